@@ -1,11 +1,12 @@
+import asyncio
 import json
 import os
 from abc import ABC, abstractmethod
-from collections.abc import Iterable
+from collections.abc import AsyncIterator, Iterable
 from datetime import datetime
 from io import BytesIO
 from logging import Logger, StreamHandler, getLogger
-from typing import List
+from typing import Any, List, Tuple
 
 import requests
 import vertexai
@@ -20,8 +21,18 @@ from proto.marshal.collections import RepeatedComposite
 from pydantic import BaseModel
 from vertexai.generative_models import GenerationConfig, GenerationResponse, GenerativeModel, Part, SafetySetting
 
+from .context_cache import ContextCacheManager, VertexContextCacheClient
+from .document_index import DocumentIndexStore, format_document_index
+from .financial_metrics import FINANCIAL_METRICS_RESPONSE_SCHEMA, parse_financial_metrics
 from .firebase_util import get_db_client_with_default_credentials
-from .gcp_util import download_file_from_gcs, upload_file_into_gcs
+from .gcp_util import (
+    download_bytes_from_gcs,
+    download_file_from_gcs,
+    get_filename_from_gcs_uri,
+    split_bucket_name_and_file_path,
+    upload_file_into_gcs,
+)
+from .pdf_preprocessor import FinancialStatementPdfPreprocessor
 
 local_logger = getLogger(__name__)
 local_logger.addHandler(StreamHandler())
@@ -52,6 +63,10 @@ class FinancialAgentConfig(BaseModel):
     temperature: int = 0
     log_bucket_name: str = "sakamomo_family_api"
     log_base_folder: str = "log"
+    use_context_cache: bool = True
+    context_cache_ttl_seconds: int = 60 * 60
+    max_context_caches: int = 16
+    use_page_selection: bool = True
     debug_mode: bool = False
 
 
@@ -85,6 +100,10 @@ class AbstractAgent(ABC):
     def get_llm_agent_response(self, input_data: dict) -> LLMAgentResponse:
         pass
 
+    async def aget_llm_agent_response(self, input_data: dict) -> LLMAgentResponse:
+        # ネイティブの非同期APIを持たないAgentは、イベントループを止めないよう別スレッドで実行する
+        return await asyncio.to_thread(self.get_llm_agent_response, input_data)
+
 
 class MainAgent(AbstractAgent):
     def __init__(self, agent_config: MainAgentConfig, logger: Logger = None) -> None:
@@ -143,6 +162,14 @@ class MainAgent(AbstractAgent):
         )
         return LLMAgentResponse(text=res["output"], metadata={})
 
+    async def aget_llm_agent_response(self, input_data: str) -> LLMAgentResponse:
+        self.__logger.info("start aget_llm_agent_response...")
+        res = await self.__agent_with_chat_history.ainvoke(
+            {"input": input_data},
+            config={"configurable": {"session_id": self.__agent_config.dialogue_session_id}},
+        )
+        return LLMAgentResponse(text=res["output"], metadata={})
+
     def get_chat_message_history(self, memory_type: str, config: dict) -> BaseChatMessageHistory:
         if memory_type == "local":
             chat_buffer = ConversationBufferMemory()
@@ -163,13 +190,25 @@ class MainAgent(AbstractAgent):
 
 # TODO : request_idをcontroller側のみで意識できるようにログのアップロード周りはcontroller側で実施した方が良いかもしれない
 class FinancialReportAgent(AbstractAgent):
-    def __init__(self, config: FinancialAgentConfig) -> None:
+    def __init__(
+        self,
+        config: FinancialAgentConfig,
+        context_cache_manager: ContextCacheManager | None = None,
+        document_index_store: DocumentIndexStore | None = None,
+    ) -> None:
         super().__init__()
 
         vertexai.init(project=os.environ["GCP_PROJECT"], location=os.environ["GCP_LOCATION"])
         self.__model = GenerativeModel(model_name=config.llm_model_name)
         self.__config = config
-        self.__generation_config = GenerationConfig(temperature=config.temperature, max_output_tokens=8192, top_p=0.95)
+        self.__generation_params = {"temperature": config.temperature, "max_output_tokens": 8192, "top_p": 0.95}
+        self.__generation_config = GenerationConfig(**self.__generation_params)
+        # 指標の抽出時は、JSONのスキーマを指定して型の決まった出力を得る
+        self.__extraction_generation_config = GenerationConfig(
+            **self.__generation_params,
+            response_mime_type="application/json",
+            response_schema=FINANCIAL_METRICS_RESPONSE_SCHEMA,
+        )
         self.__safety_settings = [
             SafetySetting(
                 category=SafetySetting.HarmCategory.HARM_CATEGORY_HATE_SPEECH,
@@ -191,26 +230,195 @@ class FinancialReportAgent(AbstractAgent):
         self.__work_folder = os.path.join(os.path.dirname(__file__), "work")
         os.makedirs(self.__work_folder, exist_ok=True)
 
+        # 同じ決算書への質問が続く場合に、pdfのトークンを毎回送らずに済むようコンテキストキャッシュを利用する
+        if context_cache_manager is None and config.use_context_cache:
+            context_cache_manager = ContextCacheManager(
+                client=VertexContextCacheClient(),
+                model_name=config.llm_model_name,
+                ttl_seconds=config.context_cache_ttl_seconds,
+                max_entries=config.max_context_caches,
+            )
+        self.__context_cache_manager = context_cache_manager
+
+        # 財務三表の分析では、該当するページのみを抜き出してLLMに送る
+        self.__pdf_preprocessor = FinancialStatementPdfPreprocessor()
+
+        # 抽出済みのテキストがある決算書は、pdfの代わりにテキストをLLMに送る
+        self.__document_index_store = document_index_store
+
+    def get_model_config(self) -> dict:
+        # 解析結果に影響するモデルの設定（キャッシュキーの生成などに利用する）
+        return {
+            "model_name": self.__config.llm_model_name,
+            "use_page_selection": self.__config.use_page_selection,
+            "use_document_index": self.__document_index_store is not None,
+            **self.__generation_params,
+        }
+
     def get_llm_agent_response(self, input_data: dict) -> LLMAgentResponse:
         # gcs uriからpdfデータを取得
         # TODO : 将来的に複数のデータタイプに対応させてもよさそう
         gcs_uri: str = input_data["gcs_uri"]
         prompt: str = input_data["prompt"]
         request_id: str = input_data["request_id"]
-        file_data = Part.from_uri(uri=gcs_uri, mime_type="application/pdf")
+        model, contents, input_info = self.__get_model_and_contents(input_data=input_data)
 
         # LLMを利用した解析処理を実施
-        contents = [file_data, prompt]
-        response = self.__model.generate_content(contents=contents, generation_config=self.__generation_config)
+        response = model.generate_content(contents=contents, generation_config=self.__generation_config)
 
         # 解析結果含めて、ログとして出力
         self.__upload_llm_log(
-            response=response, request_id=request_id, prompt=prompt, timestamp=input_data["timestamp"], gcs_uri=gcs_uri
+            response=response,
+            request_id=request_id,
+            prompt=prompt,
+            timestamp=input_data["timestamp"],
+            gcs_uri=gcs_uri,
+            input_info=input_info,
         )
 
         # 解析結果を返す
         return LLMAgentResponse(text=response.text, metadata={})
 
+    async def aget_llm_agent_response(self, input_data: dict) -> LLMAgentResponse:
+        gcs_uri: str = input_data["gcs_uri"]
+        prompt: str = input_data["prompt"]
+        request_id: str = input_data["request_id"]
+        model, contents, input_info = await asyncio.to_thread(self.__get_model_and_contents, input_data=input_data)
+
+        # LLMの応答待ちの間もイベントループを止めないよう、非同期APIで解析処理を実施
+        response = await model.generate_content_async(contents=contents, generation_config=self.__generation_config)
+
+        # GCSへのログのアップロードは同期APIのため、別スレッドで実行する
+        await asyncio.to_thread(
+            self.__upload_llm_log,
+            response=response,
+            request_id=request_id,
+            prompt=prompt,
+            timestamp=input_data["timestamp"],
+            gcs_uri=gcs_uri,
+            input_info=input_info,
+        )
+
+        return LLMAgentResponse(text=response.text, metadata={})
+
+    def extract_financial_metrics(self, input_data: dict) -> LLMAgentResponse:
+        """
+        決算書から主要な指標を抽出する. textには抽出結果のJSON、metadata["metrics"]には型変換した値を返す
+        指標は財務三表や経営指標の推移のページに記載されるため、該当ページのみを送る
+        """
+        input_data = {**input_data, "use_context_cache": False, "use_page_selection": True}
+        model, contents, input_info = self.__get_model_and_contents(input_data=input_data)
+        response = model.generate_content(contents=contents, generation_config=self.__extraction_generation_config)
+
+        self.__upload_llm_log(
+            response=response,
+            request_id=input_data["request_id"],
+            prompt=input_data["prompt"],
+            timestamp=input_data["timestamp"],
+            gcs_uri=input_data["gcs_uri"],
+            input_info=input_info,
+        )
+
+        # スキーマに合わない出力の場合はここで例外が発火される
+        metrics = parse_financial_metrics(text=response.text)
+        return LLMAgentResponse(text=response.text, metadata={"metrics": metrics.model_dump()})
+
+    async def astream_llm_agent_response(self, input_data: dict) -> AsyncIterator[str]:
+        gcs_uri: str = input_data["gcs_uri"]
+        prompt: str = input_data["prompt"]
+        model, contents, input_info = await asyncio.to_thread(self.__get_model_and_contents, input_data=input_data)
+
+        # 生成された部分から順に返し、全て返し終えた後にチャンクをまとめてログとして出力する
+        responses = []
+        async for response in await model.generate_content_async(
+            contents=contents, generation_config=self.__generation_config, stream=True
+        ):
+            responses.append(response)
+            yield self.__get_text_of_chunk(response)
+
+        await asyncio.to_thread(
+            self.__upload_llm_log,
+            response=responses,
+            request_id=input_data["request_id"],
+            prompt=prompt,
+            timestamp=input_data["timestamp"],
+            gcs_uri=gcs_uri,
+            input_info=input_info,
+        )
+
+    def __get_model_and_contents(self, input_data: dict) -> Tuple[Any, list, dict]:
+        """
+        LLMに渡すモデルとコンテンツ、ログに残す入力の情報を返す
+        抽出済みのテキストがある場合は、pdfの代わりにテキストを送る
+        use_context_cacheが指定された場合はpdfをコンテキストキャッシュに載せ、質問文のみを送る
+        use_page_selectionが指定された場合は、財務三表のページのみを抜き出したpdfを送る
+        いずれも利用できなかった場合は、通常通りpdf全体と質問文を送る
+        """
+        gcs_uri: str = input_data["gcs_uri"]
+        prompt: str = input_data["prompt"]
+        if self.__document_index_store is not None:
+            contents, input_info = self.__get_contents_from_document_index(input_data=input_data)
+            if contents is not None:
+                return self.__model, contents, input_info
+
+        if input_data.get("use_context_cache", False) and self.__context_cache_manager is not None:
+            cache_name = self.__context_cache_manager.get_or_create(gcs_uri=gcs_uri)
+            if cache_name is not None:
+                model = self.__context_cache_manager.get_model(cache_name=cache_name)
+                return model, [prompt], {"context_cache_name": cache_name}
+
+        if input_data.get("use_page_selection", False) and self.__config.use_page_selection:
+            try:
+                bucket_name, remote_file_path = split_bucket_name_and_file_path(gcs_uri=gcs_uri)
+                pdf = self.__pdf_preprocessor.preprocess(
+                    pdf_data=download_bytes_from_gcs(
+                        project_id=os.environ["GCP_PROJECT"], bucket_name=bucket_name, remote_file_path=remote_file_path
+                    )
+                )
+                if pdf.is_trimmed:
+                    file_data = Part.from_data(data=pdf.data, mime_type="application/pdf")
+                    return (
+                        self.__model,
+                        [file_data, prompt],
+                        {"kept_pages": pdf.kept_pages, "total_pages": pdf.total_pages},
+                    )
+            except Exception as e:
+                local_logger.warning(f"page selection of {gcs_uri} is failed. error detail is {e}")
+
+        file_data = Part.from_uri(uri=gcs_uri, mime_type="application/pdf")
+        return self.__model, [file_data, prompt], {}
+
+    def __get_contents_from_document_index(self, input_data: dict) -> Tuple[list | None, dict]:
+        # gcsにはdoc_id.pdfのファイル名でアップロードしているため、ファイル名からdoc_idを取得する
+        doc_id = os.path.splitext(get_filename_from_gcs_uri(gcs_uri=input_data["gcs_uri"]))[0]
+        df = self.__document_index_store.load(doc_id=doc_id)
+        if df is None:
+            return None, {}
+
+        statement_pages_only = input_data.get("use_page_selection", False) and bool(df["is_statement_page"].any())
+        text = format_document_index(df=df, statement_pages_only=statement_pages_only)
+        if text.strip() == "":
+            # 画像のみのpdfなど、テキストを抽出できていない場合はpdfを送る
+            return None, {}
+
+        kept_pages = df[df["is_statement_page"]]["page"].tolist() if statement_pages_only else df["page"].tolist()
+        input_info = {
+            "document_index_uri": self.__document_index_store.get_uri(doc_id=doc_id),
+            "kept_pages": kept_pages,
+            "total_pages": len(df),
+        }
+        return [text, input_data["prompt"]], input_info
+
+    def close(self):
+        if self.__context_cache_manager is not None:
+            self.__context_cache_manager.close()
+
+    def __get_text_of_chunk(self, response: GenerationResponse) -> str:
+        # 最後のチャンクなど、テキストを含まないチャンクの場合は空文字を返す
+        if len(response.candidates) == 0 or len(response.candidates[0].content.parts) == 0:
+            return ""
+        return response.candidates[0].text
+
     # TODO : リファクタリングする（内部関数とかをutilとかに切り出す）
     def __upload_llm_log(
         self,
@@ -219,9 +427,12 @@ class FinancialReportAgent(AbstractAgent):
         prompt: str,
         timestamp: datetime,
         gcs_uri: str,
+        input_info: dict | None = None,
     ):
+        input_info = input_info if input_info is not None else {}
+
         # citation_metadataオブジェクトをリストに変換する
-        def repeated_citations_to_list(citations: RepeatedComposite) -> list:
+        def repeated_citations_to_list(citations: RepeatedComposite | list) -> list:
             citation_li = []
             for citation in citations:
                 citation_dict = {}
@@ -244,6 +455,24 @@ class FinancialReportAgent(AbstractAgent):
                 safety_rating_li.append(safety_rating_dict)
             return safety_rating_li
 
+        # ストリーミングの場合は、テキストは全チャンクを連結し、終了理由やトークン数は最後のチャンクの値を利用する
+        if isinstance(response, GenerationResponse):
+            text = response.candidates[0].text
+            last_response = response
+            citations = list(response.candidates[0].citation_metadata.citations)
+        else:
+            responses = list(response)
+            text = "".join([self.__get_text_of_chunk(chunk) for chunk in responses])
+            last_response = responses[-1]
+            citations = [
+                citation
+                for chunk in responses
+                if len(chunk.candidates) > 0
+                for citation in chunk.candidates[0].citation_metadata.citations
+            ]
+        usage_metadata = last_response._raw_response.usage_metadata
+        candidate = last_response.candidates[0]
+
         # llmのログをローカルに生成
         llm_log_data = {
             "input": {
@@ -251,21 +480,27 @@ class FinancialReportAgent(AbstractAgent):
                 "prompt": prompt,
                 "model_name": self.__config.llm_model_name,
                 "llm_config": {"temperature": self.__config.temperature},
-                "prompt_token_count": response._raw_response.usage_metadata.prompt_token_count,
+                "prompt_token_count": usage_metadata.prompt_token_count,
                 "gcs_uri": gcs_uri,
+                "context_cache_name": input_info.get("context_cache_name"),
+                "cached_content_token_count": getattr(usage_metadata, "cached_content_token_count", 0),
+                # ページを抜き出した場合は、LLMに送ったページ番号（1始まり）と元のページ数を残す
+                "kept_pages": input_info.get("kept_pages"),
+                "total_pages": input_info.get("total_pages"),
+                "document_index_uri": input_info.get("document_index_uri"),
             },
             "output": {
-                "text": response.candidates[0].text,
-                "finish_reason": response.candidates[0].finish_reason.name,
-                "finish_message": response.candidates[0].finish_message,
-                "safety_ratings": repeated_safety_ratings_to_list(response.candidates[0].safety_ratings),
-                "citation_metadata": repeated_citations_to_list(response.candidates[0].citation_metadata.citations),
-                "candidates_token_count": response._raw_response.usage_metadata.candidates_token_count,
-                "total_token_count": response._raw_response.usage_metadata.total_token_count,
+                "text": text,
+                "finish_reason": candidate.finish_reason.name,
+                "finish_message": candidate.finish_message,
+                "safety_ratings": repeated_safety_ratings_to_list(candidate.safety_ratings),
+                "citation_metadata": repeated_citations_to_list(citations),
+                "candidates_token_count": usage_metadata.candidates_token_count,
+                "total_token_count": usage_metadata.total_token_count,
             },
             "meta": {"timestamp": timestamp.strftime("%Y%m%d%H%M%S"), "request_id": request_id},
         }
-        tmp_log_file = os.path.join(self.__work_folder, "tmp_log.json")
+        tmp_log_file = os.path.join(self.__work_folder, f"tmp_log_{request_id}.json")
         with open(tmp_log_file, "w") as f:
             json.dump(llm_log_data, f, ensure_ascii=False)
 
@@ -0,0 +1,148 @@
+import hashlib
+import json
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime, timezone
+from logging import Logger, StreamHandler, getLogger
+from typing import Tuple
+
+from .firebase_util import get_db_client_with_default_credentials
+
+local_logger = getLogger(__name__)
+local_logger.addHandler(StreamHandler())
+local_logger.setLevel("DEBUG")
+
+
+def create_analysis_cache_key(content_hash: str, prompt: str, model_config: dict) -> str:
+    """
+    決算書の内容のハッシュ値、プロンプト、モデル名と生成時の設定から、解析結果のキャッシュキーを生成する
+    いずれかが異なれば解析結果も変わりうるため、別のキーとなる
+    """
+    key_source = {
+        "content_hash": content_hash,
+        "prompt_hash": hashlib.sha256(prompt.encode("utf-8")).hexdigest(),
+        "model_config": model_config,
+    }
+    return hashlib.sha256(json.dumps(key_source, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class AbstractAnalysisCacheStore(ABC):
+    @abstractmethod
+    def get(self, key: str) -> Tuple[dict, datetime] | None:
+        pass
+
+    @abstractmethod
+    def set(self, key: str, value: dict):
+        pass
+
+
+class FirestoreAnalysisCacheStore(AbstractAnalysisCacheStore):
+    """Firestoreに解析結果を保存する（インスタンスの再起動や複数インスタンス間でキャッシュを共有するために利用）"""
+
+    def __init__(self, collection_id: str = "AnalysisResultCache") -> None:
+        self.__collection_id = collection_id
+        self.__db = get_db_client_with_default_credentials()
+
+    def get(self, key: str) -> Tuple[dict, datetime] | None:
+        snapshot = self.__db.collection(self.__collection_id).document(key).get()
+        if not snapshot.exists:
+            return None
+        data = snapshot.to_dict()
+        return data["value"], datetime.fromisoformat(data["created_at"])
+
+    def set(self, key: str, value: dict):
+        data = {"value": value, "created_at": datetime.now(timezone.utc).isoformat()}
+        self.__db.collection(self.__collection_id).document(key).set(data)
+
+
+class AnalysisResultCache:
+    """
+    決算書の解析結果のキャッシュ
+    プロセス内のLRUキャッシュと、永続化用のストアの2段構成とし、どちらもttl_secondsを過ぎたものは利用しない
+    """
+
+    def __init__(
+        self,
+        persistent_store: AbstractAnalysisCacheStore | None = None,
+        max_size: int = 128,
+        ttl_seconds: int = 7 * 24 * 60 * 60,
+        custom_logger: Logger = None,
+    ) -> None:
+        self.__persistent_store = persistent_store
+        self.__max_size = max_size
+        self.__ttl_seconds = ttl_seconds
+        self.__logger = custom_logger if custom_logger is not None else local_logger
+        self.__local_cache: OrderedDict[str, Tuple[dict, float]] = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key: str) -> dict | None:
+        # まずはプロセス内のキャッシュを参照する
+        with self.__lock:
+            item = self.__local_cache.get(key)
+            if item is not None:
+                value, expired_at = item
+                if time.monotonic() < expired_at:
+                    self.__local_cache.move_to_end(key)
+                    return value
+                del self.__local_cache[key]
+
+        if self.__persistent_store is None:
+            return None
+
+        # 永続化用のストアにあれば、プロセス内のキャッシュにも残り時間分だけ載せる
+        try:
+            item = self.__persistent_store.get(key=key)
+        except Exception as e:
+            self.__logger.warning(f"getting analysis cache is failed. error detail is {e}")
+            return None
+        if item is None:
+            return None
+        value, created_at = item
+        remaining_seconds = self.__ttl_seconds - (datetime.now(timezone.utc) - created_at).total_seconds()
+        if remaining_seconds <= 0:
+            return None
+        self.__set_local(key=key, value=value, ttl_seconds=remaining_seconds)
+        return value
+
+    def set(self, key: str, value: dict):
+        self.__set_local(key=key, value=value, ttl_seconds=self.__ttl_seconds)
+        if self.__persistent_store is None:
+            return
+
+        # キャッシュの保存に失敗しても、解析結果は返せるようにする
+        try:
+            self.__persistent_store.set(key=key, value=value)
+        except Exception as e:
+            self.__logger.warning(f"setting analysis cache is failed. error detail is {e}")
+
+    def clear(self):
+        # プロセス内のキャッシュのみを破棄する（永続化用のストアは有効期限で失効させる）
+        with self.__lock:
+            self.__local_cache.clear()
+
+    def __set_local(self, key: str, value: dict, ttl_seconds: float):
+        with self.__lock:
+            self.__local_cache[key] = (value, time.monotonic() + ttl_seconds)
+            self.__local_cache.move_to_end(key)
+            while len(self.__local_cache) > self.__max_size:
+                self.__local_cache.popitem(last=False)
+
+
+def create_analysis_cache(
+    cache_type: str, config: dict | None = None, custom_logger: Logger = None
+) -> AnalysisResultCache:
+    config = config if config is not None else {}
+    if cache_type == "memory":
+        persistent_store = None
+    elif cache_type == "firestore":
+        persistent_store = FirestoreAnalysisCacheStore(collection_id=config.get("collection", "AnalysisResultCache"))
+    else:
+        raise NotImplementedError(f"{cache_type} analysis cache type is not implemented!")
+    return AnalysisResultCache(
+        persistent_store=persistent_store,
+        max_size=config.get("max_size", 128),
+        ttl_seconds=config.get("ttl_seconds", 7 * 24 * 60 * 60),
+        custom_logger=custom_logger,
+    )
@@ -1,14 +1,18 @@
+import json
+import os
 from enum import Enum
 from logging import StreamHandler, getLogger
-from typing import List
+from typing import AsyncIterator, List, Tuple
 
-from fastapi import FastAPI
+import fastapi.responses
+from fastapi import FastAPI, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import RedirectResponse, StreamingResponse
 from pydantic import BaseModel
 from starlette.exceptions import HTTPException
 
 from .controller import Controller
+from .job_store import JobNotFoundError
 
 
 class Response(BaseModel):
@@ -41,12 +45,57 @@ class AnalyzeFinancialReportRequest(BaseModel):
     analysis_type: int
     message: str
     gcs_uri: str
+    use_cache: bool = True
 
 
 class AnalyzeFinancialReportResponse(BaseModel):
     request_id: str
     text: str
     prompt: str
+    cache_hit: bool = False
+
+
+class AnalysisJobResponse(BaseModel):
+    request_id: str
+    job_id: str
+    status: str
+    result: AnalyzeFinancialReportResponse | None = None
+    error: str | None = None
+
+
+class BatchAnalysisRequest(BaseModel):
+    doc_ids: List[str] = []
+    company_name: str | None = None
+    limit: int | None = None
+    analysis_type: int = 0
+    message: str = ""
+    use_cache: bool = True
+
+
+class BatchAnalysisJobResponse(BaseModel):
+    request_id: str
+    job_id: str
+    status: str
+    result: dict | None = None
+    error: str | None = None
+
+
+class ExtractFinancialMetricsRequest(BaseModel):
+    gcs_uri: str
+    use_cache: bool = True
+
+
+class ExtractFinancialMetricsResponse(BaseModel):
+    request_id: str
+    metrics: dict
+    cache_hit: bool = False
+
+
+class FinancialMetricsJobRequest(BaseModel):
+    doc_ids: List[str] = []
+    company_name: str | None = None
+    limit: int | None = None
+    use_cache: bool = True
 
 
 class UploadFinancialReportRequest(BaseModel):
@@ -74,7 +123,7 @@ logger.setLevel("DEBUG")
 
 app = FastAPI(title="sakamomo_family_api", description="The API is sakamomo family bot.")
 session_id = "sakamomo_family_session"
-controller = Controller(dialogue_session_id=session_id)
+controller = Controller(dialogue_session_id=session_id, max_workers=int(os.getenv("CONTROLLER_MAX_WORKERS", 32)))
 
 
 # CORS対応
@@ -92,15 +141,21 @@ app.add_middleware(
 )
 
 
+@app.on_event("shutdown")
+def shutdown():
+    # 作成済みのコンテキストキャッシュを削除し、保持期間分の課金が続かないようにする
+    controller.close()
+
+
 @app.get("/health")
-def health():
+async def health():
     return Response(status=0, message="OK")
 
 
 @app.post("/bot")
-def bot(request: BotRequest):
+async def bot(request: BotRequest):
     try:
-        res = controller.handle_message(message=request.message)
+        res = await controller.ahandle_message(message=request.message)
     except Exception as e:
         logger.error(e)
         raise HTTPException(status_code=500, detail="Internal Server Error. Bot process is failed.")
@@ -108,9 +163,9 @@ def bot(request: BotRequest):
 
 
 @app.post("/financial_document_list")
-def financial_document_list(request: FinancialDocumentListRequest):
+async def financial_document_list(request: FinancialDocumentListRequest):
     try:
-        res = controller.search_financial_documents_if_existed(company_name=request.company_name)
+        res = await controller.asearch_financial_documents_if_existed(company_name=request.company_name)
         document_list = [
             FinancialDocumentData(
                 doc_id=item["doc_id"],
@@ -127,29 +182,229 @@ def financial_document_list(request: FinancialDocumentListRequest):
 
 
 @app.post("/analyze_financial_document")
-def analyze_financial_document(request: AnalyzeFinancialReportRequest):
+async def analyze_financial_document(request: AnalyzeFinancialReportRequest):
     if request.analysis_type == FinancialReportAnalysisType.QA.value:
         message = request.message
     else:
         message = None
 
     try:
-        res = controller.analyze_financial_document(gcs_uri=request.gcs_uri, message=message)
+        res = await controller.aanalyze_financial_document(
+            gcs_uri=request.gcs_uri, message=message, use_cache=request.use_cache
+        )
     except Exception as e:
         logger.error(e)
         raise HTTPException(
             status_code=500, detail="Internal Server Error. Analysis Financial Report process is failed."
         )
     return AnalyzeFinancialReportResponse(
-        text=res.detail["response_text"], prompt=res.detail["prompt"], request_id=res.request_id
+        text=res.detail["response_text"],
+        prompt=res.detail["prompt"],
+        request_id=res.request_id,
+        cache_hit=res.detail["cache_hit"],
+    )
+
+
+@app.post("/analyze_financial_document/stream")
+async def stream_analyze_financial_document(request: AnalyzeFinancialReportRequest):
+    # LLMの生成結果をServer-Sent Eventsで逐次返し、最初のトークンが届くまでの待ち時間のみで表示を開始できるようにする
+    if request.analysis_type == FinancialReportAnalysisType.QA.value:
+        message = request.message
+    else:
+        message = None
+
+    try:
+        res = await controller.acreate_analysis_stream(
+            gcs_uri=request.gcs_uri, message=message, use_cache=request.use_cache
+        )
+    except Exception as e:
+        logger.error(e)
+        raise HTTPException(
+            status_code=500, detail="Internal Server Error. Analysis Financial Report process is failed."
+        )
+    return StreamingResponse(
+        to_server_sent_events(
+            request_id=res.request_id,
+            prompt=res.detail["prompt"],
+            cache_hit=res.detail["cache_hit"],
+            stream=res.detail["stream"],
+        ),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def to_server_sent_events(
+    request_id: str, prompt: str, cache_hit: bool, stream: AsyncIterator[str]
+) -> AsyncIterator[str]:
+    """
+    生成結果をSSEの形式に変換する. テキストは改行を含むため、json文字列としてdataに格納する
+    metadata -> message(複数) -> done の順に送信し、途中で失敗した場合はerrorを送信して終了する
+    """
+    yield f"event: metadata\ndata: {json.dumps({'request_id': request_id, 'prompt': prompt, 'cache_hit': cache_hit}, ensure_ascii=False)}\n\n"
+    try:
+        async for text in stream:
+            if text == "":
+                continue
+            yield f"event: message\ndata: {json.dumps({'text': text}, ensure_ascii=False)}\n\n"
+    except Exception as e:
+        logger.error(e)
+        message = "Internal Server Error. Analysis Financial Report process is failed."
+        yield f"event: error\ndata: {json.dumps({'message': message}, ensure_ascii=False)}\n\n"
+        return
+    yield f"event: done\ndata: {json.dumps({'request_id': request_id})}\n\n"
+
+
+@app.post("/analysis_jobs", status_code=202)
+async def submit_analysis_job(request: AnalyzeFinancialReportRequest):
+    # LLMの応答を待たずにjob_idを返し、結果はGET /analysis_jobs/{job_id}で取得させる
+    if request.analysis_type == FinancialReportAnalysisType.QA.value:
+        message = request.message
+    else:
+        message = None
+
+    try:
+        res = await controller.asubmit_analysis_job(
+            gcs_uri=request.gcs_uri, message=message, use_cache=request.use_cache
+        )
+    except Exception as e:
+        logger.error(e)
+        raise HTTPException(status_code=500, detail="Internal Server Error. Submit Analysis Job process is failed.")
+    return AnalysisJobResponse(request_id=res.request_id, job_id=res.detail["job_id"], status=res.detail["status"])
+
+
+@app.get("/analysis_jobs/{job_id}")
+async def get_analysis_job(job_id: str):
+    try:
+        res = await controller.aget_analysis_job(job_id=job_id)
+    except JobNotFoundError as e:
+        logger.error(e)
+        raise HTTPException(status_code=404, detail="Analysis Job is not found.")
+    except Exception as e:
+        logger.error(e)
+        raise HTTPException(status_code=500, detail="Internal Server Error. Get Analysis Job process is failed.")
+
+    result = None
+    if res.detail["result"] is not None:
+        result = AnalyzeFinancialReportResponse(
+            text=res.detail["result"]["response_text"],
+            prompt=res.detail["result"]["prompt"],
+            request_id=res.detail["result"]["request_id"],
+            cache_hit=res.detail["result"].get("cache_hit", False),
+        )
+    return AnalysisJobResponse(
+        request_id=res.request_id,
+        job_id=res.detail["job_id"],
+        status=res.detail["status"],
+        result=result,
+        error=res.detail["error"],
+    )
+
+
+@app.post("/batch_analysis", status_code=202)
+async def submit_batch_analysis(request: BatchAnalysisRequest):
+    # doc_idのリスト、または企業名で検索した有価証券報告書をまとめて解析するジョブを投入する
+    if len(request.doc_ids) == 0 and request.company_name is None:
+        raise HTTPException(status_code=400, detail="doc_ids or company_name is required.")
+    if request.analysis_type == FinancialReportAnalysisType.QA.value:
+        message = request.message
+    else:
+        message = None
+
+    try:
+        res = await controller.asubmit_batch_analysis_job(
+            doc_ids=request.doc_ids,
+            company_name=request.company_name,
+            limit=request.limit,
+            message=message,
+            use_cache=request.use_cache,
+        )
+    except Exception as e:
+        logger.error(e)
+        raise HTTPException(status_code=500, detail="Internal Server Error. Submit Batch Analysis process is failed.")
+    return BatchAnalysisJobResponse(request_id=res.request_id, job_id=res.detail["job_id"], status=res.detail["status"])
+
+
+@app.get("/batch_analysis/{job_id}")
+async def get_batch_analysis(job_id: str):
+    try:
+        res = await controller.aget_batch_analysis_job(job_id=job_id)
+    except JobNotFoundError as e:
+        logger.error(e)
+        raise HTTPException(status_code=404, detail="Batch Analysis Job is not found.")
+    except Exception as e:
+        logger.error(e)
+        raise HTTPException(status_code=500, detail="Internal Server Error. Get Batch Analysis process is failed.")
+    return BatchAnalysisJobResponse(
+        request_id=res.request_id,
+        job_id=res.detail["job_id"],
+        status=res.detail["status"],
+        result=res.detail["result"],
+        error=res.detail["error"],
+    )
+
+
+@app.post("/extract_financial_metrics")
+async def extract_financial_metrics(request: ExtractFinancialMetricsRequest):
+    try:
+        res = await controller.aextract_financial_metrics(gcs_uri=request.gcs_uri, use_cache=request.use_cache)
+    except Exception as e:
+        logger.error(e)
+        raise HTTPException(
+            status_code=500, detail="Internal Server Error. Extract Financial Metrics process is failed."
+        )
+    return ExtractFinancialMetricsResponse(
+        request_id=res.request_id, metrics=res.detail["metrics"], cache_hit=res.detail["cache_hit"]
+    )
+
+
+@app.post("/financial_metrics_jobs", status_code=202)
+async def submit_financial_metrics_job(request: FinancialMetricsJobRequest):
+    # 複数の決算書から指標を抽出し、BigQueryにまとめてロードするジョブを投入する
+    if len(request.doc_ids) == 0 and request.company_name is None:
+        raise HTTPException(status_code=400, detail="doc_ids or company_name is required.")
+
+    try:
+        res = await controller.asubmit_financial_metrics_job(
+            doc_ids=request.doc_ids,
+            company_name=request.company_name,
+            limit=request.limit,
+            use_cache=request.use_cache,
+        )
+    except Exception as e:
+        logger.error(e)
+        raise HTTPException(
+            status_code=500, detail="Internal Server Error. Submit Financial Metrics Job process is failed."
+        )
+    return BatchAnalysisJobResponse(request_id=res.request_id, job_id=res.detail["job_id"], status=res.detail["status"])
+
+
+@app.get("/financial_metrics_jobs/{job_id}")
+async def get_financial_metrics_job(job_id: str):
+    try:
+        res = await controller.aget_financial_metrics_job(job_id=job_id)
+    except JobNotFoundError as e:
+        logger.error(e)
+        raise HTTPException(status_code=404, detail="Financial Metrics Job is not found.")
+    except Exception as e:
+        logger.error(e)
+        raise HTTPException(
+            status_code=500, detail="Internal Server Error. Get Financial Metrics Job process is failed."
+        )
+    return BatchAnalysisJobResponse(
+        request_id=res.request_id,
+        job_id=res.detail["job_id"],
+        status=res.detail["status"],
+        result=res.detail["result"],
+        error=res.detail["error"],
     )
 
 
 # TODO : この機能はバイナリファイルを受け取れるようにするか、ユーザーには提供しない機能とするか、検討した方が良さそう
 @app.post("/upload_financial_report")
-def upload_financial_report(request: UploadFinancialReportRequest):
+async def upload_financial_report(request: UploadFinancialReportRequest):
     try:
-        res = controller.upload_financial_report_into_gcs(doc_id=request.doc_id)
+        res = await controller.aupload_financial_report_into_gcs(doc_id=request.doc_id)
     except Exception as e:
         logger.error(e)
         raise HTTPException(status_code=500, detail="Internal Server Error. Upload Financial Report Process is failed.")
@@ -157,18 +412,90 @@ def upload_financial_report(request: UploadFinancialReportRequest):
 
 
 @app.get("/download_financial_document")
-def download_financial_document(gcs_uri: str):
+async def download_financial_document(
+    gcs_uri: str,
+    redirect: bool = False,
+    range_header: str | None = Header(default=None, alias="Range"),
+    if_none_match: str | None = Header(default=None),
+):
+    # 署名付きURLへのリダイレクトが指定された場合は、APIサーバーを経由せずGCSから直接ダウンロードさせる
+    if redirect:
+        try:
+            res = await controller.acreate_financial_document_signed_url(gcs_uri=gcs_uri)
+        except Exception as e:
+            logger.error(e)
+            raise HTTPException(
+                status_code=500, detail="Internal Server Error. Download Financial Report Process is failed."
+            )
+        return RedirectResponse(url=res.detail["signed_url"], status_code=307)
+
     try:
-        res = controller.downalod_financial_document(gcs_uri=gcs_uri)
+        res = await controller.aget_financial_document_metadata(gcs_uri=gcs_uri)
+    except FileNotFoundError as e:
+        logger.error(e)
+        raise HTTPException(status_code=404, detail="Financial Report is not found.")
     except Exception as e:
         logger.error(e)
         raise HTTPException(
             status_code=500, detail="Internal Server Error. Download Financial Report Process is failed."
         )
-    # TODO : FileResponseを使うと楽かも
-    # return fastapi.responses.Response(
-    #     content=res.detail["document_data"],
-    #     media_type=res.detail["mime_type"],
-    #     status_code=200
-    # )
-    return FileResponse(path=res.detail["document_path"], media_type=res.detail["mime_type"], status_code=200)
+
+    size = res.detail["size"]
+    etag = f'"{res.detail["etag"]}"'
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Content-Disposition": f'inline; filename="{res.detail["filename"]}"',
+    }
+
+    # クライアントが同じファイルを保持している場合は、本文を返さない
+    if if_none_match is not None and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return fastapi.responses.Response(status_code=304, headers=headers)
+
+    # Rangeヘッダーが指定された場合は、指定範囲のみを返す
+    status_code = 200
+    start, end = 0, size - 1
+    if range_header is not None:
+        try:
+            byte_range = parse_range_header(range_header=range_header, size=size)
+        except ValueError:
+            return fastapi.responses.Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+        if byte_range is not None:
+            start, end = byte_range
+            status_code = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+
+    # GCSからチャンク単位で読み込みながら返すため、ローカルディスクには保存しない
+    chunks = (
+        controller.iter_financial_document_chunks(
+            gcs_uri=gcs_uri, start=start, end=end, generation=res.detail["generation"]
+        )
+        if size > 0
+        else iter([])
+    )
+    return StreamingResponse(chunks, status_code=status_code, media_type=res.detail["mime_type"], headers=headers)
+
+
+def parse_range_header(range_header: str, size: int) -> Tuple[int, int] | None:
+    """
+    Rangeヘッダーを解析し、(開始位置, 終了位置)を返す. 終了位置は範囲に含む
+    単一範囲以外の指定は、ファイル全体を返すためNoneを返す. 満たせない範囲の場合はValueErrorを送出する
+    """
+    unit, _, ranges = range_header.partition("=")
+    if unit.strip() != "bytes" or "," in ranges:
+        return None
+
+    start_str, _, end_str = ranges.strip().partition("-")
+    if start_str == "":
+        # bytes=-500のように、末尾からのバイト数が指定された場合
+        if end_str == "" or int(end_str) == 0:
+            raise ValueError(f"range header is invalid. {range_header}")
+        start = max(0, size - int(end_str))
+        end = size - 1
+    else:
+        start = int(start_str)
+        end = min(int(end_str), size - 1) if end_str != "" else size - 1
+    if start >= size or start > end:
+        raise ValueError(f"range header is not satisfiable. {range_header}")
+    return start, end
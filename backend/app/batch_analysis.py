@@ -0,0 +1,165 @@
+"""
+複数の有価証券報告書をまとめて解析するためのモジュール
+
+CLIとしても実行できる. 実行例:
+    python -m app.batch_analysis --doc_ids S100XXXX S100YYYY --output output/batch.parquet
+    python -m app.batch_analysis --company_name トヨタ --max_workers 8 --output output/batch.jsonl
+    python -m app.batch_analysis --doc_ids S1 S2 S3 --stub --stub_latency 1.0  # GCPに接続せずに動作を確認する場合
+"""
+
+import json
+import os
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from logging import Logger, StreamHandler, getLogger
+from typing import Callable, List
+
+import pandas as pd
+from pydantic import BaseModel
+
+local_logger = getLogger(__name__)
+local_logger.addHandler(StreamHandler())
+local_logger.setLevel("DEBUG")
+
+
+class BatchAnalysisItem(BaseModel):
+    doc_id: str
+    status: str
+    gcs_uri: str | None = None
+    request_id: str | None = None
+    response_text: str | None = None
+    cache_hit: bool | None = None
+    error: str | None = None
+    elapsed_seconds: float
+
+
+class BatchAnalyzer:
+    """
+    doc_idのリストを、上限付きのスレッドプールで並列にアップロード・解析するクラス
+    1件の失敗で全体を止めないよう、結果はdoc_id毎にstatus（succeeded / failed）を持たせて返す
+    """
+
+    def __init__(
+        self,
+        upload: Callable[[str], str],
+        analyze: Callable[[str, str | None], dict],
+        max_workers: int = 8,
+        custom_logger: Logger = None,
+    ) -> None:
+        """
+        Args:
+            upload (Callable[[str], str]): doc_idを受け取り、決算書をGCSに配置してgcs uriを返す関数
+            analyze (Callable[[str, str | None], dict]): gcs uriと質問を受け取り、解析結果（response_textなど）を返す関数
+            max_workers (int): 同時に解析する件数の上限
+        """
+        self.__upload = upload
+        self.__analyze = analyze
+        self.__max_workers = max(1, max_workers)
+        self.__logger = custom_logger if custom_logger is not None else local_logger
+
+    def run(self, doc_ids: List[str], message: str | None = None) -> List[BatchAnalysisItem]:
+        # 同じdoc_idが複数指定されても、解析は1回のみとする
+        unique_doc_ids = list(dict.fromkeys(doc_ids))
+        with ThreadPoolExecutor(max_workers=self.__max_workers, thread_name_prefix="batch_analysis") as executor:
+            items = list(executor.map(lambda doc_id: self.__run_item(doc_id=doc_id, message=message), unique_doc_ids))
+
+        success_count = len([item for item in items if item.status == "succeeded"])
+        self.__logger.info(f"batch analysis is finished. success count = {success_count}, total count = {len(items)}")
+        return items
+
+    def __run_item(self, doc_id: str, message: str | None) -> BatchAnalysisItem:
+        start_time = time.perf_counter()
+        gcs_uri = None
+        try:
+            gcs_uri = self.__upload(doc_id)
+            result = self.__analyze(gcs_uri, message)
+            return BatchAnalysisItem(
+                doc_id=doc_id,
+                status="succeeded",
+                gcs_uri=gcs_uri,
+                request_id=result.get("request_id"),
+                response_text=result.get("response_text"),
+                cache_hit=result.get("cache_hit"),
+                elapsed_seconds=time.perf_counter() - start_time,
+            )
+        except Exception as e:
+            self.__logger.error(f"batch analysis of {doc_id} is failed. error detail is {e}")
+            return BatchAnalysisItem(
+                doc_id=doc_id,
+                status="failed",
+                gcs_uri=gcs_uri,
+                error=str(e),
+                elapsed_seconds=time.perf_counter() - start_time,
+            )
+
+
+def write_batch_results(items: List[BatchAnalysisItem], output_path: str) -> str:
+    # 拡張子が.parquetの場合はParquet、それ以外はJSONL形式で出力する
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    if output_path.endswith(".parquet"):
+        df = pd.DataFrame([item.model_dump() for item in items], columns=list(BatchAnalysisItem.model_fields.keys()))
+        df.to_parquet(output_path, index=False)
+    else:
+        with open(output_path, "w") as f:
+            for item in items:
+                f.write(json.dumps(item.model_dump(), ensure_ascii=False) + "\n")
+    return output_path
+
+
+def create_stub_functions(latency_seconds: float) -> tuple:
+    # GCPやEDINETに接続せずに並列実行の挙動を確認するためのスタブ
+    def upload(doc_id: str) -> str:
+        time.sleep(latency_seconds * 0.1)
+        return f"gs://stub_bucket/document/{doc_id}.pdf"
+
+    def analyze(gcs_uri: str, message: str | None) -> dict:
+        time.sleep(latency_seconds)
+        return {"request_id": "stub", "response_text": f"analysis result of {gcs_uri}", "cache_hit": False}
+
+    return upload, analyze
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--doc_ids", nargs="*", default=[])
+    parser.add_argument(
+        "--company_name",
+        type=str,
+        default=None,
+        help="指定した場合、BigQueryから該当する有価証券報告書を検索して対象に加える",
+    )
+    parser.add_argument(
+        "--limit", type=int, default=None, help="company_nameで検索した結果のうち、新しいものから解析する件数"
+    )
+    parser.add_argument("--message", type=str, default=None, help="未指定の場合は財務三表の分析を行う")
+    parser.add_argument("--max_workers", type=int, default=8)
+    parser.add_argument("--no_cache", action="store_true")
+    parser.add_argument("--output", type=str, default=os.path.join("output", "batch_analysis.jsonl"))
+    parser.add_argument("--stub", action="store_true")
+    parser.add_argument("--stub_latency", type=float, default=1.0)
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    if args.stub:
+        upload, analyze = create_stub_functions(latency_seconds=args.stub_latency)
+        items = BatchAnalyzer(upload=upload, analyze=analyze, max_workers=args.max_workers).run(
+            doc_ids=args.doc_ids, message=args.message
+        )
+    else:
+        from .controller import Controller
+
+        controller = Controller(dialogue_session_id="batch_analysis_session")
+        doc_ids = list(args.doc_ids)
+        if args.company_name is not None:
+            doc_ids += controller.search_doc_ids(company_name=args.company_name, limit=args.limit)
+        items = controller.run_batch_analysis(
+            doc_ids=doc_ids, message=args.message, use_cache=not args.no_cache, max_workers=args.max_workers
+        )
+
+    write_batch_results(items=items, output_path=args.output)
+    success_count = len([item for item in items if item.status == "succeeded"])
+    print(
+        f"success count = {success_count}, error count = {len(items) - success_count}, "
+        f"elapsed = {time.perf_counter() - start_time:.2f}s, output = {args.output}"
+    )
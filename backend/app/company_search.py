@@ -0,0 +1,104 @@
+import os
+import threading
+import time
+from datetime import datetime
+from logging import Logger, StreamHandler, getLogger
+from typing import List, Tuple
+
+from google.cloud import bigquery
+
+from .analysis_cache import AnalysisResultCache
+from .company_search_index import CompanySearchIndexLoader, normalize_company_name
+from .gcp_util import get_bigquery_client
+
+local_logger = getLogger(__name__)
+local_logger.addHandler(StreamHandler())
+local_logger.setLevel("DEBUG")
+
+SEARCH_COMPANY_SQL_PATH = os.path.join(os.path.dirname(__file__), "sql", "search_company.sql")
+
+
+class CompanySearcher:
+    """
+    企業名から有価証券報告書の一覧をBigQueryで検索するクラス
+    検索結果は正規化した企業名をキーにプロセス内でキャッシュし、日次ジョブでテーブルが更新された場合は破棄する
+    search_indexを指定した場合は、索引を読み込み済みであればBigQueryを使わずに索引で検索する
+    """
+
+    def __init__(
+        self,
+        table_id: str,
+        cache_max_size: int = 256,
+        cache_ttl_seconds: int = 24 * 60 * 60,
+        freshness_check_seconds: int = 5 * 60,
+        search_index: CompanySearchIndexLoader | None = None,
+        client: bigquery.Client = None,
+        custom_logger: Logger = None,
+    ) -> None:
+        self.__table_id = table_id
+        self.__search_index = search_index
+        self.__client = client if client is not None else get_bigquery_client()
+        self.__logger = custom_logger if custom_logger is not None else local_logger
+
+        # SQLのテンプレートは初期化時に一度だけ読み込む. 企業名はクエリパラメータとして渡す
+        with open(SEARCH_COMPANY_SQL_PATH, "r") as f:
+            self.__query = f.read().format(table_id=table_id)
+
+        self.__cache = AnalysisResultCache(
+            persistent_store=None, max_size=cache_max_size, ttl_seconds=cache_ttl_seconds, custom_logger=self.__logger
+        )
+        self.__freshness_check_seconds = freshness_check_seconds
+        self.__lock = threading.Lock()
+        self.__table_modified: datetime | None = None
+        self.__checked_at: float | None = None
+
+    def search(self, company_name: str) -> Tuple[List[dict], str]:
+        """検索結果（提出日時の新しい順）と、検索に利用したもの（index / cache / bigquery）を返す"""
+        if self.__search_index is not None:
+            items = self.__search_index.search(company_name=company_name)
+            if items is not None:
+                return items, "index"
+
+        key = normalize_company_name(company_name)
+        self.__invalidate_if_table_updated()
+        cached_result = self.__cache.get(key=key)
+        if cached_result is not None:
+            return cached_result["items"], "cache"
+
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ScalarQueryParameter("company_name", "STRING", key)]
+        )
+        rows = self.__client.query(self.__query, job_config=job_config).result()
+        items = [
+            {"doc_id": row["docID"], "filer_name": row["filerName"], "doc_description": row["docDescription"]}
+            for row in rows
+        ]
+        self.__cache.set(key=key, value={"items": items})
+        return items, "bigquery"
+
+    def clear(self):
+        self.__cache.clear()
+
+    def close(self):
+        if self.__search_index is not None:
+            self.__search_index.close()
+
+    def __invalidate_if_table_updated(self):
+        # テーブルの更新日時はメタデータのAPIで取得でき、クエリは発行しない. 確認はfreshness_check_seconds毎に行う
+        with self.__lock:
+            now = time.monotonic()
+            if self.__checked_at is not None and now - self.__checked_at < self.__freshness_check_seconds:
+                return
+            self.__checked_at = now
+
+        try:
+            modified = self.__client.get_table(self.__table_id).modified
+        except Exception as e:
+            self.__logger.warning(f"getting metadata of {self.__table_id} is failed. error detail is {e}")
+            return
+
+        with self.__lock:
+            if self.__table_modified is not None and modified != self.__table_modified:
+                self.__logger.info(f"{self.__table_id} is updated at {modified}. search cache is cleared.")
+                self.__cache.clear()
+            self.__table_modified = modified
@@ -0,0 +1,185 @@
+import heapq
+import os
+import threading
+import unicodedata
+from collections import defaultdict
+from io import BytesIO
+from itertools import chain, islice
+from logging import Logger, StreamHandler, getLogger
+from typing import Dict, List
+
+import pandas as pd
+
+from .gcp_util import download_bytes_from_gcs, get_file_metadata_from_gcs, split_bucket_name_and_file_path
+
+local_logger = getLogger(__name__)
+local_logger.addHandler(StreamHandler())
+local_logger.setLevel("DEBUG")
+
+# 日次ジョブが出力するスナップショットの列
+SEARCH_SNAPSHOT_COLUMNS = ["docID", "filerName", "docDescription", "submitDateTime", "pdfFlag"]
+
+
+def normalize_company_name(company_name: str) -> str:
+    # 全角・半角や大文字・小文字、空白の違いで別の企業名として扱われないよう正規化する
+    return " ".join(unicodedata.normalize("NFKC", company_name).split()).lower()
+
+
+def create_ngrams(text: str) -> set:
+    # 1文字の検索にも対応できるよう、1-gramと2-gramの両方を索引に載せる
+    return set(text) | {text[i : i + 2] for i in range(len(text) - 1)}
+
+
+class CompanySearchIndex:
+    """
+    企業名の部分一致検索を行うためのn-gramの転置索引
+    同じ企業の書類は企業名を共有するため、索引は重複を除いた企業名単位で作成し、企業名から書類の一覧を引く
+    書類は提出日時の新しい順に並べておき、検索結果もその順に返す
+    """
+
+    def __init__(self, df: pd.DataFrame) -> None:
+        # BigQueryでの検索と同じく、pdfのある有価証券報告書のみを対象とする
+        # pdfFlagはテーブルの移行前のスナップショットでは"1"、移行後はTrueとなるため、どちらも受け付ける
+        df = df[
+            df["docDescription"].str.contains("有価証券報告書", na=False)
+            & df["pdfFlag"].astype(str).isin(["1", "True", "true"])
+        ]
+        df = df.sort_values("submitDateTime", ascending=False, kind="stable")
+        self.__doc_ids: List[str] = df["docID"].astype(str).tolist()
+        self.__filer_names: List[str] = df["filerName"].astype(str).tolist()
+        self.__doc_descriptions: List[str] = df["docDescription"].astype(str).tolist()
+
+        # 正規化した企業名 -> 書類の行番号（提出日時の新しい順）
+        rows_of_names: Dict[str, List[int]] = defaultdict(list)
+        for row, filer_name in enumerate(self.__filer_names):
+            rows_of_names[normalize_company_name(filer_name)].append(row)
+        self.__names: List[str] = list(rows_of_names.keys())
+        self.__rows_of_names: List[List[int]] = list(rows_of_names.values())
+
+        # n-gram -> 企業名の番号の集合
+        postings: Dict[str, set] = defaultdict(set)
+        for name_id, name in enumerate(self.__names):
+            for ngram in create_ngrams(name):
+                postings[ngram].add(name_id)
+        self.__postings: Dict[str, frozenset] = {ngram: frozenset(ids) for ngram, ids in postings.items()}
+
+    def __len__(self) -> int:
+        return len(self.__doc_ids)
+
+    def search(self, company_name: str, limit: int | None = None) -> List[dict]:
+        query = normalize_company_name(company_name)
+        if query == "":
+            return []
+
+        # クエリのn-gramを全て含む企業名に絞り込み、最後に部分文字列として含まれるかを確認する
+        ngrams = sorted({query[i : i + 2] for i in range(len(query) - 1)} or {query}, key=self.__count_of)
+        candidates = None
+        for ngram in ngrams:
+            ids = self.__postings.get(ngram)
+            if ids is None:
+                return []
+            candidates = set(ids) if candidates is None else candidates & ids
+            if len(candidates) == 0:
+                return []
+        # 行番号が小さいほど新しい書類のため、行番号順に並べれば提出日時の新しい順になる
+        # 件数を制限する場合は、企業名毎の（整列済みの）行番号をマージして先頭のみを取り出す
+        matched_rows = [self.__rows_of_names[name_id] for name_id in candidates if query in self.__names[name_id]]
+        if limit is not None:
+            rows = list(islice(heapq.merge(*matched_rows), limit))
+        else:
+            rows = sorted(chain.from_iterable(matched_rows))
+        return [
+            {
+                "doc_id": self.__doc_ids[row],
+                "filer_name": self.__filer_names[row],
+                "doc_description": self.__doc_descriptions[row],
+            }
+            for row in rows
+        ]
+
+    def __count_of(self, ngram: str) -> int:
+        # 出現数の少ないn-gramから絞り込むことで、集合演算の対象を小さくする
+        return len(self.__postings.get(ngram, ()))
+
+
+class CompanySearchIndexLoader:
+    """
+    日次ジョブが出力したParquetのスナップショットから検索用の索引を作成し、保持するクラス
+    reload_interval_seconds毎にスナップショットの更新（GCSのgeneration、ローカルの場合は更新日時）を確認し、
+    更新されていればバックグラウンドで索引を作り直して差し替える
+    """
+
+    def __init__(
+        self,
+        snapshot_uri: str,
+        project_id: str | None = None,
+        reload_interval_seconds: int = 5 * 60,
+        custom_logger: Logger = None,
+    ) -> None:
+        self.__snapshot_uri = snapshot_uri
+        self.__project_id = project_id
+        self.__reload_interval_seconds = reload_interval_seconds
+        self.__logger = custom_logger if custom_logger is not None else local_logger
+        self.__index: CompanySearchIndex | None = None
+        self.__version: str | None = None
+        self.__reload_lock = threading.Lock()
+
+        # 初回の読み込みも起動を待たせないようバックグラウンドで行い、読み込むまではNoneを返す
+        self.__stop_event = threading.Event()
+        self.__watcher = threading.Thread(target=self.__watch, name="company_search_index", daemon=True)
+        self.__watcher.start()
+
+    def search(self, company_name: str, limit: int | None = None) -> List[dict] | None:
+        index = self.__index
+        if index is None:
+            return None
+        return index.search(company_name=company_name, limit=limit)
+
+    def reload_if_updated(self) -> bool:
+        with self.__reload_lock:
+            version = self.__get_version()
+            if version == self.__version:
+                return False
+
+            df = pd.read_parquet(BytesIO(self.__read_snapshot()), columns=SEARCH_SNAPSHOT_COLUMNS)
+            index = CompanySearchIndex(df=df)
+            # 参照の差し替えのみで切り替えるため、検索中のリクエストは古い索引のまま処理を終えられる
+            self.__index = index
+            self.__version = version
+            self.__logger.info(
+                f"company search index is loaded from {self.__snapshot_uri}. version = {version}, rows = {len(index)}"
+            )
+            return True
+
+    def close(self):
+        self.__stop_event.set()
+
+    def __watch(self):
+        while not self.__stop_event.is_set():
+            try:
+                self.reload_if_updated()
+            except Exception as e:
+                # スナップショットがまだない場合などは、BigQueryでの検索を続ける
+                self.__logger.warning(f"loading company search index is failed. error detail is {e}")
+            self.__stop_event.wait(self.__reload_interval_seconds)
+
+    def __get_version(self) -> str:
+        if self.__is_gcs():
+            bucket_name, remote_file_path = split_bucket_name_and_file_path(gcs_uri=self.__snapshot_uri)
+            blob = get_file_metadata_from_gcs(
+                project_id=self.__project_id, bucket_name=bucket_name, remote_file_path=remote_file_path
+            )
+            return str(blob.generation)
+        return str(os.stat(self.__snapshot_uri).st_mtime_ns)
+
+    def __read_snapshot(self) -> bytes:
+        if self.__is_gcs():
+            bucket_name, remote_file_path = split_bucket_name_and_file_path(gcs_uri=self.__snapshot_uri)
+            return download_bytes_from_gcs(
+                project_id=self.__project_id, bucket_name=bucket_name, remote_file_path=remote_file_path
+            )
+        with open(self.__snapshot_uri, "rb") as f:
+            return f.read()
+
+    def __is_gcs(self) -> bool:
+        return self.__snapshot_uri.startswith("gs://")
@@ -0,0 +1,167 @@
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import timedelta
+from logging import Logger, StreamHandler, getLogger
+from typing import Any, Dict
+
+local_logger = getLogger(__name__)
+local_logger.addHandler(StreamHandler())
+local_logger.setLevel("DEBUG")
+
+
+class AbstractContextCacheClient(ABC):
+    """コンテキストキャッシュの作成・削除と、キャッシュを参照するモデルの生成を行うクライアント"""
+
+    @abstractmethod
+    def create(self, model_name: str, gcs_uri: str, ttl_seconds: int) -> str:
+        pass
+
+    @abstractmethod
+    def get_model(self, cache_name: str) -> Any:
+        pass
+
+    @abstractmethod
+    def delete(self, cache_name: str):
+        pass
+
+
+class VertexContextCacheClient(AbstractContextCacheClient):
+    """Vertex AIのContext Cachingを利用するクライアント. vertexaiはメソッドの呼び出し時にimportする"""
+
+    def create(self, model_name: str, gcs_uri: str, ttl_seconds: int) -> str:
+        from vertexai.generative_models import Part
+        from vertexai.preview import caching
+
+        cached_content = caching.CachedContent.create(
+            model_name=model_name,
+            contents=[Part.from_uri(uri=gcs_uri, mime_type="application/pdf")],
+            ttl=timedelta(seconds=ttl_seconds),
+        )
+        return cached_content.name
+
+    def get_model(self, cache_name: str) -> Any:
+        from vertexai.preview import caching
+        from vertexai.preview.generative_models import GenerativeModel
+
+        return GenerativeModel.from_cached_content(cached_content=caching.CachedContent(cached_content_name=cache_name))
+
+    def delete(self, cache_name: str):
+        from vertexai.preview import caching
+
+        caching.CachedContent(cached_content_name=cache_name).delete()
+
+
+class ContextCacheManager:
+    """
+    gcs uri単位でコンテキストキャッシュを管理するクラス
+    初回の利用時に作成し、有効期限内は再利用する. 上限を超えた場合は最も使われていないキャッシュから削除する
+    """
+
+    def __init__(
+        self,
+        client: AbstractContextCacheClient,
+        model_name: str,
+        ttl_seconds: int = 60 * 60,
+        max_entries: int = 16,
+        refresh_margin_seconds: int = 60,
+        custom_logger: Logger = None,
+    ) -> None:
+        self.__client = client
+        self.__model_name = model_name
+        self.__ttl_seconds = ttl_seconds
+        self.__max_entries = max_entries
+        self.__refresh_margin_seconds = refresh_margin_seconds
+        self.__logger = custom_logger if custom_logger is not None else local_logger
+
+        # gcs_uri -> (キャッシュ名, 有効期限). キャッシュを作成できなかった場合はキャッシュ名をNoneとし、期限まで再作成しない
+        self.__entries: OrderedDict[str, tuple[str | None, float]] = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__creating_locks: Dict[str, threading.Lock] = {}
+
+    def get_or_create(self, gcs_uri: str) -> str | None:
+        """
+        gcs_uriに対応するキャッシュ名を返す. 未作成・期限切れ間近の場合は作成する
+        キャッシュを作成できない場合（トークン数が最小値に満たない場合など）はNoneを返す
+        """
+        cache_name = self.__get_valid_entry(gcs_uri=gcs_uri)
+        if cache_name is not None:
+            return cache_name
+
+        # 同じgcs_uriのキャッシュが同時に作成されないよう、gcs_uri単位でロックを取る
+        with self.__lock:
+            creating_lock = self.__creating_locks.setdefault(gcs_uri, threading.Lock())
+        try:
+            with creating_lock:
+                with self.__lock:
+                    entry = self.__entries.get(gcs_uri)
+                    if entry is not None and time.monotonic() < entry[1] - self.__refresh_margin_seconds:
+                        self.__entries.move_to_end(gcs_uri)
+                        return entry[0]
+
+                try:
+                    cache_name = self.__client.create(
+                        model_name=self.__model_name, gcs_uri=gcs_uri, ttl_seconds=self.__ttl_seconds
+                    )
+                    self.__logger.info(f"context cache {cache_name} is created for {gcs_uri}.")
+                except Exception as e:
+                    self.__logger.warning(f"creating context cache for {gcs_uri} is failed. error detail is {e}")
+                    cache_name = None
+                self.__set_entry(gcs_uri=gcs_uri, cache_name=cache_name)
+        finally:
+            # 作成後は登録済みのエントリを参照できるため、gcs_uri単位のロックは残さない
+            with self.__lock:
+                if self.__creating_locks.get(gcs_uri) is creating_lock:
+                    del self.__creating_locks[gcs_uri]
+        return cache_name
+
+    def get_model(self, cache_name: str) -> Any:
+        return self.__client.get_model(cache_name=cache_name)
+
+    def evict(self, gcs_uri: str):
+        with self.__lock:
+            entry = self.__entries.pop(gcs_uri, None)
+        if entry is not None:
+            self.__delete_cache(cache_name=entry[0])
+
+    def close(self):
+        # 残っているキャッシュを全て削除し、保持期間分の課金が続かないようにする
+        with self.__lock:
+            entries = list(self.__entries.values())
+            self.__entries.clear()
+        for cache_name, _ in entries:
+            self.__delete_cache(cache_name=cache_name)
+
+    def __get_valid_entry(self, gcs_uri: str) -> str | None:
+        with self.__lock:
+            entry = self.__entries.get(gcs_uri)
+            if entry is None:
+                return None
+            cache_name, expired_at = entry
+            if time.monotonic() >= expired_at - self.__refresh_margin_seconds:
+                return None
+            self.__entries.move_to_end(gcs_uri)
+            return cache_name
+
+    def __set_entry(self, gcs_uri: str, cache_name: str | None):
+        # 期限切れ間近で作り直した古いキャッシュは、利用中のリクエストがありうるため削除せず期限切れを待つ
+        evicted_entries = []
+        with self.__lock:
+            self.__entries.pop(gcs_uri, None)
+            self.__entries[gcs_uri] = (cache_name, time.monotonic() + self.__ttl_seconds)
+            while len(self.__entries) > self.__max_entries:
+                _, entry = self.__entries.popitem(last=False)
+                evicted_entries.append(entry)
+        for evicted_cache_name, _ in evicted_entries:
+            self.__delete_cache(cache_name=evicted_cache_name)
+
+    def __delete_cache(self, cache_name: str | None):
+        if cache_name is None:
+            return
+        try:
+            self.__client.delete(cache_name=cache_name)
+            self.__logger.info(f"context cache {cache_name} is deleted.")
+        except Exception as e:
+            # 削除に失敗しても、有効期限が切れればVertex AI側で削除される
+            self.__logger.warning(f"deleting context cache {cache_name} is failed. error detail is {e}")
@@ -1,27 +1,61 @@
+import asyncio
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from io import BytesIO
+from functools import partial
 from logging import StreamHandler, getLogger
-from typing import List
+from typing import Any, AsyncIterator, Callable, Iterator, List, Tuple
 from uuid import uuid4
 
-from google.cloud import bigquery
 from pydantic import BaseModel
 
 from .agent import FinancialAgentConfig, FinancialReportAgent, MainAgent, MainAgentConfig
+from .analysis_cache import create_analysis_cache, create_analysis_cache_key
+from .batch_analysis import BatchAnalysisItem, BatchAnalyzer, write_batch_results
+from .company_search import CompanySearcher
+from .company_search_index import CompanySearchIndexLoader
+from .document_index import DocumentIndexStore
+from .document_store import FinancialDocumentStore
 from .edinet_wrapper import EdinetWrapper
+from .financial_metrics import (
+    FINANCIAL_METRICS_PROMPT,
+    FinancialMetricsRecord,
+    FinancialMetricsStore,
+    parse_financial_metrics,
+)
 from .gcp_util import (
-    download_file_from_gcs,
+    download_bytes_from_gcs,
+    generate_signed_url_of_gcs,
+    get_file_metadata_from_gcs,
     get_filename_from_gcs_uri,
+    iter_file_chunks_from_gcs,
     split_bucket_name_and_file_path,
     upload_file_into_gcs,
+    upload_stream_into_gcs,
 )
+from .job_queue import AnalysisJobQueue
+from .job_store import create_job_store
 from .todo_util import TodoHandler
 
 logger = getLogger(__name__)
 logger.addHandler(StreamHandler())
 logger.setLevel("DEBUG")
 
+# 決算書の分析時に、ユーザーからの質問がない場合に利用するプロンプト
+DEFAULT_ANALYSIS_PROMPT = """
+上記の決算資料から、後述する観点について分析を行い、下記の内容について回答してください。
+
+## 回答して欲しい内容
+
+・財務三表（損益計算書、貸借対照表、キャッシュフロー表）について、分析を行ってください。
+・今後3ヵ年で企業の収益性は良くなっていくでしょうか？その理由も述べてください。
+・直近1年で企業の株価は上昇していくでしょうか？その理由も述べてください。
+
+## 分析時の観点
+
+・貸借対照表、損益計算書、キャッシュフロー表が記載されている場合、各データについて、詳細な分析をすること
+        """
+
 
 class Response(BaseModel):
     request_id: str
@@ -30,7 +64,10 @@ class Response(BaseModel):
 
 
 class Controller:
-    def __init__(self, dialogue_session_id: str) -> None:
+    def __init__(self, dialogue_session_id: str, max_workers: int = 32) -> None:
+        # 非同期APIから同期的なクライアント（BigQuery、GCS、EDINETなど）を呼び出すためのスレッドプール
+        self.__executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="controller")
+
         # MainAgentの初期化
         agent_config = MainAgentConfig(dialogue_session_id=dialogue_session_id, memory_store_type="firestore")
         self.__agent = MainAgent(agent_config=agent_config)
@@ -43,9 +80,97 @@ class Controller:
         os.makedirs(self.__output_folder, exist_ok=True)
         self.__edinet_wrapper = EdinetWrapper(api_key=os.environ["EDINET_API_KEY"], output_folder=self.__output_folder)
 
+        # 企業名での検索結果は、日次ジョブでテーブルが更新されるまでプロセス内でキャッシュする
+        # SEARCH_INDEX_SNAPSHOT_URIが指定された場合は、日次ジョブが出力したスナップショットから索引を作成して検索する
+        search_index_snapshot_uri = os.getenv("SEARCH_INDEX_SNAPSHOT_URI")
+        self.__company_searcher = CompanySearcher(
+            table_id=os.getenv("EDINET_METADATA_TABLE_ID", "line_sakamomo_family_api.edinet_document_metadata"),
+            cache_max_size=int(os.getenv("SEARCH_CACHE_MAX_SIZE", 256)),
+            cache_ttl_seconds=int(os.getenv("SEARCH_CACHE_TTL_SECONDS", 24 * 60 * 60)),
+            freshness_check_seconds=int(os.getenv("SEARCH_CACHE_FRESHNESS_CHECK_SECONDS", 5 * 60)),
+            search_index=(
+                CompanySearchIndexLoader(
+                    snapshot_uri=search_index_snapshot_uri,
+                    project_id=os.environ["GCP_PROJECT"],
+                    reload_interval_seconds=int(os.getenv("SEARCH_INDEX_RELOAD_INTERVAL_SECONDS", 5 * 60)),
+                    custom_logger=logger,
+                )
+                if search_index_snapshot_uri
+                else None
+            ),
+            custom_logger=logger,
+        )
+
         # 決算書を分析するためのAgentを初期化
-        self.__financial_agent_config = FinancialAgentConfig(llm_model_name="gemini-1.5-flash-001")
-        self.__financial_agent = FinancialReportAgent(config=self.__financial_agent_config)
+        self.__financial_agent_config = FinancialAgentConfig(
+            llm_model_name="gemini-1.5-flash-001",
+            use_context_cache=os.getenv("USE_CONTEXT_CACHE", "1") == "1",
+            context_cache_ttl_seconds=int(os.getenv("CONTEXT_CACHE_TTL_SECONDS", 60 * 60)),
+            use_page_selection=os.getenv("USE_PAGE_SELECTION", "1") == "1",
+        )
+        # DOCUMENT_INDEX_BASE_URIが指定された場合は、アップロード時に抽出したテキストを解析に利用する
+        document_index_base_uri = os.getenv("DOCUMENT_INDEX_BASE_URI")
+        self.__document_index_store = (
+            DocumentIndexStore(
+                base_uri=document_index_base_uri, project_id=os.environ["GCP_PROJECT"], custom_logger=logger
+            )
+            if document_index_base_uri
+            else None
+        )
+        self.__financial_agent = FinancialReportAgent(
+            config=self.__financial_agent_config, document_index_store=self.__document_index_store
+        )
+
+        # 同じ決算書・プロンプト・モデル設定の解析結果を再利用するためのキャッシュ
+        self.__analysis_cache = create_analysis_cache(
+            cache_type=os.getenv("ANALYSIS_CACHE_TYPE", "firestore"),
+            config={
+                "max_size": int(os.getenv("ANALYSIS_CACHE_MAX_SIZE", 128)),
+                "ttl_seconds": int(os.getenv("ANALYSIS_CACHE_TTL_SECONDS", 7 * 24 * 60 * 60)),
+            },
+            custom_logger=logger,
+        )
+
+        # 決算書の解析はHTTPリクエストから切り離し、ジョブとしてワーカースレッドで実行する
+        job_store = create_job_store(
+            store_type=os.getenv("JOB_STORE_TYPE", "firestore"),
+            config={"db_path": os.getenv("JOB_STORE_DB_PATH", os.path.join(self.__output_folder, "jobs.sqlite3"))},
+        )
+        self.__analysis_job_queue = AnalysisJobQueue(
+            job_store=job_store,
+            handler=self.__run_analysis_job,
+            job_type="analysis",
+            max_workers=int(os.getenv("ANALYSIS_JOB_MAX_WORKERS", 4)),
+            custom_logger=logger,
+        )
+
+        # 複数の決算書をまとめて解析するジョブは、1ジョブ内で並列に解析するため同時実行数は小さくする
+        self.__batch_analysis_job_queue = AnalysisJobQueue(
+            job_store=job_store,
+            handler=self.__run_batch_analysis_job,
+            job_type="batch_analysis",
+            max_workers=int(os.getenv("BATCH_ANALYSIS_JOB_MAX_WORKERS", 1)),
+            custom_logger=logger,
+        )
+
+        # 決算書から抽出した指標は、企業間の比較をSQLで行えるようBigQueryに保存する
+        self.__financial_metrics_store = FinancialMetricsStore(
+            table_id=os.getenv("FINANCIAL_METRICS_TABLE_ID", "line_sakamomo_family_api.financial_metrics"),
+            custom_logger=logger,
+        )
+        self.__financial_metrics_job_queue = AnalysisJobQueue(
+            job_store=job_store,
+            handler=self.__run_financial_metrics_job,
+            job_type="financial_metrics",
+            max_workers=int(os.getenv("BATCH_ANALYSIS_JOB_MAX_WORKERS", 1)),
+            custom_logger=logger,
+        )
+
+        # アップロード済みの決算書をdoc_id単位で管理し、同じ決算書の重複アップロードを防ぐ
+        self.__document_store = FinancialDocumentStore(project_id=os.environ["GCP_PROJECT"], custom_logger=logger)
+
+    def close(self):
+        self.__financial_agent.close()
 
     # TODO : 内部で例外が発生した際は例外を返すようにした方がよさそう.
     # TODO : Responseを返すように修正
@@ -70,93 +195,580 @@ class Controller:
         request_id = uuid4()
         current_time = datetime.now()
 
-        # 会社名から、bigqueryを検索し、有価証券報告書のリストを取得する
-        client = bigquery.Client()
+        # 会社名から、索引またはbigqueryを検索し、有価証券報告書のリストを取得する（同じ会社名の検索結果はキャッシュを返す）
+        rows, source = self.__company_searcher.search(company_name=company_name)
         items: List[dict] = []
-        with open(os.path.join(os.path.dirname(__file__), "sql", "search_company.sql"), "r") as f:
-            query = f.read().format(company_name=company_name)
-            query_job = client.query(query)
-            rows = query_job.result()
-            for row in rows:
-                doc_id = row["docID"]
-                item = {
-                    "doc_id": doc_id,
-                    "filer_name": row["filerName"],
-                    "doc_description": row["docDescription"],
-                    "doc_url": f"{self.__edinet_wrapper.get_document_url(doc_id=doc_id)}",
-                }
-                items.append(item)
-
-        return Response(request_id=str(request_id), timestamp=current_time, detail={"items": items})
-
-    def upload_financial_report_into_gcs(self, doc_id: str) -> Response:
+        for row in rows:
+            doc_id = row["doc_id"]
+            item = {
+                "doc_id": doc_id,
+                "filer_name": row["filer_name"],
+                "doc_description": row["doc_description"],
+                "doc_url": f"{self.__edinet_wrapper.get_document_url(doc_id=doc_id)}",
+            }
+            items.append(item)
+
+        return Response(request_id=str(request_id), timestamp=current_time, detail={"items": items, "source": source})
+
+    def upload_financial_report_into_gcs(self, doc_id: str, use_local_file: bool = False) -> Response:
         request_id = uuid4()
         current_time = datetime.now()
 
-        # doc_idからpdfレポートを取得。取得できない場合は例外が発火される
-        file_path = self.__edinet_wrapper.download_pdf_of_financial_report(doc_id=doc_id)
+        # 既にアップロード済みのdoc_idであれば、EDINETからは取得せずに既存のファイルを返す
+        gcs_uri, reused = self.__document_store.get_or_upload(
+            doc_id=doc_id,
+            upload=lambda: self.__upload_financial_report(
+                doc_id=doc_id, request_id=str(request_id), current_time=current_time, use_local_file=use_local_file
+            ),
+        )
+        if reused:
+            logger.info(f"{doc_id} is already uploaded. gcs uri is {gcs_uri}")
 
-        # 取得したpdfを、gcsにアップロードする
-        file_name = os.path.basename(file_path)
-        current_time_str = current_time.strftime("%Y%m%d%H%M%S")
-        gcs_file_path = f"document/{current_time_str}/{request_id}/{file_name}"
-        gcs_uri = upload_file_into_gcs(
-            project_id=os.environ["GCP_PROJECT"],
-            bucket_name=self.__financial_agent_config.log_bucket_name,
-            remote_file_path=gcs_file_path,
-            local_file_path=file_path,
+        # テキストの抽出は解析の前に一度だけ行えば良いため、レスポンスを待たせずにバックグラウンドで実行する
+        if self.__document_index_store is not None:
+            self.__executor.submit(self.__build_document_index, doc_id=doc_id, gcs_uri=gcs_uri)
+
+        return Response(
+            request_id=str(request_id), timestamp=current_time, detail={"gcs_uri": gcs_uri, "reused": reused}
         )
 
-        return Response(request_id=str(request_id), timestamp=current_time, detail={"gcs_uri": gcs_uri})
+    def __build_document_index(self, doc_id: str, gcs_uri: str):
+        try:
+            if self.__document_index_store.exists(doc_id=doc_id):
+                return
+            bucket_name, remote_file_path = split_bucket_name_and_file_path(gcs_uri=gcs_uri)
+            pdf_data = download_bytes_from_gcs(
+                project_id=os.environ["GCP_PROJECT"], bucket_name=bucket_name, remote_file_path=remote_file_path
+            )
+            self.__document_index_store.build_and_save(doc_id=doc_id, pdf_data=pdf_data)
+        except Exception as e:
+            logger.error(f"building document index of {doc_id} is failed. error detail is {e}")
+
+    def __upload_financial_report(
+        self, doc_id: str, request_id: str, current_time: datetime, use_local_file: bool = False
+    ) -> str:
+        current_time_str = current_time.strftime("%Y%m%d%H%M%S")
+        gcs_file_path = f"document/{current_time_str}/{request_id}/{doc_id}.pdf"
+
+        if use_local_file:
+            # doc_idからpdfレポートを取得。取得できない場合は例外が発火される
+            file_path = self.__edinet_wrapper.download_pdf_of_financial_report(doc_id=doc_id)
 
-    def analyze_financial_document(self, gcs_uri: str, message: str | None = None) -> Response:
+            # 取得したpdfを、gcsにアップロードし、ローカルのファイルは削除する
+            try:
+                return upload_file_into_gcs(
+                    project_id=os.environ["GCP_PROJECT"],
+                    bucket_name=self.__financial_agent_config.log_bucket_name,
+                    remote_file_path=gcs_file_path,
+                    local_file_path=file_path,
+                )
+            finally:
+                os.remove(file_path)
+
+        # EDINETからのレスポンスを、ローカルに保存せずにそのままgcsへアップロードする
+        with self.__edinet_wrapper.open_pdf_stream_of_financial_report(doc_id=doc_id) as res:
+            res.raw.decode_content = True
+            content_length = res.headers.get("Content-Length")
+            return upload_stream_into_gcs(
+                project_id=os.environ["GCP_PROJECT"],
+                bucket_name=self.__financial_agent_config.log_bucket_name,
+                remote_file_path=gcs_file_path,
+                stream=res.raw,
+                content_type="application/pdf",
+                size=int(content_length) if content_length is not None else None,
+            )
+
+    def analyze_financial_document(self, gcs_uri: str, message: str | None = None, use_cache: bool = True) -> Response:
         request_id = str(uuid4())
         current_time = datetime.now()
 
+        # 同じ条件で解析済みであれば、LLMを呼び出さずにキャッシュした結果を返す
+        cache_key, cached_result, input_data = self.__prepare_analysis(
+            request_id=request_id, current_time=current_time, gcs_uri=gcs_uri, message=message, use_cache=use_cache
+        )
+        prompt = input_data["prompt"]
+        if cached_result is not None:
+            return Response(
+                request_id=request_id,
+                timestamp=current_time,
+                detail={"response_text": cached_result["response_text"], "prompt": prompt, "cache_hit": True},
+            )
+
         # pdfをLLMに送って、解析させる(CustomAgentか新規のAgentを用いる)
-        default_prompt = """
-上記の決算資料から、後述する観点について分析を行い、下記の内容について回答してください。
+        agent_response = self.__financial_agent.get_llm_agent_response(input_data=input_data)
+        self.__save_analysis_result(cache_key=cache_key, request_id=request_id, response_text=agent_response.text)
+        return Response(
+            request_id=request_id,
+            timestamp=current_time,
+            detail={"response_text": agent_response.text, "prompt": prompt, "cache_hit": False},
+        )
 
-## 回答して欲しい内容
+    def __prepare_analysis(
+        self, request_id: str, current_time: datetime, gcs_uri: str, message: str | None, use_cache: bool
+    ) -> Tuple[str, dict | None, dict]:
+        """
+        同期・非同期・ストリーミングの解析で共通の、キャッシュの参照とAgentへの入力の作成を行う
+        戻り値は、キャッシュのキー、キャッシュした解析結果（ない場合はNone）、Agentへの入力
+        """
+        prompt = message if message is not None else DEFAULT_ANALYSIS_PROMPT
+        cache_key, cached_result = self.__find_cached_analysis(gcs_uri=gcs_uri, prompt=prompt, use_cache=use_cache)
+        input_data = {
+            "request_id": request_id,
+            "gcs_uri": gcs_uri,
+            "prompt": prompt,
+            "timestamp": current_time,
+            # 質問形式の解析は同じ決算書に続けて質問されやすいため、コンテキストキャッシュを利用する
+            "use_context_cache": message is not None,
+            # 質問がない場合は財務三表の分析のため、該当するページのみを送る
+            "use_page_selection": message is None,
+        }
+        return cache_key, cached_result, input_data
 
-・財務三表（損益計算書、貸借対照表、キャッシュフロー表）について、分析を行ってください。
-・今後3ヵ年で企業の収益性は良くなっていくでしょうか？その理由も述べてください。
-・直近1年で企業の株価は上昇していくでしょうか？その理由も述べてください。
+    def __save_analysis_result(self, cache_key: str, request_id: str, response_text: str):
+        self.__analysis_cache.set(key=cache_key, value={"response_text": response_text, "request_id": request_id})
 
-## 分析時の観点
+    def __find_cached_analysis(self, gcs_uri: str, prompt: str, use_cache: bool) -> Tuple[str, dict | None]:
+        # 決算書の内容のハッシュ値はGCSのメタデータから取得し、pdf本体はダウンロードしない
+        bucket_name, remote_file_path = split_bucket_name_and_file_path(gcs_uri=gcs_uri)
+        blob = get_file_metadata_from_gcs(
+            project_id=os.environ["GCP_PROJECT"], bucket_name=bucket_name, remote_file_path=remote_file_path
+        )
+        cache_key = create_analysis_cache_key(
+            content_hash=blob.md5_hash or blob.crc32c,
+            prompt=prompt,
+            model_config=self.__financial_agent.get_model_config(),
+        )
 
-・貸借対照表、損益計算書、キャッシュフロー表が記載されている場合、各データについて、詳細な分析をすること
-        """
-        prompt = message if message is not None else default_prompt
-        input_data = {"request_id": request_id, "gcs_uri": gcs_uri, "prompt": prompt, "timestamp": current_time}
-        agent_response = self.__financial_agent.get_llm_agent_response(input_data=input_data)
+        # キャッシュを利用しない場合も、解析後の結果でキャッシュを更新できるようにキーは返す
+        if not use_cache:
+            return cache_key, None
+        cached_result = self.__analysis_cache.get(key=cache_key)
+        if cached_result is not None:
+            logger.info(f"analysis cache hit. gcs_uri = {gcs_uri}")
+        return cache_key, cached_result
+
+    def submit_analysis_job(self, gcs_uri: str, message: str | None = None, use_cache: bool = True) -> Response:
+        request_id = str(uuid4())
+        current_time = datetime.now()
+
+        job = self.__analysis_job_queue.submit(request={"gcs_uri": gcs_uri, "message": message, "use_cache": use_cache})
+        return Response(
+            request_id=request_id,
+            timestamp=current_time,
+            detail={"job_id": job.job_id, "status": job.status.value},
+        )
+
+    def get_analysis_job(self, job_id: str) -> Response:
+        return self.__get_job(job_queue=self.__analysis_job_queue, job_id=job_id)
+
+    def get_batch_analysis_job(self, job_id: str) -> Response:
+        return self.__get_job(job_queue=self.__batch_analysis_job_queue, job_id=job_id)
+
+    def get_financial_metrics_job(self, job_id: str) -> Response:
+        return self.__get_job(job_queue=self.__financial_metrics_job_queue, job_id=job_id)
+
+    def __get_job(self, job_queue: AnalysisJobQueue, job_id: str) -> Response:
+        request_id = str(uuid4())
+        current_time = datetime.now()
+
+        # ジョブが存在しない場合や、他のキューに投入されたジョブの場合はJobNotFoundErrorが発火される
+        job = job_queue.get(job_id=job_id)
+        return Response(
+            request_id=request_id,
+            timestamp=current_time,
+            detail={"job_id": job.job_id, "status": job.status.value, "result": job.result, "error": job.error},
+        )
+
+    def __run_analysis_job(self, request: dict) -> dict:
+        res = self.analyze_financial_document(
+            gcs_uri=request["gcs_uri"], message=request["message"], use_cache=request.get("use_cache", True)
+        )
+        return {"request_id": res.request_id, **res.detail}
+
+    def search_doc_ids(self, company_name: str, limit: int | None = None) -> List[str]:
+        # 検索結果は提出日時の新しい順に並んでいる
+        items = self.search_financial_documents_if_existed(company_name=company_name).detail["items"]
+        doc_ids = [item["doc_id"] for item in items]
+        return doc_ids[:limit] if limit is not None else doc_ids
+
+    def run_batch_analysis(
+        self, doc_ids: List[str], message: str | None = None, use_cache: bool = True, max_workers: int = 8
+    ) -> List[BatchAnalysisItem]:
+        analyzer = BatchAnalyzer(
+            upload=lambda doc_id: self.upload_financial_report_into_gcs(doc_id=doc_id).detail["gcs_uri"],
+            analyze=lambda gcs_uri, message: self.__run_analysis_job(
+                request={"gcs_uri": gcs_uri, "message": message, "use_cache": use_cache}
+            ),
+            max_workers=max_workers,
+            custom_logger=logger,
+        )
+        return analyzer.run(doc_ids=doc_ids, message=message)
+
+    def submit_batch_analysis_job(
+        self,
+        doc_ids: List[str],
+        company_name: str | None = None,
+        limit: int | None = None,
+        message: str | None = None,
+        use_cache: bool = True,
+    ) -> Response:
+        request_id = str(uuid4())
+        current_time = datetime.now()
+
+        job = self.__batch_analysis_job_queue.submit(
+            request={
+                "doc_ids": doc_ids,
+                "company_name": company_name,
+                "limit": limit,
+                "message": message,
+                "use_cache": use_cache,
+            }
+        )
+        return Response(
+            request_id=request_id,
+            timestamp=current_time,
+            detail={"job_id": job.job_id, "status": job.status.value},
+        )
+
+    def __run_batch_analysis_job(self, request: dict) -> dict:
+        request_id = str(uuid4())
+        current_time = datetime.now()
+
+        items = self.run_batch_analysis(
+            doc_ids=self.__resolve_doc_ids(request=request),
+            message=request["message"],
+            use_cache=request["use_cache"],
+            max_workers=int(os.getenv("BATCH_ANALYSIS_MAX_WORKERS", 8)),
+        )
+
+        # 解析結果の本文はサイズが大きくなるため、ジョブの結果にはファイルの場所と件数のみを残す
+        local_file_path = write_batch_results(
+            items=items, output_path=os.path.join(self.__output_folder, f"batch_{request_id}.jsonl")
+        )
+        try:
+            output_uri = upload_file_into_gcs(
+                project_id=os.environ["GCP_PROJECT"],
+                bucket_name=self.__financial_agent_config.log_bucket_name,
+                remote_file_path=f"batch/{current_time.strftime('%Y%m%d%H%M%S')}/{request_id}/results.jsonl",
+                local_file_path=local_file_path,
+            )
+        finally:
+            os.remove(local_file_path)
+
+        success_count = len([item for item in items if item.status == "succeeded"])
+        return {
+            "output_uri": output_uri,
+            "success_count": success_count,
+            "error_count": len(items) - success_count,
+            "items": [item.model_dump(include={"doc_id", "status", "gcs_uri", "error"}) for item in items],
+        }
+
+    def __resolve_doc_ids(self, request: dict) -> List[str]:
+        doc_ids = list(request["doc_ids"])
+        if request["company_name"] is not None:
+            doc_ids += self.search_doc_ids(company_name=request["company_name"], limit=request["limit"])
+        return doc_ids
+
+    def extract_financial_metrics(self, gcs_uri: str, use_cache: bool = True) -> Response:
+        request_id = str(uuid4())
+        current_time = datetime.now()
+
+        # 抽出結果も解析結果と同じキャッシュを利用する（プロンプトが異なるためキーは重複しない）
+        cache_key, cached_result = self.__find_cached_analysis(
+            gcs_uri=gcs_uri, prompt=FINANCIAL_METRICS_PROMPT, use_cache=use_cache
+        )
+        if cached_result is not None:
+            metrics = parse_financial_metrics(text=cached_result["response_text"])
+            return Response(
+                request_id=request_id,
+                timestamp=current_time,
+                detail={
+                    "response_text": cached_result["response_text"],
+                    "metrics": metrics.model_dump(),
+                    "cache_hit": True,
+                },
+            )
+
+        input_data = {
+            "request_id": request_id,
+            "gcs_uri": gcs_uri,
+            "prompt": FINANCIAL_METRICS_PROMPT,
+            "timestamp": current_time,
+        }
+        agent_response = self.__financial_agent.extract_financial_metrics(input_data=input_data)
+        self.__save_analysis_result(cache_key=cache_key, request_id=request_id, response_text=agent_response.text)
+        return Response(
+            request_id=request_id,
+            timestamp=current_time,
+            detail={
+                "response_text": agent_response.text,
+                "metrics": agent_response.metadata["metrics"],
+                "cache_hit": False,
+            },
+        )
+
+    def submit_financial_metrics_job(
+        self,
+        doc_ids: List[str],
+        company_name: str | None = None,
+        limit: int | None = None,
+        use_cache: bool = True,
+    ) -> Response:
+        request_id = str(uuid4())
+        current_time = datetime.now()
+
+        job = self.__financial_metrics_job_queue.submit(
+            request={"doc_ids": doc_ids, "company_name": company_name, "limit": limit, "use_cache": use_cache}
+        )
         return Response(
             request_id=request_id,
             timestamp=current_time,
-            detail={"response_text": agent_response.text, "prompt": prompt},
+            detail={"job_id": job.job_id, "status": job.status.value},
+        )
+
+    def __run_financial_metrics_job(self, request: dict) -> dict:
+        current_time = datetime.now()
+
+        # 指標の抽出は決算書毎に並列に行い、抽出できた指標はまとめて1回でBigQueryにロードする
+        analyzer = BatchAnalyzer(
+            upload=lambda doc_id: self.upload_financial_report_into_gcs(doc_id=doc_id).detail["gcs_uri"],
+            analyze=lambda gcs_uri, message: self.__run_financial_metrics_extraction(
+                gcs_uri=gcs_uri, use_cache=request["use_cache"]
+            ),
+            max_workers=int(os.getenv("BATCH_ANALYSIS_MAX_WORKERS", 8)),
+            custom_logger=logger,
         )
+        items = analyzer.run(doc_ids=self.__resolve_doc_ids(request=request))
+        records = [
+            FinancialMetricsRecord(
+                doc_id=item.doc_id,
+                gcs_uri=item.gcs_uri,
+                request_id=item.request_id,
+                model_name=self.__financial_agent_config.llm_model_name,
+                extracted_at=current_time,
+                **parse_financial_metrics(text=item.response_text).model_dump(),
+            )
+            for item in items
+            if item.status == "succeeded"
+        ]
+        loaded_count = self.__financial_metrics_store.save(records=records)
+
+        success_count = len(records)
+        return {
+            "table_id": self.__financial_metrics_store.get_table_id(),
+            "loaded_count": loaded_count,
+            "success_count": success_count,
+            "error_count": len(items) - success_count,
+            "items": [item.model_dump(include={"doc_id", "status", "gcs_uri", "error"}) for item in items],
+        }
+
+    def __run_financial_metrics_extraction(self, gcs_uri: str, use_cache: bool) -> dict:
+        res = self.extract_financial_metrics(gcs_uri=gcs_uri, use_cache=use_cache)
+        return {"request_id": res.request_id, **res.detail}
 
-    def downalod_financial_document(self, gcs_uri: str) -> Response:
+    def get_financial_document_metadata(self, gcs_uri: str) -> Response:
         request_id = str(uuid4())
         current_time = datetime.now()
 
-        # pdfをGCSからダウンロードする
+        # pdfのダウンロードは行わず、配信に必要なメタデータのみをGCSから取得する
+        bucket_name, remote_file_path = split_bucket_name_and_file_path(gcs_uri=gcs_uri)
+        blob = get_file_metadata_from_gcs(
+            project_id=os.environ["GCP_PROJECT"], bucket_name=bucket_name, remote_file_path=remote_file_path
+        )
+        return Response(
+            request_id=request_id,
+            timestamp=current_time,
+            detail={
+                "filename": get_filename_from_gcs_uri(gcs_uri=gcs_uri),
+                "size": blob.size,
+                "etag": blob.etag,
+                "generation": blob.generation,
+                "mime_type": blob.content_type or "application/pdf",
+            },
+        )
+
+    def iter_financial_document_chunks(
+        self, gcs_uri: str, start: int, end: int, generation: int | None = None
+    ) -> Iterator[bytes]:
         bucket_name, remote_file_path = split_bucket_name_and_file_path(gcs_uri=gcs_uri)
-        filename = get_filename_from_gcs_uri(gcs_uri=gcs_uri)
-        local_file_path = os.path.join(self.__output_folder, f"{request_id}_{filename}.pdf")
-        download_file_from_gcs(
+        return iter_file_chunks_from_gcs(
             project_id=os.environ["GCP_PROJECT"],
             bucket_name=bucket_name,
             remote_file_path=remote_file_path,
-            local_file_path=local_file_path,
+            start=start,
+            end=end,
+            generation=generation,
+        )
+
+    def create_financial_document_signed_url(self, gcs_uri: str) -> Response:
+        request_id = str(uuid4())
+        current_time = datetime.now()
+
+        bucket_name, remote_file_path = split_bucket_name_and_file_path(gcs_uri=gcs_uri)
+        signed_url = generate_signed_url_of_gcs(
+            project_id=os.environ["GCP_PROJECT"], bucket_name=bucket_name, remote_file_path=remote_file_path
+        )
+        return Response(request_id=request_id, timestamp=current_time, detail={"signed_url": signed_url})
+
+    # 以下は非同期API向けのメソッド. ネイティブの非同期クライアントがない処理はスレッドプール上で実行する
+    async def __run_in_executor(self, func: Callable[..., Any], **kwargs) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.__executor, partial(func, **kwargs))
+
+    async def ahandle_message(self, message: str) -> str:
+        if message.startswith("TODO"):
+            try:
+                res = await self.__run_in_executor(self.__todo_handler.handle, input_text=message)
+            except Exception as e:
+                logger.error(e)
+                res = "TODOの設定処理でエラーが発生しました."
+        else:
+            try:
+                res = (await self.__agent.aget_llm_agent_response(input_data=message)).text
+            except Exception as e:
+                logger.error(e)
+                res = "LLMのレスポンスでエラーが発生しました."
+        return res
+
+    async def asearch_financial_documents_if_existed(self, company_name: str) -> Response:
+        return await self.__run_in_executor(self.search_financial_documents_if_existed, company_name=company_name)
+
+    async def aupload_financial_report_into_gcs(self, doc_id: str, use_local_file: bool = False) -> Response:
+        return await self.__run_in_executor(
+            self.upload_financial_report_into_gcs, doc_id=doc_id, use_local_file=use_local_file
+        )
+
+    async def aanalyze_financial_document(
+        self, gcs_uri: str, message: str | None = None, use_cache: bool = True
+    ) -> Response:
+        request_id = str(uuid4())
+        current_time = datetime.now()
+
+        cache_key, cached_result, input_data = await self.__run_in_executor(
+            self.__prepare_analysis,
+            request_id=request_id,
+            current_time=current_time,
+            gcs_uri=gcs_uri,
+            message=message,
+            use_cache=use_cache,
+        )
+        prompt = input_data["prompt"]
+        if cached_result is not None:
+            return Response(
+                request_id=request_id,
+                timestamp=current_time,
+                detail={"response_text": cached_result["response_text"], "prompt": prompt, "cache_hit": True},
+            )
+
+        agent_response = await self.__financial_agent.aget_llm_agent_response(input_data=input_data)
+        await self.__run_in_executor(
+            self.__save_analysis_result, cache_key=cache_key, request_id=request_id, response_text=agent_response.text
+        )
+        return Response(
+            request_id=request_id,
+            timestamp=current_time,
+            detail={"response_text": agent_response.text, "prompt": prompt, "cache_hit": False},
         )
 
-        # バイナリデータとして、返す
-        # with open(local_file_path, "rb") as f:
-        #     byte_datas = BytesIO(f.read())
+    async def acreate_analysis_stream(
+        self, gcs_uri: str, message: str | None = None, use_cache: bool = True
+    ) -> Response:
+        """
+        決算書の解析結果を逐次返すためのストリームを作成する
+        detail["stream"]を読み進めるとLLMの生成結果がチャンク単位で得られ、読み終えた時点でログがアップロードされる
+        """
+        request_id = str(uuid4())
+        current_time = datetime.now()
 
+        cache_key, cached_result, input_data = await self.__run_in_executor(
+            self.__prepare_analysis,
+            request_id=request_id,
+            current_time=current_time,
+            gcs_uri=gcs_uri,
+            message=message,
+            use_cache=use_cache,
+        )
+        prompt = input_data["prompt"]
+        if cached_result is not None:
+            stream = self.__aiter_cached_text(text=cached_result["response_text"])
+        else:
+            stream = self.__aiter_and_cache_stream(
+                stream=self.__financial_agent.astream_llm_agent_response(input_data=input_data),
+                cache_key=cache_key,
+                request_id=request_id,
+            )
         return Response(
             request_id=request_id,
             timestamp=current_time,
-            detail={"document_path": local_file_path, "mime_type": "application/pdf"},
+            detail={"stream": stream, "prompt": prompt, "cache_hit": cached_result is not None},
+        )
+
+    async def __aiter_cached_text(self, text: str) -> AsyncIterator[str]:
+        yield text
+
+    async def __aiter_and_cache_stream(
+        self, stream: AsyncIterator[str], cache_key: str, request_id: str
+    ) -> AsyncIterator[str]:
+        # ストリームを最後まで読み終えた場合のみ、連結した結果をキャッシュする
+        texts = []
+        async for text in stream:
+            texts.append(text)
+            yield text
+        await self.__run_in_executor(
+            self.__save_analysis_result, cache_key=cache_key, request_id=request_id, response_text="".join(texts)
         )
+
+    async def asubmit_analysis_job(self, gcs_uri: str, message: str | None = None, use_cache: bool = True) -> Response:
+        return await self.__run_in_executor(
+            self.submit_analysis_job, gcs_uri=gcs_uri, message=message, use_cache=use_cache
+        )
+
+    async def asubmit_batch_analysis_job(
+        self,
+        doc_ids: List[str],
+        company_name: str | None = None,
+        limit: int | None = None,
+        message: str | None = None,
+        use_cache: bool = True,
+    ) -> Response:
+        return await self.__run_in_executor(
+            self.submit_batch_analysis_job,
+            doc_ids=doc_ids,
+            company_name=company_name,
+            limit=limit,
+            message=message,
+            use_cache=use_cache,
+        )
+
+    async def aextract_financial_metrics(self, gcs_uri: str, use_cache: bool = True) -> Response:
+        return await self.__run_in_executor(self.extract_financial_metrics, gcs_uri=gcs_uri, use_cache=use_cache)
+
+    async def asubmit_financial_metrics_job(
+        self,
+        doc_ids: List[str],
+        company_name: str | None = None,
+        limit: int | None = None,
+        use_cache: bool = True,
+    ) -> Response:
+        return await self.__run_in_executor(
+            self.submit_financial_metrics_job,
+            doc_ids=doc_ids,
+            company_name=company_name,
+            limit=limit,
+            use_cache=use_cache,
+        )
+
+    async def aget_analysis_job(self, job_id: str) -> Response:
+        return await self.__run_in_executor(self.get_analysis_job, job_id=job_id)
+
+    async def aget_batch_analysis_job(self, job_id: str) -> Response:
+        return await self.__run_in_executor(self.get_batch_analysis_job, job_id=job_id)
+
+    async def aget_financial_metrics_job(self, job_id: str) -> Response:
+        return await self.__run_in_executor(self.get_financial_metrics_job, job_id=job_id)
+
+    async def aget_financial_document_metadata(self, gcs_uri: str) -> Response:
+        return await self.__run_in_executor(self.get_financial_document_metadata, gcs_uri=gcs_uri)
+
+    async def acreate_financial_document_signed_url(self, gcs_uri: str) -> Response:
+        return await self.__run_in_executor(self.create_financial_document_signed_url, gcs_uri=gcs_uri)
@@ -0,0 +1,134 @@
+import os
+from io import BytesIO
+from logging import Logger, StreamHandler, getLogger
+
+import pandas as pd
+
+from .gcp_util import (
+    download_bytes_from_gcs,
+    exists_file_in_gcs,
+    split_bucket_name_and_file_path,
+    upload_stream_into_gcs,
+)
+from .pdf_preprocessor import FinancialStatementPdfPreprocessor
+
+local_logger = getLogger(__name__)
+local_logger.addHandler(StreamHandler())
+local_logger.setLevel("DEBUG")
+
+# ページ単位で抽出したテキストを保持する列. sectionは財務三表などの見出しに該当するページのみ値を持つ
+DOCUMENT_INDEX_COLUMNS = ["doc_id", "page", "section", "is_statement_page", "text"]
+
+
+def build_document_index(
+    doc_id: str, pdf_data: bytes, preprocessor: FinancialStatementPdfPreprocessor | None = None
+) -> pd.DataFrame:
+    """
+    有価証券報告書のpdfから、ページ単位のテキストと財務三表のページを抽出したDataFrameを作成する
+    財務三表のページは、見出しの後続ページも同じsectionとして扱う
+    """
+    preprocessor = preprocessor if preprocessor is not None else FinancialStatementPdfPreprocessor()
+    page_texts = preprocessor.extract_page_texts(pdf_data=pdf_data)
+    statement_pages = set(preprocessor.select_pages(page_texts=page_texts))
+
+    records = []
+    current_section = None
+    for i, text in enumerate(page_texts):
+        section = preprocessor.find_section(text=text)
+        if section is not None:
+            current_section = section
+        elif i not in statement_pages:
+            current_section = None
+        records.append(
+            {
+                "doc_id": doc_id,
+                "page": i + 1,
+                "section": current_section if i in statement_pages else None,
+                "is_statement_page": i in statement_pages,
+                "text": text,
+            }
+        )
+    df = pd.DataFrame(records, columns=DOCUMENT_INDEX_COLUMNS)
+    return df.astype({"doc_id": "string", "page": "int32", "section": "string", "is_statement_page": "bool"})
+
+
+def format_document_index(df: pd.DataFrame, statement_pages_only: bool = False) -> str:
+    # LLMに渡せるよう、ページ番号と見出しを付けたテキストに変換する
+    if statement_pages_only:
+        df = df[df["is_statement_page"]]
+    texts = []
+    for _, row in df.sort_values("page").iterrows():
+        section = f" {row['section']}" if not pd.isna(row["section"]) else ""
+        texts.append(f"--- p.{row['page']}{section} ---\n{row['text']}")
+    return "\n\n".join(texts)
+
+
+class DocumentIndexStore:
+    """
+    doc_id単位で抽出済みのテキストをParquet形式で保存するクラス
+    base_uriにgs://から始まるパスを指定した場合はGCSに、それ以外はローカルのフォルダに保存する
+    """
+
+    def __init__(self, base_uri: str, project_id: str | None = None, custom_logger: Logger = None) -> None:
+        self.__base_uri = base_uri.rstrip("/")
+        self.__project_id = project_id
+        self.__logger = custom_logger if custom_logger is not None else local_logger
+        if not self.__is_gcs():
+            os.makedirs(self.__base_uri, exist_ok=True)
+
+    def get_uri(self, doc_id: str) -> str:
+        return f"{self.__base_uri}/{doc_id}.parquet"
+
+    def exists(self, doc_id: str) -> bool:
+        uri = self.get_uri(doc_id=doc_id)
+        if self.__is_gcs():
+            return exists_file_in_gcs(project_id=self.__project_id, gcs_uri=uri)
+        return os.path.exists(uri)
+
+    def save(self, doc_id: str, df: pd.DataFrame) -> str:
+        uri = self.get_uri(doc_id=doc_id)
+        if self.__is_gcs():
+            bucket_name, remote_file_path = split_bucket_name_and_file_path(gcs_uri=uri)
+            data = BytesIO()
+            df.to_parquet(data, index=False, compression="zstd")
+            data.seek(0)
+            # 既に同じdoc_idのファイルがある場合は、アップロードに失敗するため上書きはされない
+            return upload_stream_into_gcs(
+                project_id=self.__project_id,
+                bucket_name=bucket_name,
+                remote_file_path=remote_file_path,
+                stream=data,
+                content_type="application/vnd.apache.parquet",
+                size=data.getbuffer().nbytes,
+            )
+
+        # 書き込み途中のファイルを読み込まないよう、一時ファイルに書いてから置き換える
+        tmp_uri = f"{uri}.tmp"
+        df.to_parquet(tmp_uri, index=False, compression="zstd")
+        os.replace(tmp_uri, uri)
+        return uri
+
+    def load(self, doc_id: str) -> pd.DataFrame | None:
+        uri = self.get_uri(doc_id=doc_id)
+        try:
+            if self.__is_gcs():
+                bucket_name, remote_file_path = split_bucket_name_and_file_path(gcs_uri=uri)
+                data = download_bytes_from_gcs(
+                    project_id=self.__project_id, bucket_name=bucket_name, remote_file_path=remote_file_path
+                )
+                return pd.read_parquet(BytesIO(data))
+            if not os.path.exists(uri):
+                return None
+            return pd.read_parquet(uri)
+        except Exception as e:
+            self.__logger.info(f"document index of {doc_id} is not loaded. error detail is {e}")
+            return None
+
+    def build_and_save(self, doc_id: str, pdf_data: bytes) -> str:
+        df = build_document_index(doc_id=doc_id, pdf_data=pdf_data)
+        uri = self.save(doc_id=doc_id, df=df)
+        self.__logger.info(f"document index of {doc_id} is saved into {uri}. pages = {len(df)}")
+        return uri
+
+    def __is_gcs(self) -> bool:
+        return self.__base_uri.startswith("gs://")
@@ -0,0 +1,83 @@
+import threading
+from concurrent.futures import Future
+from logging import Logger, StreamHandler, getLogger
+from typing import Callable, Dict, Tuple
+
+from .firebase_util import get_db_client_with_default_credentials, get_financial_document, register_financial_document
+from .gcp_util import exists_file_in_gcs
+
+local_logger = getLogger(__name__)
+local_logger.addHandler(StreamHandler())
+local_logger.setLevel("DEBUG")
+
+
+class FinancialDocumentStore:
+    """
+    GCSにアップロードした有価証券報告書をdoc_id単位で管理するクラス
+    アップロード済みのdoc_idは既存のgcs uriを返し、同じdoc_idの同時アップロードは1回のアップロードにまとめる
+    """
+
+    def __init__(
+        self, project_id: str, collection_id: str = "FinancialDocuments", custom_logger: Logger = None
+    ) -> None:
+        self.__project_id = project_id
+        self.__collection_id = collection_id
+        self.__logger = custom_logger if custom_logger is not None else local_logger
+        self.__db = get_db_client_with_default_credentials()
+        self.__lock = threading.Lock()
+        self.__uploading_futures: Dict[str, Future] = {}
+
+    def find_gcs_uri(self, doc_id: str) -> str | None:
+        document = get_financial_document(db=self.__db, collection_id=self.__collection_id, doc_id=doc_id)
+        if document is None:
+            return None
+
+        # GCS上のファイルが削除されている場合は、未アップロードとして扱う
+        gcs_uri = document["gcs_uri"]
+        if not exists_file_in_gcs(project_id=self.__project_id, gcs_uri=gcs_uri):
+            self.__logger.warning(f"{gcs_uri} is registered but not found in gcs.")
+            return None
+        return gcs_uri
+
+    def get_or_upload(self, doc_id: str, upload: Callable[[], str]) -> Tuple[str, bool]:
+        """
+        doc_idに対応するgcs uriを返す. 未アップロードの場合はuploadを呼び出してアップロードする
+
+        Args:
+            doc_id (str): EDINETのドキュメントID
+            upload (Callable[[], str]): アップロードを行い、gcs uriを返す関数
+
+        Returns:
+            Tuple[str, bool]: gcs uriと、既存のファイルを再利用したかどうか
+        """
+        gcs_uri = self.find_gcs_uri(doc_id=doc_id)
+        if gcs_uri is not None:
+            return gcs_uri, True
+
+        # 同じdoc_idのアップロードが実行中であれば、その結果を待つ
+        with self.__lock:
+            future = self.__uploading_futures.get(doc_id)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self.__uploading_futures[doc_id] = future
+        if not is_owner:
+            return future.result(), True
+
+        try:
+            # 待機中に他のリクエストがアップロードを完了している可能性があるため、再度確認する
+            gcs_uri = self.find_gcs_uri(doc_id=doc_id)
+            reused = gcs_uri is not None
+            if not reused:
+                gcs_uri = upload()
+                register_financial_document(
+                    db=self.__db, collection_id=self.__collection_id, doc_id=doc_id, gcs_uri=gcs_uri
+                )
+            future.set_result(gcs_uri)
+            return gcs_uri, reused
+        except Exception as e:
+            future.set_exception(e)
+            raise e
+        finally:
+            with self.__lock:
+                del self.__uploading_futures[doc_id]
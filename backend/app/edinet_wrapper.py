@@ -4,14 +4,53 @@ EDINETから有価証券報告書を取得するためのラッパークラス
 https://disclosure2dl.edinet-fsa.go.jp/guide/static/disclosure/WZEK0110.html
 """
 
+import gzip
+import hashlib
+import json
 import os
 import sys
+import threading
+import time
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from typing import List, Tuple
 
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+
+EDINET_DOCUMENT_LIST_URL = "https://disclosure.edinet-fsa.go.jp/api/v2/documents.json"
+EDINET_DOCUMENT_BASE_URL = "https://api.edinet-fsa.go.jp/api/v2/documents"
+
+# EDINETは明確なレート上限を公開していないため、過剰なアクセスとならないよう控えめな値をデフォルトとする
+DEFAULT_REQUESTS_PER_SECOND = 5.0
+
+# pdfをダウンロードする際に、一度に読み込むバイト数
+DEFAULT_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# 一時的なエラーとみなして再試行するHTTPステータスコード
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+# EDINETへのリクエストのタイムアウト（接続, 読み込み）秒数
+DEFAULT_TIMEOUT = (10.0, 60.0)
+
+
+def get_retry_wait_seconds(attempt: int, backoff_factor: float, retry_after: str | None = None) -> float:
+    # 指数バックオフの待機時間と、Retry-After（秒数またはHTTP日付）の長い方を返す
+    wait_seconds = backoff_factor * (2**attempt)
+    if retry_after is None:
+        return wait_seconds
+    try:
+        retry_after_seconds = float(retry_after)
+    except ValueError:
+        try:
+            retry_after_seconds = (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            retry_after_seconds = 0.0
+    return max(wait_seconds, retry_after_seconds)
 
 
 class DownloadResult:
@@ -19,10 +58,14 @@ class DownloadResult:
         self.target_date = target_date
         self.__success_document_ids = []
         self.__error_document_ids = []
+        self.__skipped_document_ids = []
 
     def get_success_counts(self) -> int:
         return len(self.__success_document_ids)
 
+    def get_skipped_counts(self) -> int:
+        return len(self.__skipped_document_ids)
+
     def get_error_counts(self) -> int:
         return len(self.__error_document_ids)
 
@@ -32,12 +75,18 @@ class DownloadResult:
     def append_error_doc_id(self, doc_id: str):
         self.__error_document_ids.append(doc_id)
 
+    def append_skipped_doc_id(self, doc_id: str):
+        self.__skipped_document_ids.append(doc_id)
+
     def get_success_doc_ids(self) -> list:
         return deepcopy(self.__success_document_ids)
 
     def get_error_doc_ids(self) -> list:
         return deepcopy(self.__error_document_ids)
 
+    def get_skipped_doc_ids(self) -> list:
+        return deepcopy(self.__skipped_document_ids)
+
 
 class GetDocumentListResult:
     def __init__(self, current_date: datetime) -> None:
@@ -45,6 +94,8 @@ class GetDocumentListResult:
         self.current_date = current_date
         self.__success_dates = []
         self.__error_dates = []
+        self.__cache_hit_count = 0
+        self.__cache_miss_count = 0
 
     def get_success_counts(self) -> int:
         return len(self.__success_dates)
@@ -64,28 +115,172 @@ class GetDocumentListResult:
     def get_error_dates(self) -> list:
         return deepcopy(self.__error_dates)
 
+    def get_cache_hit_counts(self) -> int:
+        return self.__cache_hit_count
+
+    def get_cache_miss_counts(self) -> int:
+        return self.__cache_miss_count
+
+    def count_cache_result(self, cache_hit: bool):
+        if cache_hit:
+            self.__cache_hit_count += 1
+        else:
+            self.__cache_miss_count += 1
+
+
+class RateLimiter:
+    """複数スレッドから呼ばれても、指定した秒間リクエスト数を超えないように待機させるクラス"""
+
+    def __init__(self, requests_per_second: float) -> None:
+        self.__interval = 1.0 / requests_per_second if requests_per_second > 0 else 0.0
+        self.__next_time = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def wait(self):
+        if self.__interval == 0.0:
+            return
+
+        # 次にリクエストを送信できる時刻を予約し、その時刻まで待機する
+        with self.__lock:
+            now = time.monotonic()
+            wait_seconds = self.__next_time - now
+            self.__next_time = max(now, self.__next_time) + self.__interval
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+
+
+class DocumentListCache:
+    """
+    EDINETのdocuments.jsonの取得結果を、日付単位でローカルに保存するキャッシュ
+    ファイル名はリクエストパラメーターのハッシュ値とし、gzip圧縮したjsonとして保存する
+    取得時点で対象日付からimmutable_after_days日以上経過していたキャッシュは不変とみなし、
+    それ以外のキャッシュはttl_seconds秒経過した時点で無効とする
+    """
+
+    def __init__(self, cache_folder: str, immutable_after_days: int = 30, ttl_seconds: int = 3600) -> None:
+        self.__cache_folder = cache_folder
+        self.__immutable_after_days = immutable_after_days
+        self.__ttl_seconds = ttl_seconds
+        os.makedirs(self.__cache_folder, exist_ok=True)
+
+    def get_cache_path(self, target_date: datetime, doc_type: int) -> str:
+        # APIキーなどの認証情報はキーに含めない
+        key = json.dumps({"date": target_date.strftime("%Y-%m-%d"), "type": doc_type}, sort_keys=True)
+        file_name = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.__cache_folder, f"{file_name}.json.gz")
+
+    def get(self, target_date: datetime, doc_type: int) -> list | None:
+        cache_path = self.get_cache_path(target_date=target_date, doc_type=doc_type)
+        if not os.path.exists(cache_path):
+            return None
+
+        try:
+            with gzip.open(cache_path, "rt", encoding="utf-8") as f:
+                cache_data = json.load(f)
+        except Exception as e:
+            print(f"failed to read cache file. error detail is {e}.")
+            return None
+
+        fetched_at = datetime.fromisoformat(cache_data["fetched_at"])
+        if not self.is_valid(target_date=target_date, fetched_at=fetched_at):
+            return None
+        return cache_data["results"]
+
+    def set(self, target_date: datetime, doc_type: int, results: list):
+        cache_path = self.get_cache_path(target_date=target_date, doc_type=doc_type)
+        cache_data = {
+            "date": target_date.strftime("%Y-%m-%d"),
+            "type": doc_type,
+            "fetched_at": datetime.now().isoformat(),
+            "results": results,
+        }
+
+        # 並列実行時に読み込み途中のファイルが見えないよう、一時ファイルに書き込んでから置き換える
+        tmp_path = f"{cache_path}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            json.dump(cache_data, f, ensure_ascii=False)
+        os.replace(tmp_path, cache_path)
+
+    def is_valid(self, target_date: datetime, fetched_at: datetime) -> bool:
+        # 取得時点で十分に過去の日付だった場合は、以降内容が変わらないものとみなす
+        if (fetched_at.date() - target_date.date()).days >= self.__immutable_after_days:
+            return True
+        return (datetime.now() - fetched_at).total_seconds() < self.__ttl_seconds
+
 
 class EdinetWrapper:
-    def __init__(self, api_key: str, output_folder: str = None) -> None:
+    def __init__(
+        self,
+        api_key: str,
+        output_folder: str = None,
+        max_workers: int = 1,
+        requests_per_second: float = DEFAULT_REQUESTS_PER_SECOND,
+        document_list_url: str = EDINET_DOCUMENT_LIST_URL,
+        document_base_url: str = EDINET_DOCUMENT_BASE_URL,
+        use_cache: bool = True,
+        cache_immutable_after_days: int = 30,
+        cache_ttl_seconds: int = 3600,
+        download_chunk_size: int = DEFAULT_DOWNLOAD_CHUNK_SIZE,
+        pool_size: int = 10,
+        timeout: Tuple[float, float] = DEFAULT_TIMEOUT,
+        retry_count: int = 3,
+        backoff_factor: float = 1.0,
+    ) -> None:
         self.__api_key = api_key
+        self.__max_workers = max_workers
+        self.__rate_limiter = RateLimiter(requests_per_second=requests_per_second)
+        self.__document_list_url = document_list_url
+        self.__document_base_url = document_base_url
+        self.__download_chunk_size = download_chunk_size
+        self.__timeout = timeout
+        self.__retry_count = retry_count
+        self.__backoff_factor = backoff_factor
+
+        # EDINETへのリクエストはインスタンスで共有するセッションから行い、TCP/TLSの接続を再利用する
+        # 並列実行時にも接続を使い回せるよう、プールサイズは同時実行数以上とする
+        self.__session = self.__create_session(pool_size=max(pool_size, max_workers))
         self.__output_folder = (
             os.path.join(os.path.dirname(__file__), "output", datetime.now().strftime("%Y%m%d%H%M%S"))
             if output_folder is None
             else output_folder
         )
         os.makedirs(self.__output_folder, exist_ok=True)
+        self.__cache = (
+            DocumentListCache(
+                cache_folder=os.path.join(self.__output_folder, "cache", "documents"),
+                immutable_after_days=cache_immutable_after_days,
+                ttl_seconds=cache_ttl_seconds,
+            )
+            if use_cache
+            else None
+        )
 
     def get_document_url(self, doc_id: str) -> str:
-        return f"https://api.edinet-fsa.go.jp/api/v2/documents/{doc_id}"
+        return f"{self.__document_base_url}/{doc_id}"
 
     def get_documents_info_dataframe(self, target_date: datetime) -> pd.DataFrame:
-        url = "https://disclosure.edinet-fsa.go.jp/api/v2/documents.json"
+        df, _ = self.__get_documents_info_dataframe_with_cache_status(target_date=target_date)
+        return df
+
+    def __get_documents_info_dataframe_with_cache_status(self, target_date: datetime) -> Tuple[pd.DataFrame, bool]:
+        documents, cache_hit = self.__get_documents(target_date=target_date, doc_type=2)
+        df = pd.DataFrame(documents)
+        return df, cache_hit
+
+    def __get_documents(self, target_date: datetime, doc_type: int) -> Tuple[list, bool]:
+        # キャッシュが有効であれば、EDINETへのリクエストを行わずにキャッシュの内容を返す
+        if self.__cache is not None:
+            documents = self.__cache.get(target_date=target_date, doc_type=doc_type)
+            if documents is not None:
+                return documents, True
+
+        url = self.__document_list_url
         params = {
             "date": target_date.strftime("%Y-%m-%d"),
-            "type": 2,  # 2は有価証券報告書などの決算書類
+            "type": doc_type,  # 2は有価証券報告書などの決算書類
             "Subscription-Key": self.__api_key,
         }
-        response = requests.get(url, params=params)
+        response = self.__get(url, params=params)
         if response.status_code != 200:
             raise Exception(f"failed to get document list! http status code is {response.status_code}")
 
@@ -95,70 +290,205 @@ class EdinetWrapper:
             raise Exception(f"failed to get document list! status code is {status_code}")
 
         documents = json_data["results"]
-        df = pd.DataFrame(documents)
-        return df
+        if self.__cache is not None:
+            self.__cache.set(target_date=target_date, doc_type=doc_type, results=documents)
+        return documents, False
 
     def download_pdf_of_financial_report(self, doc_id: str) -> str:
         url = self.get_document_url(doc_id=doc_id)
         params = {"type": 2, "Subscription-Key": self.__api_key}  # PDFを取得する場合は2を指定
+        output_path = os.path.join(self.__output_folder, f"{doc_id}.pdf")
+        tmp_output_path = f"{output_path}.part"
 
         try:
-            res = requests.get(url, params=params, verify=False)
-            output_path = os.path.join(self.__output_folder, f"{doc_id}.pdf")
-            if res.status_code != 200:
-                raise Exception(f"fail to download {doc_id} document. status code is {res.status_code}")
-
-            with open(output_path, "wb") as file_out:
-                file_out.write(res.content)
-                return output_path
+            # 前回途中までダウンロードしたファイルがあれば、Rangeヘッダーを指定して続きから取得する
+            # Content-Lengthで検証できるよう、圧縮転送は行わない
+            downloaded_size = os.path.getsize(tmp_output_path) if os.path.exists(tmp_output_path) else 0
+            headers = {"Accept-Encoding": "identity"}
+            if downloaded_size > 0:
+                headers["Range"] = f"bytes={downloaded_size}-"
+
+            with self.__get(url, params=params, headers=headers, stream=True, verify=False) as res:
+                if res.status_code == 206:
+                    mode = "ab"
+                elif res.status_code == 200:
+                    # Rangeヘッダーが無視された場合は最初からダウンロードし直す
+                    mode = "wb"
+                    downloaded_size = 0
+                else:
+                    if res.status_code == 416:
+                        os.remove(tmp_output_path)
+                    raise Exception(f"fail to download {doc_id} document. status code is {res.status_code}")
+
+                # エラー時はjsonが返却されるため、pdfとして保存しない
+                if "application/json" in res.headers.get("Content-Type", ""):
+                    raise Exception(f"fail to download {doc_id} document. response is {res.text}")
+
+                # メモリ上にpdf全体を保持しないよう、チャンク単位で一時ファイルに書き込む
+                content_length = res.headers.get("Content-Length")
+                expected_size = downloaded_size + int(content_length) if content_length is not None else None
+                with open(tmp_output_path, mode) as file_out:
+                    for chunk in res.iter_content(chunk_size=self.__download_chunk_size):
+                        file_out.write(chunk)
+
+            actual_size = os.path.getsize(tmp_output_path)
+            if expected_size is not None and actual_size != expected_size:
+                raise Exception(
+                    f"fail to download {doc_id} document. expected size is {expected_size}, actual size is {actual_size}"
+                )
+
+            # 全て書き込めた場合のみ、一時ファイルを出力先にリネームする
+            os.replace(tmp_output_path, output_path)
+            return output_path
         except urllib.error.HTTPError as e:
             if e.code >= 400:
                 sys.stderr.write(e.reason + "\n")
             else:
                 raise e
 
-    def download_pdfs_of_financial_report_target_date(self, target_date: datetime) -> DownloadResult:
+    def open_pdf_stream_of_financial_report(self, doc_id: str) -> requests.Response:
+        """
+        有価証券報告書のpdfを、本文を読み込まずにストリームとして開く
+        返却したレスポンスは呼び出し側でcloseすること（with文での利用を想定）
+        """
+        url = self.get_document_url(doc_id=doc_id)
+        params = {"type": 2, "Subscription-Key": self.__api_key}  # PDFを取得する場合は2を指定
+
+        # 転送中のバイト数をContent-Lengthで検証できるよう、圧縮転送は行わない
+        res = self.__get(url, params=params, headers={"Accept-Encoding": "identity"}, stream=True, verify=False)
+        if res.status_code != 200:
+            res.close()
+            raise Exception(f"fail to download {doc_id} document. status code is {res.status_code}")
+
+        # エラー時はjsonが返却されるため、pdfとして扱わない
+        if "application/json" in res.headers.get("Content-Type", ""):
+            message = res.text
+            res.close()
+            raise Exception(f"fail to download {doc_id} document. response is {message}")
+        return res
+
+    def download_pdfs_of_financial_report_target_date(
+        self,
+        target_date: datetime,
+        max_workers: int | None = None,
+        skip_existing: bool = True,
+    ) -> DownloadResult:
         # EDINETから指定した日付の有価証券報告書のリストを取得する
         df = self.get_documents_info_dataframe(target_date=target_date)
+        doc_ids = df["docID"].tolist() if len(df) > 0 else []
 
-        # 有価証券報告書を指定したフォルダにダウンロードする
+        # 有価証券報告書を指定したフォルダに並列でダウンロードする
+        workers = max(1, self.__max_workers if max_workers is None else max_workers)
         res = DownloadResult(target_date=target_date)
-        for _, doc in df.iterrows():
-            print(
-                doc["edinetCode"],
-                doc["docID"],
-                doc["filerName"],
-                doc["docDescription"],
-                doc["submitDateTime"],
-                sep="\t",
-            )
-            doc_id = doc["docID"]
-
-            try:
-                self.download_pdf_of_financial_report(doc_id=doc_id)
-                res.append_success_doc_id(doc_id=doc_id)
-            except Exception as e:
-                print(e)
-                res.append_error_doc_id(doc_id=doc_id)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            skipped_doc_ids = set()
+            for doc_id in doc_ids:
+                # 既にダウンロード済みのファイルは再取得しない
+                if skip_existing and os.path.exists(os.path.join(self.__output_folder, f"{doc_id}.pdf")):
+                    skipped_doc_ids.add(doc_id)
+                    continue
+                futures[doc_id] = executor.submit(self.download_pdf_of_financial_report, doc_id=doc_id)
+
+            # スキップしたものも含め、結果はドキュメント一覧の順に記録する
+            for _, doc in df.iterrows():
+                doc_id = doc["docID"]
+                if doc_id in skipped_doc_ids:
+                    res.append_success_doc_id(doc_id=doc_id)
+                    res.append_skipped_doc_id(doc_id=doc_id)
+                    continue
+                if doc_id not in futures:
+                    continue
+                try:
+                    futures[doc_id].result()
+                    res.append_success_doc_id(doc_id=doc_id)
+                    print(
+                        doc["edinetCode"],
+                        doc["docID"],
+                        doc["filerName"],
+                        doc["docDescription"],
+                        doc["submitDateTime"],
+                        sep="\t",
+                    )
+                except Exception as e:
+                    print(f"failed to download {doc_id}. error detail is {e}.")
+                    res.append_error_doc_id(doc_id=doc_id)
 
         return res
 
-    def get_documents_list(self, duration_days: int) -> GetDocumentListResult:
-        current_date = datetime.now()
-        dfs = []
-        res = GetDocumentListResult(current_date=current_date)
-        for day in range(duration_days):
-            target_date = current_date - timedelta(days=day)
-            print(target_date.strftime("%Y-%m-%d"))
+    def close(self):
+        self.__session.close()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __get(self, url: str, **kwargs) -> requests.Response:
+        # 429や5xxの場合は、Retry-Afterヘッダーを尊重しつつ指数バックオフで再試行する
+        # 再試行もRateLimiterを経由させ、EDINETが過負荷の間に秒間リクエスト数の上限を超えないようにする
+        attempt = 0
+        while True:
+            self.__rate_limiter.wait()
             try:
-                df = self.get_documents_info_dataframe(target_date=target_date)
-                dfs.append(df)
-                res.append_success_date(target_date)
-            except Exception as e:
-                print(f"failed to get document list. error detail is {e}.")
-                res.append_error_date(target_date)
+                res = self.__session.get(url, timeout=self.__timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.__retry_count:
+                    raise
+                time.sleep(get_retry_wait_seconds(attempt=attempt, backoff_factor=self.__backoff_factor))
+                attempt += 1
                 continue
+
+            if res.status_code not in RETRY_STATUS_CODES or attempt >= self.__retry_count:
+                return res
+            wait_seconds = get_retry_wait_seconds(
+                attempt=attempt, backoff_factor=self.__backoff_factor, retry_after=res.headers.get("Retry-After")
+            )
+            res.close()
+            time.sleep(wait_seconds)
+            attempt += 1
+
+    def __create_session(self, pool_size: int) -> requests.Session:
+        # 再試行はRateLimiterを経由させるため__getで行い、アダプターでは再試行しない
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=0)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def get_documents_list(self, duration_days: int, max_workers: int | None = None) -> GetDocumentListResult:
+        current_date = datetime.now()
+        target_dates = [current_date - timedelta(days=day) for day in range(duration_days)]
+        res = GetDocumentListResult(current_date=current_date)
+        dfs = self.__get_documents_info_dataframes(target_dates=target_dates, res=res, max_workers=max_workers)
         df = pd.concat(dfs, ignore_index=True)
         res.df = df
         return res
+
+    def __get_documents_info_dataframes(
+        self, target_dates: List[datetime], res: GetDocumentListResult, max_workers: int | None = None
+    ) -> List[pd.DataFrame]:
+        # 日付単位のリクエストは互いに独立しているため、スレッドプールで並列に取得する
+        # 同時実行数はmax_workers、リクエスト間隔はRateLimiterで制御する
+        workers = self.__max_workers if max_workers is None else max_workers
+        dfs = []
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = [
+                executor.submit(self.__get_documents_info_dataframe_with_cache_status, target_date=t)
+                for t in target_dates
+            ]
+
+            # 逐次実行時と同じ順序になるよう、日付順に結果を集約する
+            for target_date, future in zip(target_dates, futures):
+                print(target_date.strftime("%Y-%m-%d"))
+                try:
+                    df, cache_hit = future.result()
+                    dfs.append(df)
+                    res.append_success_date(target_date)
+                    res.count_cache_result(cache_hit=cache_hit)
+                except Exception as e:
+                    print(f"failed to get document list. error detail is {e}.")
+                    res.append_error_date(target_date)
+                    continue
+        return dfs
@@ -0,0 +1,167 @@
+import json
+import re
+from datetime import datetime
+from logging import Logger, StreamHandler, getLogger
+from typing import List
+
+from google.cloud import bigquery
+from pydantic import BaseModel
+
+from .gcp_util import get_bigquery_client
+
+local_logger = getLogger(__name__)
+local_logger.addHandler(StreamHandler())
+local_logger.setLevel("DEBUG")
+
+# 有価証券報告書から主要な指標を抽出する際のプロンプト. 出力形式はresponse_schemaで指定する
+FINANCIAL_METRICS_PROMPT = """
+上記の有価証券報告書から、最新の事業年度の主要な経営指標を抽出してください。
+
+## 抽出時のルール
+
+・連結財務諸表がある場合は連結の値を、ない場合は単体の値を抽出してください。
+・金額は全て円単位に換算してください（例: 1,234百万円 → 1234000000）。
+・比率（自己資本比率、自己資本利益率）はパーセントの値で抽出してください（例: 12.3% → 12.3）。
+・損失やマイナスの値は負の数で抽出してください。
+・記載がない項目はnullとしてください。推測で値を補わないでください。
+"""
+
+# (列名, BigQueryの型, 説明). response_schemaとBigQueryのスキーマはここから生成する
+FINANCIAL_METRICS_FIELDS = [
+    ("fiscal_year_end", "DATE", "事業年度の末日（YYYY-MM-DD）"),
+    ("accounting_standard", "STRING", "会計基準（日本基準、IFRS、米国基準のいずれか）"),
+    ("is_consolidated", "BOOLEAN", "連結の値であればtrue、単体の値であればfalse"),
+    ("net_sales", "FLOAT", "売上高（売上収益、営業収益）"),
+    ("operating_income", "FLOAT", "営業利益"),
+    ("ordinary_income", "FLOAT", "経常利益（IFRSの場合は税引前利益）"),
+    ("net_income", "FLOAT", "親会社株主に帰属する当期純利益"),
+    ("total_assets", "FLOAT", "総資産"),
+    ("net_assets", "FLOAT", "純資産"),
+    ("equity_ratio", "FLOAT", "自己資本比率（%）"),
+    ("roe", "FLOAT", "自己資本利益率（%）"),
+    ("eps", "FLOAT", "1株当たり当期純利益（円）"),
+    ("operating_cash_flow", "FLOAT", "営業活動によるキャッシュ・フロー"),
+    ("investing_cash_flow", "FLOAT", "投資活動によるキャッシュ・フロー"),
+    ("financing_cash_flow", "FLOAT", "財務活動によるキャッシュ・フロー"),
+    ("cash_and_equivalents", "FLOAT", "現金及び現金同等物の期末残高"),
+    ("number_of_employees", "INTEGER", "従業員数（人）"),
+]
+
+# BigQueryの型 -> response_schema（OpenAPIのサブセット）の型
+RESPONSE_SCHEMA_TYPES = {
+    "DATE": "STRING",
+    "STRING": "STRING",
+    "BOOLEAN": "BOOLEAN",
+    "FLOAT": "NUMBER",
+    "INTEGER": "INTEGER",
+}
+
+FINANCIAL_METRICS_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        name: {"type": RESPONSE_SCHEMA_TYPES[field_type], "description": description, "nullable": True}
+        for name, field_type, description in FINANCIAL_METRICS_FIELDS
+    },
+    "required": [name for name, _, _ in FINANCIAL_METRICS_FIELDS],
+}
+
+FINANCIAL_METRICS_TABLE_SCHEMA = [
+    bigquery.SchemaField("doc_id", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("gcs_uri", "STRING"),
+    bigquery.SchemaField("request_id", "STRING"),
+    bigquery.SchemaField("model_name", "STRING"),
+    bigquery.SchemaField("extracted_at", "TIMESTAMP", mode="REQUIRED"),
+] + [
+    bigquery.SchemaField(name, field_type, description=description)
+    for name, field_type, description in FINANCIAL_METRICS_FIELDS
+]
+
+
+class FinancialMetrics(BaseModel):
+    fiscal_year_end: str | None = None
+    accounting_standard: str | None = None
+    is_consolidated: bool | None = None
+    net_sales: float | None = None
+    operating_income: float | None = None
+    ordinary_income: float | None = None
+    net_income: float | None = None
+    total_assets: float | None = None
+    net_assets: float | None = None
+    equity_ratio: float | None = None
+    roe: float | None = None
+    eps: float | None = None
+    operating_cash_flow: float | None = None
+    investing_cash_flow: float | None = None
+    financing_cash_flow: float | None = None
+    cash_and_equivalents: float | None = None
+    number_of_employees: int | None = None
+
+
+class FinancialMetricsRecord(FinancialMetrics):
+    doc_id: str
+    gcs_uri: str | None = None
+    request_id: str | None = None
+    model_name: str | None = None
+    extracted_at: datetime
+
+
+def parse_financial_metrics(text: str) -> FinancialMetrics:
+    """LLMの出力（JSON）をFinancialMetricsに変換する. コードブロックで囲まれている場合も読み込めるようにする"""
+    matched = re.search(r"```(?:json)?\s*(.*?)```", text, re.DOTALL)
+    data = json.loads(matched.group(1) if matched else text)
+    # 日付の形式でない値はBigQueryへのロードに失敗するため、Noneとする
+    fiscal_year_end = data.get("fiscal_year_end")
+    if fiscal_year_end is not None and not re.fullmatch(r"\d{4}-\d{2}-\d{2}", str(fiscal_year_end)):
+        data["fiscal_year_end"] = None
+    return FinancialMetrics(**data)
+
+
+class FinancialMetricsStore:
+    """
+    抽出した指標をBigQueryのテーブルに保存するクラス
+    1件ずつ挿入せず、複数の決算書の指標をまとめて1回のロードジョブで追加する
+    """
+
+    def __init__(self, table_id: str, client: bigquery.Client = None, custom_logger: Logger = None) -> None:
+        self.__table_id = table_id
+        self.__client = client if client is not None else get_bigquery_client()
+        self.__logger = custom_logger if custom_logger is not None else local_logger
+        self.__table_created = False
+
+    def get_table_id(self) -> str:
+        return self.__table_id
+
+    def save(self, records: List[FinancialMetricsRecord]) -> int:
+        if len(records) == 0:
+            return 0
+        self.__create_table_if_not_exists()
+
+        # 同じ決算書を再抽出した場合に行が重複しないよう、doc_idで既存の行を削除してから追加する
+        records = list({record.doc_id: record for record in records}.values())
+        doc_ids = [record.doc_id for record in records]
+        delete_query = f"""
+            DELETE FROM `{self.__table_id}`
+            WHERE doc_id IN UNNEST(@doc_ids)
+        """
+        query_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ArrayQueryParameter("doc_ids", "STRING", doc_ids)]
+        )
+        self.__client.query(delete_query, job_config=query_config).result()
+
+        rows = [record.model_dump(mode="json") for record in records]
+        job_config = bigquery.LoadJobConfig(
+            schema=FINANCIAL_METRICS_TABLE_SCHEMA,
+            source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+            write_disposition="WRITE_APPEND",
+        )
+        self.__client.load_table_from_json(rows, self.__table_id, job_config=job_config).result()
+        self.__logger.info(f"{len(rows)} financial metrics records are loaded into {self.__table_id}.")
+        return len(rows)
+
+    def __create_table_if_not_exists(self):
+        if self.__table_created:
+            return
+        table = bigquery.Table(self.__table_id, schema=FINANCIAL_METRICS_TABLE_SCHEMA)
+        table.clustering_fields = ["doc_id"]
+        self.__client.create_table(table, exists_ok=True)
+        self.__table_created = True
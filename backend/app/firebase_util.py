@@ -7,8 +7,12 @@ from google.cloud.firestore_v1.base_query import FieldFilter
 
 
 def get_db_client_with_default_credentials() -> google.cloud.firestore.Client:
-    cred = credentials.ApplicationDefault()
-    firebase_admin.initialize_app(cred)
+    # 複数のクラスから呼ばれても、firebaseのアプリは一度だけ初期化する
+    try:
+        firebase_admin.get_app()
+    except ValueError:
+        cred = credentials.ApplicationDefault()
+        firebase_admin.initialize_app(cred)
     db = firestore.client()
     return db
 
@@ -32,3 +36,13 @@ def get_todo_list(db: google.cloud.firestore.Client, collection_id: str, target_
         .stream()
     )
     return collections
+
+
+def get_financial_document(db: google.cloud.firestore.Client, collection_id: str, doc_id: str) -> dict | None:
+    snapshot = db.collection(collection_id).document(doc_id).get()
+    return snapshot.to_dict() if snapshot.exists else None
+
+
+def register_financial_document(db: google.cloud.firestore.Client, collection_id: str, doc_id: str, gcs_uri: str):
+    data = {"doc_id": doc_id, "gcs_uri": gcs_uri, "uploaded_at": datetime.now()}
+    db.collection(collection_id).document(doc_id).set(data)
@@ -1,23 +1,187 @@
-from typing import List
+import os
+import threading
+from datetime import timedelta
+from typing import IO, Any, Callable, Dict, Iterator, List
 
-from google.cloud import storage
+import google.auth
+import requests
+from google.auth.credentials import Credentials
+from google.auth.transport.requests import Request
+from google.cloud import bigquery, storage
+
+# ストリームからアップロードする際に、一度にメモリ上に保持するバイト数（256KBの倍数である必要がある）
+DEFAULT_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+# クライアント毎に保持するHTTPコネクションの上限. 同時にGCPへアクセスするスレッド数以上にする
+DEFAULT_CONNECTION_POOL_SIZE = int(os.getenv("GCP_CONNECTION_POOL_SIZE", 32))
+
+
+class GcpClientRegistry:
+    """
+    GCPのクライアントを、種類とプロジェクト単位でプロセス内に1つだけ保持するクラス
+    クライアントの生成（認証情報の取得、コネクションの確立）は初回の利用時のみ行い、以降は全てのスレッドで共有する
+    """
+
+    def __init__(self, pool_size: int = DEFAULT_CONNECTION_POOL_SIZE, credentials: Credentials | None = None) -> None:
+        self.__pool_size = pool_size
+        self.__credentials = credentials
+        self.__lock = threading.Lock()
+        self.__clients: Dict[tuple, Any] = {}
+
+    def get_storage_client(self, project_id: str | None = None) -> storage.Client:
+        return self.__get_or_create(
+            key=("storage", project_id),
+            create=lambda: storage.Client(project=project_id, credentials=self.__credentials),
+        )
+
+    def get_bigquery_client(self, project_id: str | None = None) -> bigquery.Client:
+        return self.__get_or_create(
+            key=("bigquery", project_id),
+            create=lambda: bigquery.Client(project=project_id, credentials=self.__credentials),
+        )
+
+    def get_default_credentials(self) -> Credentials:
+        # アクセストークンは有効期限が切れた場合のみ更新する
+        credentials = self.__get_or_create(key=("credentials", None), create=lambda: google.auth.default()[0])
+        with self.__lock:
+            if not credentials.valid:
+                credentials.refresh(Request())
+        return credentials
+
+    def clear(self):
+        with self.__lock:
+            self.__clients.clear()
+
+    def __get_or_create(self, key: tuple, create: Callable[[], Any]) -> Any:
+        client = self.__clients.get(key)
+        if client is not None:
+            return client
+
+        # 同じクライアントが複数のスレッドから同時に生成されないよう、ロックを取って再確認する
+        with self.__lock:
+            client = self.__clients.get(key)
+            if client is None:
+                client = create()
+                self.__mount_connection_pool(client=client)
+                self.__clients[key] = client
+        return client
+
+    def __mount_connection_pool(self, client: Any):
+        # requestsの既定のコネクションプール（10）では、並列に実行した際にコネクションが使い回されず再接続が発生する
+        http = getattr(client, "_http", None)
+        if not isinstance(http, requests.Session):
+            return
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.__pool_size, pool_maxsize=self.__pool_size)
+        http.mount("https://", adapter)
+
+
+client_registry = GcpClientRegistry()
+
+
+def get_storage_client(project_id: str | None = None) -> storage.Client:
+    return client_registry.get_storage_client(project_id=project_id)
+
+
+def get_bigquery_client(project_id: str | None = None) -> bigquery.Client:
+    return client_registry.get_bigquery_client(project_id=project_id)
 
 
 def upload_file_into_gcs(project_id: str, bucket_name: str, remote_file_path: str, local_file_path: str) -> str:
-    storage_client = storage.Client(project=project_id)
+    storage_client = get_storage_client(project_id=project_id)
     bucket = storage_client.bucket(bucket_name)
     blob = bucket.blob(remote_file_path)
     blob.upload_from_filename(local_file_path, if_generation_match=0)
     return f"gs://{bucket_name}/{remote_file_path}"
 
 
+def upload_stream_into_gcs(
+    project_id: str,
+    bucket_name: str,
+    remote_file_path: str,
+    stream: IO[bytes],
+    content_type: str,
+    size: int | None = None,
+    chunk_size: int = DEFAULT_UPLOAD_CHUNK_SIZE,
+) -> str:
+    # chunk_size単位のresumable uploadでストリームを読み進めるため、ファイル全体をメモリやディスクに保持しない
+    # sizeを指定した場合、ストリームが途中で途切れるとアップロードは完了しない
+    storage_client = get_storage_client(project_id=project_id)
+    bucket = storage_client.bucket(bucket_name)
+    blob = bucket.blob(remote_file_path, chunk_size=chunk_size)
+    blob.upload_from_file(stream, size=size, content_type=content_type, if_generation_match=0)
+    return f"gs://{bucket_name}/{remote_file_path}"
+
+
 def download_file_from_gcs(project_id: str, bucket_name: str, remote_file_path: str, local_file_path: str):
-    storage_client = storage.Client(project=project_id)
+    storage_client = get_storage_client(project_id=project_id)
     bucket = storage_client.bucket(bucket_name)
     blob = bucket.blob(remote_file_path)
     blob.download_to_filename(local_file_path)
 
 
+def download_bytes_from_gcs(project_id: str, bucket_name: str, remote_file_path: str) -> bytes:
+    # ローカルディスクを経由せず、メモリ上にファイルを取得する（サイズの小さいファイル向け）
+    storage_client = get_storage_client(project_id=project_id)
+    bucket = storage_client.bucket(bucket_name)
+    blob = bucket.blob(remote_file_path)
+    return blob.download_as_bytes()
+
+
+def get_file_metadata_from_gcs(project_id: str, bucket_name: str, remote_file_path: str) -> storage.Blob:
+    # サイズやetagなどのメタデータのみを取得し、本文はダウンロードしない
+    storage_client = get_storage_client(project_id=project_id)
+    bucket = storage_client.bucket(bucket_name)
+    blob = bucket.get_blob(remote_file_path)
+    if blob is None:
+        raise FileNotFoundError(f"gs://{bucket_name}/{remote_file_path} is not found.")
+    return blob
+
+
+def iter_file_chunks_from_gcs(
+    project_id: str,
+    bucket_name: str,
+    remote_file_path: str,
+    start: int,
+    end: int,
+    generation: int | None = None,
+    chunk_size: int = 1024 * 1024,
+) -> Iterator[bytes]:
+    # start〜end（endを含む）の範囲を、chunk_size単位のRangeリクエストで順番に取得する
+    # generationを指定した場合、途中でファイルが更新されると例外となり、異なる版のデータが混ざらない
+    storage_client = get_storage_client(project_id=project_id)
+    bucket = storage_client.bucket(bucket_name)
+    blob = bucket.blob(remote_file_path, generation=generation)
+    position = start
+    while position <= end:
+        chunk_end = min(position + chunk_size - 1, end)
+        yield blob.download_as_bytes(start=position, end=chunk_end, checksum=None)
+        position = chunk_end + 1
+
+
+def generate_signed_url_of_gcs(
+    project_id: str, bucket_name: str, remote_file_path: str, expiration: timedelta = timedelta(minutes=15)
+) -> str:
+    # Cloud Runのサービスアカウントは秘密鍵を持たないため、アクセストークンを使ってIAM経由で署名する
+    credentials = client_registry.get_default_credentials()
+    storage_client = get_storage_client(project_id=project_id)
+    blob = storage_client.bucket(bucket_name).blob(remote_file_path)
+    return blob.generate_signed_url(
+        version="v4",
+        expiration=expiration,
+        method="GET",
+        service_account_email=getattr(credentials, "service_account_email", None),
+        access_token=credentials.token,
+        credentials=credentials,
+    )
+
+
+def exists_file_in_gcs(project_id: str, gcs_uri: str) -> bool:
+    bucket_name, remote_file_path = split_bucket_name_and_file_path(gcs_uri=gcs_uri)
+    storage_client = get_storage_client(project_id=project_id)
+    bucket = storage_client.bucket(bucket_name)
+    return bucket.blob(remote_file_path).exists()
+
+
 def split_bucket_name_and_file_path(gcs_uri: str) -> List[str]:
     uri = gcs_uri.replace("gs://", "")
     return uri.split("/", 1)
@@ -25,3 +189,42 @@ def split_bucket_name_and_file_path(gcs_uri: str) -> List[str]:
 
 def get_filename_from_gcs_uri(gcs_uri: str) -> str:
     return gcs_uri.split("/")[-1]
+
+
+if __name__ == "__main__":
+    # クライアントを毎回生成する場合と、レジストリで共有する場合の1リクエストあたりのオーバーヘッドを比較する
+    # 実行例: python -m app.gcp_util --project_id xxx --gcs_uri gs://bucket/path/to/file.pdf --count 50
+    import time
+    from argparse import ArgumentParser
+
+    from google.auth.credentials import AnonymousCredentials
+
+    parser = ArgumentParser()
+    parser.add_argument("--project_id", type=str, default=None)
+    parser.add_argument(
+        "--gcs_uri", type=str, default=None, help="指定した場合、ファイルのメタデータ取得までを含めて計測する"
+    )
+    parser.add_argument("--count", type=int, default=50)
+    parser.add_argument(
+        "--anonymous", action="store_true", help="認証情報を取得せずに、クライアントの生成のみを計測する"
+    )
+    args = parser.parse_args()
+
+    credentials = AnonymousCredentials() if args.anonymous else None
+    registry = GcpClientRegistry(credentials=credentials)
+
+    def request(storage_client: storage.Client):
+        if args.gcs_uri is None:
+            return storage_client.bucket("benchmark").blob("benchmark")
+        bucket_name, remote_file_path = split_bucket_name_and_file_path(gcs_uri=args.gcs_uri)
+        return storage_client.bucket(bucket_name).get_blob(remote_file_path)
+
+    def measure(get_client: Callable[[], storage.Client]) -> float:
+        start_time = time.perf_counter()
+        for _ in range(args.count):
+            request(get_client())
+        return (time.perf_counter() - start_time) / args.count * 1000
+
+    before_ms = measure(lambda: storage.Client(project=args.project_id, credentials=credentials))
+    after_ms = measure(lambda: registry.get_storage_client(project_id=args.project_id))
+    print(f"new client per request = {before_ms:.3f}ms/request, shared client = {after_ms:.3f}ms/request")
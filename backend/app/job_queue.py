@@ -0,0 +1,63 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from logging import Logger, StreamHandler, getLogger
+from typing import Callable
+from uuid import uuid4
+
+from .job_store import AbstractJobStore, AnalysisJob, JobNotFoundError, JobStatus
+
+local_logger = getLogger(__name__)
+local_logger.addHandler(StreamHandler())
+local_logger.setLevel("DEBUG")
+
+
+class AnalysisJobQueue:
+    """
+    時間のかかる解析処理をHTTPリクエストから切り離して、ワーカースレッドで実行するためのキュー
+    ジョブの状態と結果はjob_storeに保存し、job_idで参照する
+    job_storeを複数のキューで共有する場合は、job_typeでキュー毎のジョブを区別する
+    """
+
+    def __init__(
+        self,
+        job_store: AbstractJobStore,
+        handler: Callable[[dict], dict],
+        job_type: str = "analysis",
+        max_workers: int = 4,
+        custom_logger: Logger = None,
+    ) -> None:
+        self.__job_store = job_store
+        self.__handler = handler
+        self.__job_type = job_type
+        self.__executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="analysis_job")
+        self.__logger = custom_logger if custom_logger is not None else local_logger
+
+    def submit(self, request: dict) -> AnalysisJob:
+        current_time = datetime.now()
+        job = AnalysisJob(
+            job_id=str(uuid4()),
+            job_type=self.__job_type,
+            status=JobStatus.PENDING,
+            created_at=current_time,
+            updated_at=current_time,
+            request=request,
+        )
+        self.__job_store.create(job=job)
+        self.__executor.submit(self.__run, job_id=job.job_id, request=request)
+        return job
+
+    def get(self, job_id: str) -> AnalysisJob:
+        # 他のキューに投入されたジョブは、結果の形式が異なるため存在しないものとして扱う
+        job = self.__job_store.get(job_id=job_id)
+        if job is None or job.job_type != self.__job_type:
+            raise JobNotFoundError(f"{self.__job_type} job {job_id} is not found.")
+        return job
+
+    def __run(self, job_id: str, request: dict):
+        self.__job_store.update(job_id=job_id, status=JobStatus.RUNNING)
+        try:
+            result = self.__handler(request)
+            self.__job_store.update(job_id=job_id, status=JobStatus.SUCCEEDED, result=result)
+        except Exception as e:
+            self.__logger.error(f"job {job_id} is failed. error detail is {e}")
+            self.__job_store.update(job_id=job_id, status=JobStatus.FAILED, error=str(e))
@@ -0,0 +1,139 @@
+import json
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from copy import deepcopy
+from datetime import datetime
+from enum import Enum
+from typing import Dict
+
+from pydantic import BaseModel
+
+from .firebase_util import get_db_client_with_default_credentials
+
+
+class JobNotFoundError(Exception):
+    pass
+
+
+class JobStatus(str, Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+
+
+class AnalysisJob(BaseModel):
+    job_id: str
+    # 同じジョブストアを共有するキューのうち、どのキューに投入されたジョブか
+    job_type: str = "analysis"
+    status: JobStatus
+    created_at: datetime
+    updated_at: datetime
+    request: dict
+    result: dict | None = None
+    error: str | None = None
+
+
+class AbstractJobStore(ABC):
+    @abstractmethod
+    def create(self, job: AnalysisJob):
+        pass
+
+    @abstractmethod
+    def get(self, job_id: str) -> AnalysisJob | None:
+        pass
+
+    @abstractmethod
+    def update(self, job_id: str, status: JobStatus, result: dict | None = None, error: str | None = None):
+        pass
+
+
+class InMemoryJobStore(AbstractJobStore):
+    """プロセス内のみでジョブを管理する（ローカルでの動作確認用）"""
+
+    def __init__(self) -> None:
+        self.__jobs: Dict[str, AnalysisJob] = {}
+        self.__lock = threading.Lock()
+
+    def create(self, job: AnalysisJob):
+        with self.__lock:
+            self.__jobs[job.job_id] = deepcopy(job)
+
+    def get(self, job_id: str) -> AnalysisJob | None:
+        with self.__lock:
+            job = self.__jobs.get(job_id)
+            return deepcopy(job) if job is not None else None
+
+    def update(self, job_id: str, status: JobStatus, result: dict | None = None, error: str | None = None):
+        with self.__lock:
+            job = self.__jobs[job_id]
+            job.status = status
+            job.result = result
+            job.error = error
+            job.updated_at = datetime.now()
+
+
+class SQLiteJobStore(AbstractJobStore):
+    """SQLiteのファイルでジョブを管理する（ローカルでプロセスを再起動してもジョブを参照したい場合に利用）"""
+
+    def __init__(self, db_path: str) -> None:
+        self.__connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.__lock = threading.Lock()
+        with self.__lock, self.__connection:
+            self.__connection.execute(
+                "CREATE TABLE IF NOT EXISTS analysis_jobs (job_id TEXT PRIMARY KEY, data TEXT NOT NULL)"
+            )
+
+    def create(self, job: AnalysisJob):
+        with self.__lock, self.__connection:
+            self.__connection.execute(
+                "INSERT INTO analysis_jobs (job_id, data) VALUES (?, ?)", (job.job_id, job.model_dump_json())
+            )
+
+    def get(self, job_id: str) -> AnalysisJob | None:
+        with self.__lock:
+            row = self.__connection.execute("SELECT data FROM analysis_jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return AnalysisJob.model_validate(json.loads(row[0])) if row is not None else None
+
+    def update(self, job_id: str, status: JobStatus, result: dict | None = None, error: str | None = None):
+        job = self.get(job_id=job_id)
+        job.status = status
+        job.result = result
+        job.error = error
+        job.updated_at = datetime.now()
+        with self.__lock, self.__connection:
+            self.__connection.execute(
+                "UPDATE analysis_jobs SET data = ? WHERE job_id = ?", (job.model_dump_json(), job_id)
+            )
+
+
+class FirestoreJobStore(AbstractJobStore):
+    """Firestoreでジョブを管理する（Cloud Runの複数インスタンス間でジョブの状態を共有する本番用）"""
+
+    def __init__(self, collection_id: str = "AnalysisJobs") -> None:
+        self.__collection_id = collection_id
+        self.__db = get_db_client_with_default_credentials()
+
+    def create(self, job: AnalysisJob):
+        self.__db.collection(self.__collection_id).document(job.job_id).set(job.model_dump(mode="json"))
+
+    def get(self, job_id: str) -> AnalysisJob | None:
+        snapshot = self.__db.collection(self.__collection_id).document(job_id).get()
+        return AnalysisJob.model_validate(snapshot.to_dict()) if snapshot.exists else None
+
+    def update(self, job_id: str, status: JobStatus, result: dict | None = None, error: str | None = None):
+        data = {"status": status.value, "result": result, "error": error, "updated_at": datetime.now().isoformat()}
+        self.__db.collection(self.__collection_id).document(job_id).update(data)
+
+
+def create_job_store(store_type: str, config: dict | None = None) -> AbstractJobStore:
+    config = config if config is not None else {}
+    if store_type == "memory":
+        return InMemoryJobStore()
+    elif store_type == "sqlite":
+        return SQLiteJobStore(db_path=config["db_path"])
+    elif store_type == "firestore":
+        return FirestoreJobStore(collection_id=config.get("collection", "AnalysisJobs"))
+    else:
+        raise NotImplementedError(f"{store_type} job store type is not implemented!")
@@ -1,3 +1,4 @@
+import asyncio
 import os
 from logging import StreamHandler, getLogger
 
@@ -40,7 +41,8 @@ async def callback(request: Request, x_line_signature=Header(None)):
 
     body = await request.body()
     try:
-        handler.handle(body.decode("utf-8"), x_line_signature)
+        # ハンドラ内でLLMなどの同期処理を呼び出すため、イベントループを止めないよう別スレッドで実行する
+        await asyncio.to_thread(handler.handle, body.decode("utf-8"), x_line_signature)
     except InvalidSignatureError:
         raise HTTPException(status_code=400, detail="InvalidSignatureError")
     return Response(status="OK")
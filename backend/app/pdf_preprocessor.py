@@ -0,0 +1,125 @@
+import re
+from io import BytesIO
+from logging import Logger, StreamHandler, getLogger
+from typing import Callable, List
+
+import PyPDF2
+from pydantic import BaseModel
+
+local_logger = getLogger(__name__)
+local_logger.addHandler(StreamHandler())
+local_logger.setLevel("DEBUG")
+
+# 財務三表（貸借対照表、損益計算書、キャッシュフロー計算書）と、その概要が記載されたページの見出し
+DEFAULT_SECTION_KEYWORDS = [
+    "主要な経営指標等の推移",
+    "貸借対照表",
+    "損益計算書",
+    "キャッシュ・フロー計算書",
+]
+
+# 目次のページは全ての見出しを含むため、「…」や「・・・」などのリーダー線が多いページは対象外とする
+TABLE_OF_CONTENTS_PATTERN = re.compile(r"(…|\.{3,}|・{3,}|．{3,})")
+
+
+class PreprocessedPdf(BaseModel):
+    data: bytes
+    kept_pages: List[int]
+    total_pages: int
+    is_trimmed: bool
+
+
+class FinancialStatementPdfPreprocessor:
+    """
+    有価証券報告書のpdfから、財務三表が記載されたページのみを抜き出したpdfを作成するクラス
+    見出しを含むページと、表が続くことを考慮してその後続ページを残す
+    """
+
+    def __init__(
+        self,
+        section_keywords: List[str] = DEFAULT_SECTION_KEYWORDS,
+        following_pages: int = 2,
+        max_pages: int = 40,
+        table_of_contents_threshold: int = 5,
+        custom_logger: Logger = None,
+    ) -> None:
+        self.__section_keywords = section_keywords
+        self.__following_pages = following_pages
+        self.__max_pages = max_pages
+        self.__table_of_contents_threshold = table_of_contents_threshold
+        self.__logger = custom_logger if custom_logger is not None else local_logger
+        self.__heading_patterns = [
+            (keyword, re.compile(f"【[^】]*{re.escape(keyword)}[^】]*】")) for keyword in section_keywords
+        ]
+
+    def extract_page_texts(self, pdf_data: bytes) -> List[str]:
+        reader = PyPDF2.PdfReader(BytesIO(pdf_data))
+        return [page.extract_text() or "" for page in reader.pages]
+
+    def find_section(self, text: str) -> str | None:
+        """ページに含まれる見出しのキーワードを返す（見出しの形式を優先する）. 目次のページやキーワードがないページはNoneを返す"""
+        if len(TABLE_OF_CONTENTS_PATTERN.findall(text)) >= self.__table_of_contents_threshold:
+            return None
+        for keyword, pattern in self.__heading_patterns:
+            if pattern.search(text):
+                return keyword
+        for keyword in self.__section_keywords:
+            if keyword in text:
+                return keyword
+        return None
+
+    def select_pages(self, page_texts: List[str]) -> List[int]:
+        """
+        見出しのキーワードを含むページと、その後続ページのインデックス（0始まり）を返す
+        注記などにもキーワードは現れるため、まずは【連結貸借対照表】のような見出しの形式で探し、見つからなければキーワードのみで探す
+        """
+        selected_pages = self.__select_pages_by(
+            page_texts=page_texts,
+            match=lambda text: any([pattern.search(text) for _, pattern in self.__heading_patterns]),
+        )
+        if len(selected_pages) == 0:
+            selected_pages = self.__select_pages_by(
+                page_texts=page_texts, match=lambda text: any([keyword in text for keyword in self.__section_keywords])
+            )
+        return selected_pages[: self.__max_pages]
+
+    def __select_pages_by(self, page_texts: List[str], match: Callable[[str], bool]) -> List[int]:
+        selected_pages = set()
+        for i, text in enumerate(page_texts):
+            if len(TABLE_OF_CONTENTS_PATTERN.findall(text)) >= self.__table_of_contents_threshold:
+                continue
+            if match(text):
+                selected_pages.update(range(i, min(i + self.__following_pages + 1, len(page_texts))))
+        return sorted(selected_pages)
+
+    def preprocess(self, pdf_data: bytes) -> PreprocessedPdf:
+        """
+        財務三表のページのみを残したpdfを返す
+        テキストを抽出できない（画像のみのpdfなど）場合や、該当ページが見つからない場合は元のpdfをそのまま返す
+        """
+        reader = PyPDF2.PdfReader(BytesIO(pdf_data))
+        total_pages = len(reader.pages)
+        try:
+            page_texts = [page.extract_text() or "" for page in reader.pages]
+        except Exception as e:
+            self.__logger.warning(f"extracting text from pdf is failed. error detail is {e}")
+            page_texts = []
+
+        selected_pages = self.select_pages(page_texts=page_texts)
+        if len(selected_pages) == 0 or len(selected_pages) >= total_pages:
+            return PreprocessedPdf(
+                data=pdf_data, kept_pages=list(range(1, total_pages + 1)), total_pages=total_pages, is_trimmed=False
+            )
+
+        writer = PyPDF2.PdfWriter()
+        for i in selected_pages:
+            writer.add_page(reader.pages[i])
+        output = BytesIO()
+        writer.write(output)
+        self.__logger.info(f"pdf is trimmed from {total_pages} pages to {len(selected_pages)} pages.")
+        return PreprocessedPdf(
+            data=output.getvalue(),
+            kept_pages=[i + 1 for i in selected_pages],
+            total_pages=total_pages,
+            is_trimmed=True,
+        )
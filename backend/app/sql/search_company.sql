@@ -3,12 +3,14 @@ select
     filerName,
     docDescription
 from
-    `line_sakamomo_family_api.edinet_document_metadata`
+    `{table_id}`
 where
-    CONTAINS_SUBSTR(filerName, "{company_name}")
+    CONTAINS_SUBSTR(filerName, @company_name)
+    AND
+    docTypeCode IN ("120", "130")
     AND
     CONTAINS_SUBSTR(docDescription, "有価証券報告書")
     AND
-    pdfFlag = "1"
+    pdfFlag
 order by
     submitDateTime DESC
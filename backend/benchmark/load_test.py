@@ -0,0 +1,283 @@
+"""
+バックエンドAPI（app.api）の同時実行性能を、変更前の同期ハンドラと比較する負荷試験スクリプト
+
+app.apiのアプリケーションとControllerをそのまま起動し、外部サービスの呼び出しのみを応答遅延を模したスタブに置き換える
+- Vertex AI : GenerativeModelのgenerate_content / generate_content_async
+- BigQuery  : 企業名検索などで利用するクライアント
+- GCS       : 決算書のメタデータ取得とLLMのログのアップロード
+- Firestore : MainAgent、TODO、アップロード済みの決算書の管理（計測するルートでは呼び出さない）. キャッシュとジョブはメモリで管理する
+
+比較する構成
+- sync : 変更前のapi.pyと同じく、同じルートをdef ハンドラで提供し、Controllerの同期メソッドを呼び出す
+- async: app.apiの非同期ルートをそのまま利用する（Controllerのスレッドプール、agent.pyの非同期APIを経由する）
+
+計測するルート
+- /analyze_financial_document : GCSのメタデータ取得 → LLMでの解析 → ログのアップロード → 解析結果のキャッシュ
+- /financial_document_list    : BigQueryでの企業名検索（検索結果のキャッシュに当たらないよう、計測毎・リクエスト毎に企業名を変える）
+
+実行例:
+    python benchmark/load_test.py --requests 400 --concurrency 100 --llm_latency 2.0
+    python benchmark/load_test.py --controller_max_workers 8  # Controllerのスレッドプールを小さくした場合
+    python benchmark/load_test.py --target_url http://localhost:8080 --routes financial_document_list  # 起動済みのAPI
+"""
+
+import asyncio
+import os
+import statistics
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Callable, List
+from unittest import mock
+from uuid import uuid4
+
+import requests
+import uvicorn
+from fastapi import FastAPI
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+ROUTES = {
+    "analyze_financial_document": lambda key: {
+        "analysis_type": 0,
+        "message": "",
+        "gcs_uri": f"gs://dummy/document/{key}/S100TEST.pdf",
+        "use_cache": False,
+    },
+    "financial_document_list": lambda key: {"company_name": f"テスト株式会社{key}"},
+}
+
+
+class StubGenerationResponse:
+    """agent.pyがログの出力に利用する項目のみを持つ、Vertex AIのGenerationResponseのスタブ"""
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+        self.candidates = [
+            SimpleNamespace(
+                text=text,
+                content=SimpleNamespace(parts=[text]),
+                citation_metadata=SimpleNamespace(citations=[]),
+                finish_reason=SimpleNamespace(name="STOP"),
+                finish_message="",
+                safety_ratings=[],
+            )
+        ]
+        self._raw_response = SimpleNamespace(
+            usage_metadata=SimpleNamespace(
+                prompt_token_count=10000,
+                candidates_token_count=1000,
+                total_token_count=11000,
+                cached_content_token_count=0,
+            )
+        )
+
+
+class StubGenerativeModel:
+    def __init__(self, latency: float) -> None:
+        self.__latency = latency
+
+    def generate_content(self, contents: list, **kwargs) -> StubGenerationResponse:
+        time.sleep(self.__latency)
+        return StubGenerationResponse(text="analysis result")
+
+    async def generate_content_async(self, contents: list, **kwargs) -> StubGenerationResponse:
+        await asyncio.sleep(self.__latency)
+        return StubGenerationResponse(text="analysis result")
+
+
+class StubBigQueryClient:
+    def __init__(self, latency: float) -> None:
+        self.__latency = latency
+
+    def query(self, query: str, job_config=None) -> SimpleNamespace:
+        time.sleep(self.__latency)
+        rows = [{"docID": "S100TEST", "filerName": "テスト株式会社", "docDescription": "有価証券報告書"}]
+        return SimpleNamespace(result=lambda: rows)
+
+    def get_table(self, table_id: str) -> SimpleNamespace:
+        return SimpleNamespace(modified=datetime(2024, 1, 1))
+
+
+class StubFirestoreComponent:
+    """Firestoreを利用するクラス（MainAgent、TodoHandler、FinancialDocumentStore）の代わりに生成する"""
+
+    def __init__(self, *args, **kwargs) -> None:
+        pass
+
+
+def start_stubs(llm_latency: float, io_latency: float, bigquery_latency: float) -> List:
+    def get_file_metadata_from_gcs(**kwargs) -> SimpleNamespace:
+        time.sleep(io_latency)
+        # 解析結果のキャッシュに当たらないよう、内容のハッシュ値はリクエスト毎に変える
+        return SimpleNamespace(md5_hash=str(uuid4()), crc32c=None)
+
+    def upload_file_into_gcs(**kwargs) -> str:
+        time.sleep(io_latency)
+        return "gs://dummy/log/llm_log.json"
+
+    bigquery_client = StubBigQueryClient(latency=bigquery_latency)
+    patchers = [
+        mock.patch("vertexai.init"),
+        mock.patch("app.agent.GenerativeModel", lambda **kwargs: StubGenerativeModel(latency=llm_latency)),
+        mock.patch("app.agent.GenerationResponse", StubGenerationResponse),
+        mock.patch("app.agent.upload_file_into_gcs", upload_file_into_gcs),
+        mock.patch("app.controller.get_file_metadata_from_gcs", get_file_metadata_from_gcs),
+        mock.patch("app.gcp_util.client_registry.get_bigquery_client", lambda project_id=None: bigquery_client),
+        mock.patch("app.controller.MainAgent", StubFirestoreComponent),
+        mock.patch("app.controller.TodoHandler", StubFirestoreComponent),
+        mock.patch("app.controller.FinancialDocumentStore", StubFirestoreComponent),
+    ]
+    for patcher in patchers:
+        patcher.start()
+    return patchers
+
+
+def load_api(controller_max_workers: int):
+    # app.apiはimport時にControllerを生成するため、環境変数とスタブはimportの前に設定する
+    os.environ.update(
+        {
+            "GCP_PROJECT": "dummy",
+            "GCP_LOCATION": "asia-northeast1",
+            "EDINET_API_KEY": "dummy",
+            "ANALYSIS_CACHE_TYPE": "memory",
+            "JOB_STORE_TYPE": "memory",
+            "USE_CONTEXT_CACHE": "0",
+            "USE_PAGE_SELECTION": "0",
+            "CONTROLLER_MAX_WORKERS": str(controller_max_workers),
+        }
+    )
+    for key in ["DOCUMENT_INDEX_BASE_URI", "SEARCH_INDEX_SNAPSHOT_URI"]:
+        os.environ.pop(key, None)
+
+    from app import api
+
+    return api
+
+
+def create_sync_app(api) -> FastAPI:
+    # 変更前のapi.pyと同じく、def ハンドラ（FastAPIのスレッドプールで実行される）からControllerの同期メソッドを呼び出す
+    app = FastAPI()
+
+    @app.post("/analyze_financial_document")
+    def analyze_financial_document(request: api.AnalyzeFinancialReportRequest):
+        if request.analysis_type == api.FinancialReportAnalysisType.QA.value:
+            message = request.message
+        else:
+            message = None
+        res = api.controller.analyze_financial_document(
+            gcs_uri=request.gcs_uri, message=message, use_cache=request.use_cache
+        )
+        return api.AnalyzeFinancialReportResponse(
+            text=res.detail["response_text"],
+            prompt=res.detail["prompt"],
+            request_id=res.request_id,
+            cache_hit=res.detail["cache_hit"],
+        )
+
+    @app.post("/financial_document_list")
+    def financial_document_list(request: api.FinancialDocumentListRequest):
+        res = api.controller.search_financial_documents_if_existed(company_name=request.company_name)
+        document_list = [
+            api.FinancialDocumentData(
+                doc_id=item["doc_id"],
+                doc_url=item["doc_url"],
+                filer_name=item["filer_name"],
+                document_description=item["doc_description"],
+            )
+            for item in res.detail["items"]
+        ]
+        return api.FinancialDocumentListResponse(status=0, document_list=document_list, request_id=res.request_id)
+
+    return app
+
+
+class BackgroundServer:
+    def __init__(self, app: FastAPI, port: int) -> None:
+        config = uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", workers=1)
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+        self.url = f"http://127.0.0.1:{port}"
+
+    def __enter__(self):
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.05)
+        return self
+
+    def __exit__(self, *args):
+        self.server.should_exit = True
+        self.thread.join()
+
+
+def run_load(
+    target_url: str, route: str, create_payload: Callable[[str], dict], total_requests: int, concurrency: int
+) -> dict:
+    local = threading.local()
+    run_id = uuid4().hex[:8]
+
+    def send_request(i: int) -> float:
+        # 接続の確立時間を計測に含めないよう、スレッド毎にセッションを使い回す
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        start = time.perf_counter()
+        res = local.session.post(f"{target_url}/{route}", json=create_payload(f"{run_id}-{i}"), timeout=600)
+        res.raise_for_status()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = sorted(executor.map(send_request, range(total_requests)))
+    elapsed = time.perf_counter() - start
+
+    return {
+        "p50": statistics.median(latencies),
+        "p99": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+        "rps": total_requests / elapsed,
+        "elapsed": elapsed,
+    }
+
+
+def print_result(route: str, mode: str, result: dict):
+    print(
+        f"{route}\t{mode}\tp50={result['p50']:.2f}s\tp99={result['p99']:.2f}s\t"
+        f"rps={result['rps']:.2f}\telapsed={result['elapsed']:.2f}s"
+    )
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--routes", type=str, nargs="+", default=list(ROUTES), choices=list(ROUTES))
+    parser.add_argument("--llm_latency", type=float, default=2.0, help="スタブのLLM応答時間（秒）")
+    parser.add_argument("--io_latency", type=float, default=0.05, help="スタブのGCSの応答時間（秒）")
+    parser.add_argument("--bigquery_latency", type=float, default=0.5, help="スタブのBigQueryの応答時間（秒）")
+    parser.add_argument(
+        "--controller_max_workers",
+        type=int,
+        default=32,
+        help="Controllerのスレッドプールのサイズ（CONTROLLER_MAX_WORKERS）",
+    )
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument(
+        "--target_url", type=str, default=None, help="指定した場合、スタブを起動せずにこのURLへ負荷をかける"
+    )
+    args = parser.parse_args()
+
+    if args.target_url is not None:
+        for route in args.routes:
+            result = run_load(args.target_url, route, ROUTES[route], args.requests, args.concurrency)
+            print_result(route=route, mode=args.target_url, result=result)
+    else:
+        start_stubs(llm_latency=args.llm_latency, io_latency=args.io_latency, bigquery_latency=args.bigquery_latency)
+        api = load_api(controller_max_workers=args.controller_max_workers)
+        for mode, app in [("sync", create_sync_app(api)), ("async", api.app)]:
+            with BackgroundServer(app, port=args.port) as server:
+                for route in args.routes:
+                    result = run_load(server.url, route, ROUTES[route], args.requests, args.concurrency)
+                    print_result(route=route, mode=mode, result=result)
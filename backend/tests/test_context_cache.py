@@ -0,0 +1,106 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+from app import context_cache
+from app.context_cache import AbstractContextCacheClient, ContextCacheManager
+
+
+class FakeContextCacheClient(AbstractContextCacheClient):
+    def __init__(self, create_seconds: float = 0.0, fail: bool = False) -> None:
+        self.created = []
+        self.deleted = []
+        self.__create_seconds = create_seconds
+        self.__fail = fail
+        self.__lock = threading.Lock()
+
+    def create(self, model_name: str, gcs_uri: str, ttl_seconds: int) -> str:
+        time.sleep(self.__create_seconds)
+        if self.__fail:
+            raise Exception("the number of tokens is too small.")
+        with self.__lock:
+            cache_name = f"cache-{len(self.created)}"
+            self.created.append(cache_name)
+        return cache_name
+
+    def get_model(self, cache_name: str) -> Any:
+        return cache_name
+
+    def delete(self, cache_name: str):
+        self.deleted.append(cache_name)
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_get_or_create_reuses_cache():
+    client = FakeContextCacheClient()
+    manager = ContextCacheManager(client=client, model_name="gemini")
+
+    cache_name = manager.get_or_create(gcs_uri="gs://bucket/a.pdf")
+    assert manager.get_or_create(gcs_uri="gs://bucket/a.pdf") == cache_name
+    assert manager.get_or_create(gcs_uri="gs://bucket/b.pdf") != cache_name
+    assert len(client.created) == 2
+
+    # 作成後は、gcs_uri単位のロックは残らない
+    assert manager._ContextCacheManager__creating_locks == {}
+
+
+def test_get_or_create_recreates_expired_cache(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(context_cache.time, "monotonic", clock)
+    client = FakeContextCacheClient()
+    manager = ContextCacheManager(client=client, model_name="gemini", ttl_seconds=600, refresh_margin_seconds=60)
+
+    cache_name = manager.get_or_create(gcs_uri="gs://bucket/a.pdf")
+    clock.now += 500
+    assert manager.get_or_create(gcs_uri="gs://bucket/a.pdf") == cache_name
+
+    # 期限切れ間近になると作り直し、古いキャッシュは利用中の可能性があるため削除しない
+    clock.now += 50
+    new_cache_name = manager.get_or_create(gcs_uri="gs://bucket/a.pdf")
+    assert new_cache_name != cache_name
+    assert client.deleted == []
+
+
+def test_get_or_create_does_not_retry_failed_creation_until_expired(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(context_cache.time, "monotonic", clock)
+    client = FakeContextCacheClient(fail=True)
+    manager = ContextCacheManager(client=client, model_name="gemini", ttl_seconds=600, refresh_margin_seconds=0)
+
+    assert manager.get_or_create(gcs_uri="gs://bucket/a.pdf") is None
+    assert manager.get_or_create(gcs_uri="gs://bucket/a.pdf") is None
+    assert manager._ContextCacheManager__creating_locks == {}
+
+
+def test_get_or_create_concurrently_creates_once():
+    client = FakeContextCacheClient(create_seconds=0.1)
+    manager = ContextCacheManager(client=client, model_name="gemini")
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        cache_names = list(executor.map(lambda _: manager.get_or_create(gcs_uri="gs://bucket/a.pdf"), range(8)))
+
+    assert len(client.created) == 1
+    assert set(cache_names) == {client.created[0]}
+    assert manager._ContextCacheManager__creating_locks == {}
+
+
+def test_max_entries_and_close():
+    client = FakeContextCacheClient()
+    manager = ContextCacheManager(client=client, model_name="gemini", max_entries=2)
+
+    for name in ["a", "b", "c"]:
+        manager.get_or_create(gcs_uri=f"gs://bucket/{name}.pdf")
+
+    # 上限を超えた場合は、最も使われていないキャッシュから削除する
+    assert client.deleted == ["cache-0"]
+
+    manager.close()
+    assert sorted(client.deleted) == ["cache-0", "cache-1", "cache-2"]
@@ -0,0 +1,54 @@
+import time
+
+import pytest
+
+from app.job_queue import AnalysisJobQueue
+from app.job_store import InMemoryJobStore, JobNotFoundError, JobStatus
+
+
+def wait_until_finished(job_queue: AnalysisJobQueue, job_id: str, timeout_seconds: float = 5.0):
+    deadline = time.monotonic() + timeout_seconds
+    while time.monotonic() < deadline:
+        job = job_queue.get(job_id=job_id)
+        if job.status in (JobStatus.SUCCEEDED, JobStatus.FAILED):
+            return job
+        time.sleep(0.01)
+    raise Exception(f"job {job_id} is not finished.")
+
+
+def test_run_job():
+    job_queue = AnalysisJobQueue(job_store=InMemoryJobStore(), handler=lambda request: {"echo": request["message"]})
+
+    job = job_queue.submit(request={"message": "hello"})
+    job = wait_until_finished(job_queue=job_queue, job_id=job.job_id)
+    assert job.status == JobStatus.SUCCEEDED
+    assert job.result == {"echo": "hello"}
+
+
+def test_failed_job():
+    def handler(request: dict) -> dict:
+        raise Exception("analysis is failed.")
+
+    job_queue = AnalysisJobQueue(job_store=InMemoryJobStore(), handler=handler)
+
+    job = job_queue.submit(request={})
+    job = wait_until_finished(job_queue=job_queue, job_id=job.job_id)
+    assert job.status == JobStatus.FAILED
+    assert job.error == "analysis is failed."
+
+
+def test_get_job_of_other_queue():
+    # 同じジョブストアを共有していても、他のキューに投入されたジョブは参照できない
+    job_store = InMemoryJobStore()
+    analysis_job_queue = AnalysisJobQueue(job_store=job_store, handler=lambda request: {}, job_type="analysis")
+    batch_job_queue = AnalysisJobQueue(job_store=job_store, handler=lambda request: {}, job_type="batch_analysis")
+
+    analysis_job = analysis_job_queue.submit(request={})
+    batch_job = batch_job_queue.submit(request={})
+    assert analysis_job_queue.get(job_id=analysis_job.job_id).job_type == "analysis"
+    assert batch_job_queue.get(job_id=batch_job.job_id).job_type == "batch_analysis"
+
+    with pytest.raises(JobNotFoundError):
+        analysis_job_queue.get(job_id=batch_job.job_id)
+    with pytest.raises(JobNotFoundError):
+        batch_job_queue.get(job_id=analysis_job.job_id)
@@ -0,0 +1,78 @@
+from datetime import datetime
+
+import pytest
+
+from app.job_store import AnalysisJob, JobStatus, create_job_store
+
+
+def create_job(job_id: str) -> AnalysisJob:
+    current_time = datetime.now()
+    return AnalysisJob(
+        job_id=job_id,
+        status=JobStatus.PENDING,
+        created_at=current_time,
+        updated_at=current_time,
+        request={"company_name": "テスト株式会社", "question": "売上高は?"},
+    )
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def job_store(request, tmp_path):
+    return create_job_store(store_type=request.param, config={"db_path": str(tmp_path / "jobs.db")})
+
+
+def test_create_and_get(job_store):
+    job = create_job(job_id="job-1")
+    job_store.create(job=job)
+
+    assert job_store.get(job_id="job-1") == job
+    assert job_store.get(job_id="not-found") is None
+
+
+def test_status_transition_to_succeeded(job_store):
+    job_store.create(job=create_job(job_id="job-1"))
+
+    job_store.update(job_id="job-1", status=JobStatus.RUNNING)
+    job = job_store.get(job_id="job-1")
+    assert job.status == JobStatus.RUNNING
+    assert job.result is None
+
+    job_store.update(job_id="job-1", status=JobStatus.SUCCEEDED, result={"response_text": "回答"})
+    job = job_store.get(job_id="job-1")
+    assert job.status == JobStatus.SUCCEEDED
+    assert job.result == {"response_text": "回答"}
+    assert job.error is None
+    assert job.updated_at >= job.created_at
+
+
+def test_status_transition_to_failed(job_store):
+    job_store.create(job=create_job(job_id="job-1"))
+
+    job_store.update(job_id="job-1", status=JobStatus.RUNNING)
+    job_store.update(job_id="job-1", status=JobStatus.FAILED, error="timeout")
+    job = job_store.get(job_id="job-1")
+    assert job.status == JobStatus.FAILED
+    assert job.result is None
+    assert job.error == "timeout"
+
+
+def test_get_returns_copy(job_store):
+    # 取得したジョブを書き換えても、保存されているジョブは変わらない
+    job_store.create(job=create_job(job_id="job-1"))
+    job = job_store.get(job_id="job-1")
+    job.status = JobStatus.FAILED
+
+    assert job_store.get(job_id="job-1").status == JobStatus.PENDING
+
+
+def test_sqlite_job_store_persists(tmp_path):
+    # プロセスを再起動した場合と同様に、作り直したストアからもジョブを参照できる
+    config = {"db_path": str(tmp_path / "jobs.db")}
+    create_job_store(store_type="sqlite", config=config).create(job=create_job(job_id="job-1"))
+
+    job_store = create_job_store(store_type="sqlite", config=config)
+    job_store.update(job_id="job-1", status=JobStatus.SUCCEEDED, result={"response_text": "回答"})
+
+    job = create_job_store(store_type="sqlite", config=config).get(job_id="job-1")
+    assert job.status == JobStatus.SUCCEEDED
+    assert job.result == {"response_text": "回答"}
@@ -1,5 +1,7 @@
 import json
 import os
+import time
+from typing import Iterator
 
 import requests
 from requests import Response
@@ -32,13 +34,91 @@ class BackendRequester:
     def request_upload_financial_report(self, token: str, doc_id: str) -> dict:
         return self.request_api(token=token, request_name="upload_financial_report", data={"doc_id": doc_id}).json()
 
-    def request_analyze_financial_document(self, token: str, analysis_type: int, gcs_uri: str, message: str) -> dict:
+    def request_analyze_financial_document(
+        self, token: str, analysis_type: int, gcs_uri: str, message: str, use_cache: bool = True
+    ) -> dict:
         return self.request_api(
             token=token,
             request_name="analyze_financial_document",
-            data={"analysis_type": analysis_type, "gcs_uri": gcs_uri, "message": message},
+            data={"analysis_type": analysis_type, "gcs_uri": gcs_uri, "message": message, "use_cache": use_cache},
         ).json()
 
+    def request_stream_analyze_financial_document(
+        self,
+        token: str,
+        analysis_type: int,
+        gcs_uri: str,
+        message: str,
+        metadata: dict | None = None,
+        use_cache: bool = True,
+    ) -> Iterator[str]:
+        """
+        解析結果をServer-Sent Eventsで受け取り、生成されたテキストを順に返す
+        metadataにdictを渡した場合は、request_idとpromptが格納される
+        """
+        url = f"{self.__backend_url}/analyze_financial_document/stream"
+        with requests.request(
+            "POST",
+            url,
+            data=json.dumps(
+                {"analysis_type": analysis_type, "gcs_uri": gcs_uri, "message": message, "use_cache": use_cache}
+            ),
+            headers={
+                "Content-Type": "application/json",
+                "Accept": "text/event-stream",
+                "Authorization": "Bearer {}".format(token),
+            },
+            stream=True,
+        ) as resp:
+            if resp.status_code != 200:
+                raise Exception(
+                    "Bad response from application: {!r} / {!r} / {!r}".format(
+                        resp.status_code, resp.headers, resp.text
+                    )
+                )
+
+            event = "message"
+            for line in resp.iter_lines(decode_unicode=True):
+                if line.startswith("event:"):
+                    event = line[len("event:") :].strip()
+                elif line.startswith("data:"):
+                    data = json.loads(line[len("data:") :].strip())
+                    if event == "metadata" and metadata is not None:
+                        metadata.update(data)
+                    elif event == "message":
+                        yield data["text"]
+                    elif event == "error":
+                        raise Exception(data["message"])
+                elif line == "":
+                    event = "message"
+
+    def request_submit_analysis_job(
+        self, token: str, analysis_type: int, gcs_uri: str, message: str, use_cache: bool = True
+    ) -> dict:
+        return self.request_api(
+            token=token,
+            request_name="analysis_jobs",
+            data={"analysis_type": analysis_type, "gcs_uri": gcs_uri, "message": message, "use_cache": use_cache},
+        ).json()
+
+    def request_get_analysis_job(self, token: str, job_id: str) -> dict:
+        return self.request_get(
+            token=token, request_name=f"analysis_jobs/{job_id}", data={}, mime_type="application/json"
+        ).json()
+
+    def wait_analysis_job(
+        self, token: str, job_id: str, polling_interval: float = 2.0, timeout_seconds: float = 600.0
+    ) -> dict:
+        # ジョブが完了するまで、一定間隔でジョブの状態を問い合わせる
+        start_time = time.time()
+        while True:
+            res = self.request_get_analysis_job(token=token, job_id=job_id)
+            if res["status"] in ["succeeded", "failed"]:
+                return res
+            if time.time() - start_time > timeout_seconds:
+                raise Exception(f"analysis job {job_id} is timeout.")
+            time.sleep(polling_interval)
+
     def request_download_financial_document(self, token: str, gcs_uri: str) -> bytes:
         return self.request_get(
             token=token,
@@ -55,7 +135,7 @@ class BackendRequester:
             data=json.dumps(data),
             headers={"Content-Type": "application/json", "Authorization": "Bearer {}".format(token)},
         )
-        if resp.status_code != 200:
+        if resp.status_code not in [200, 202]:
             raise Exception(
                 "Bad response from application: {!r} / {!r} / {!r}".format(resp.status_code, resp.headers, resp.text)
             )
@@ -191,6 +191,7 @@ def financial_report_analysis_widget():
         )
 
         # 解析ボタンの表示
+        use_stream = st.toggle("解析結果を逐次表示する", value=True)
         analyze_btn = st.button("解析開始")
         if analyze_btn:
             # 指定したドキュメントを分析する
@@ -206,15 +207,36 @@ def financial_report_analysis_widget():
             # 対象となる決算資料を分析する
             gcs_uri = res["gcs_uri"]
             st.text(f"gcs uri : {gcs_uri}")
-            with st.spinner("please wait to analyze the financial report.."):
-                res = backend_requester.request_analyze_financial_document(
-                    token=st.session_state[TOKEN_KEY], analysis_type=0, gcs_uri=gcs_uri, message=""
+            if use_stream:
+                # 解析結果を生成された部分から順に表示する
+                metadata = {}
+                st.write_stream(
+                    backend_requester.request_stream_analyze_financial_document(
+                        token=st.session_state[TOKEN_KEY],
+                        analysis_type=0,
+                        gcs_uri=gcs_uri,
+                        message="",
+                        metadata=metadata,
+                    )
                 )
-
-            # 解析結果を出力する
-            request_id = res["request_id"]
-            st.text(f"Request ID : {request_id}")
-            st.text(res["text"])
+                st.text(f"Request ID : {metadata.get('request_id')}")
+            else:
+                # 解析はジョブとして投入し、完了するまでポーリングで待機する
+                with st.spinner("please wait to analyze the financial report.."):
+                    job = backend_requester.request_submit_analysis_job(
+                        token=st.session_state[TOKEN_KEY], analysis_type=0, gcs_uri=gcs_uri, message=""
+                    )
+                    st.text(f"Job ID : {job['job_id']}")
+                    job = backend_requester.wait_analysis_job(token=st.session_state[TOKEN_KEY], job_id=job["job_id"])
+
+                # 解析結果を出力する
+                if job["status"] == "succeeded":
+                    res = job["result"]
+                    request_id = res["request_id"]
+                    st.text(f"Request ID : {request_id}")
+                    st.text(res["text"])
+                else:
+                    st.error(f"analysis job is failed. {job['error']}")
 
             # ドキュメントをダウンロードする
             # TODO : 階層が深いので、リファクタリングするか・関数として切り出す
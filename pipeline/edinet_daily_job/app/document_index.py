@@ -0,0 +1,162 @@
+"""
+有価証券報告書のpdfから、ページ単位のテキストと財務三表のページを抽出し、doc_id単位でParquetとして保存するためのクラス群
+バックエンド（backend/app/document_index.py）と同じ形式で保存し、解析時はバックエンドが読み込む
+"""
+
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import List
+
+import pandas as pd
+import PyPDF2
+from google.cloud import storage
+
+from edinet_wrapper import EdinetWrapper
+from gcp_clients import get_storage_client
+
+# 財務三表（貸借対照表、損益計算書、キャッシュフロー計算書）と、その概要が記載されたページの見出し
+DEFAULT_SECTION_KEYWORDS = [
+    "主要な経営指標等の推移",
+    "貸借対照表",
+    "損益計算書",
+    "キャッシュ・フロー計算書",
+]
+
+# 目次のページは全ての見出しを含むため、「…」や「・・・」などのリーダー線が多いページは対象外とする
+TABLE_OF_CONTENTS_PATTERN = re.compile(r"(…|\.{3,}|・{3,}|．{3,})")
+TABLE_OF_CONTENTS_THRESHOLD = 5
+
+DOCUMENT_INDEX_COLUMNS = ["doc_id", "page", "section", "is_statement_page", "text"]
+
+
+def find_section(text: str,
+                 section_keywords: List[str] = DEFAULT_SECTION_KEYWORDS,
+                 headings_only: bool = False) -> str | None:
+    # 注記などにもキーワードは現れるため、【連結貸借対照表】のような見出しの形式を優先する
+    if len(TABLE_OF_CONTENTS_PATTERN.findall(text)) >= TABLE_OF_CONTENTS_THRESHOLD:
+        return None
+    for keyword in section_keywords:
+        if re.search(f"【[^】]*{re.escape(keyword)}[^】]*】", text):
+            return keyword
+    if headings_only:
+        return None
+    for keyword in section_keywords:
+        if keyword in text:
+            return keyword
+    return None
+
+
+def build_document_index(doc_id: str,
+                         pdf_data: bytes,
+                         following_pages: int = 2,
+                         max_pages: int = 40) -> pd.DataFrame:
+    reader = PyPDF2.PdfReader(BytesIO(pdf_data))
+    page_texts = [page.extract_text() or "" for page in reader.pages]
+
+    # 見出しの形式で見つかったページを優先し、見つからない場合はキーワードのみで探す
+    heading_pages = [i for i, text in enumerate(page_texts) if find_section(text, headings_only=True) is not None]
+    if len(heading_pages) == 0:
+        heading_pages = [i for i, text in enumerate(page_texts) if find_section(text) is not None]
+    statement_pages = set()
+    for i in heading_pages:
+        statement_pages.update(range(i, min(i + following_pages + 1, len(page_texts))))
+    statement_pages = set(sorted(statement_pages)[:max_pages])
+
+    records = []
+    current_section = None
+    for i, text in enumerate(page_texts):
+        section = find_section(text)
+        if section is not None:
+            current_section = section
+        elif i not in statement_pages:
+            current_section = None
+        records.append({
+            "doc_id": doc_id,
+            "page": i + 1,
+            "section": current_section if i in statement_pages else None,
+            "is_statement_page": i in statement_pages,
+            "text": text,
+        })
+    df = pd.DataFrame(records, columns=DOCUMENT_INDEX_COLUMNS)
+    return df.astype({"doc_id": "string", "page": "int32", "section": "string", "is_statement_page": "bool"})
+
+
+class DocumentIndexStore:
+    """
+    doc_id単位で抽出済みのテキストをParquet形式で保存するクラス
+    base_uriにgs://から始まるパスを指定した場合はGCSに、それ以外はローカルのフォルダに保存する
+    """
+
+    def __init__(self, base_uri: str) -> None:
+        self.__base_uri = base_uri.rstrip("/")
+        if self.__is_gcs():
+            self.__storage_client = get_storage_client()
+        else:
+            os.makedirs(self.__base_uri, exist_ok=True)
+
+    def get_uri(self, doc_id: str) -> str:
+        return f"{self.__base_uri}/{doc_id}.parquet"
+
+    def exists(self, doc_id: str) -> bool:
+        uri = self.get_uri(doc_id=doc_id)
+        if self.__is_gcs():
+            return self.__get_blob(uri).exists()
+        return os.path.exists(uri)
+
+    def save(self, doc_id: str, df: pd.DataFrame) -> str:
+        uri = self.get_uri(doc_id=doc_id)
+        data = BytesIO()
+        df.to_parquet(data, index=False, compression="zstd")
+        if self.__is_gcs():
+            data.seek(0)
+            self.__get_blob(uri).upload_from_file(data, content_type="application/vnd.apache.parquet")
+            return uri
+
+        # 書き込み途中のファイルを読み込まないよう、一時ファイルに書いてから置き換える
+        tmp_uri = f"{uri}.tmp"
+        with open(tmp_uri, "wb") as f:
+            f.write(data.getvalue())
+        os.replace(tmp_uri, uri)
+        return uri
+
+    def __get_blob(self, uri: str) -> storage.Blob:
+        bucket_name, remote_file_path = uri[len("gs://"):].split("/", 1)
+        return self.__storage_client.bucket(bucket_name).blob(remote_file_path)
+
+    def __is_gcs(self) -> bool:
+        return self.__base_uri.startswith("gs://")
+
+
+def build_document_indexes(edinet: EdinetWrapper,
+                           doc_ids: List[str],
+                           index_store: DocumentIndexStore,
+                           max_workers: int = 1) -> dict:
+    """
+    指定したdoc_idのpdfをEDINETから取得し、テキストを抽出して保存する. 抽出済みのdoc_idはスキップする
+    """
+    def build(doc_id: str) -> str:
+        if index_store.exists(doc_id=doc_id):
+            return "skipped"
+        file_path = edinet.download_pdf_of_financial_report(doc_id=doc_id)
+        try:
+            with open(file_path, "rb") as f:
+                df = build_document_index(doc_id=doc_id, pdf_data=f.read())
+            index_store.save(doc_id=doc_id, df=df)
+        finally:
+            os.remove(file_path)
+        return "success"
+
+    def build_safely(doc_id: str) -> str:
+        try:
+            return build(doc_id)
+        except Exception as e:
+            print(f"building document index of {doc_id} is failed. error detail is {e}")
+            return "error"
+
+    counts = {"success": 0, "skipped": 0, "error": 0}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        for status in executor.map(build_safely, doc_ids):
+            counts[status] += 1
+    return counts
@@ -0,0 +1,271 @@
+"""
+EDINETのドキュメント一覧を保存するBigQueryのテーブル（edinet_document_metadata）を管理するためのクラス
+テーブルは提出日（submitDateTime）で日単位にパーティション分割し、企業名などでクラスタリングする
+取り込みはパーティション単位の置き換えで行い、テーブル全体の書き換えや全件スキャンの削除を避ける
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from io import BytesIO
+from typing import List
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from google.api_core.exceptions import NotFound
+from google.cloud import bigquery
+
+from edinet_wrapper import DOCUMENT_ARROW_SCHEMA, DOCUMENT_FIELD_TYPES, LISTING_DATE_FIELD
+from gcp_clients import get_bigquery_client
+
+
+# DOCUMENT_FIELD_TYPESの型 -> BigQueryの型
+BIGQUERY_FIELD_TYPES = {
+    "string": "STRING",
+    "category": "STRING",
+    "int": "INTEGER",
+    "date": "DATE",
+    "datetime": "DATETIME",
+    "bool": "BOOLEAN",
+}
+
+DOCUMENT_METADATA_SCHEMA = [
+    bigquery.SchemaField(col, BIGQUERY_FIELD_TYPES[field_type], mode="REQUIRED" if col == "docID" else "NULLABLE")
+    for col, field_type in DOCUMENT_FIELD_TYPES.items()
+]
+
+# BigQueryにロードするParquetのスキーマ. categoryの列は文字列に戻し、必須の列は欠損値を許容しない
+PARQUET_SCHEMA = pa.schema([
+    pa.field(field.name,
+             pa.string() if pa.types.is_dictionary(field.type) else field.type,
+             nullable=schema_field.mode != "REQUIRED")
+    for field, schema_field in zip(DOCUMENT_ARROW_SCHEMA, DOCUMENT_METADATA_SCHEMA)
+])
+
+PARTITION_FIELD = "submitDateTime"
+
+# 企業名検索（filerName）、書類種別（docTypeCode）、企業単位（edinetCode）での絞り込みが多いため、この順でクラスタリングする
+CLUSTERING_FIELDS = ["filerName", "docTypeCode", "edinetCode"]
+
+
+class DocumentMetadataTable:
+    def __init__(self, table_id: str, client: bigquery.Client = None) -> None:
+        self.__table_id = table_id
+        self.__client = client if client is not None else get_bigquery_client()
+
+    def get_table_id(self) -> str:
+        return self.__table_id
+
+    def create_if_not_exists(self):
+        """
+        テーブルがなければ作成する. 既存のテーブルの構成（パーティション分割・列の型）が異なる場合は例外とし、
+        テーブルの作り直しはジョブからは行わない（migrate_document_table.pyで明示的に移行する）
+        """
+        table = self.__get_table_or_none(table_id=self.__table_id)
+        if table is None:
+            # 移行の途中で終了した場合は、作業用・退避用のテーブルにデータが残っているため、空のテーブルを作らずに止める
+            for table_id in [self.get_migration_table_id(), self.get_backup_table_id()]:
+                if self.__get_table_or_none(table_id=table_id) is not None:
+                    raise Exception(f"{self.__table_id} is not found, but {table_id} exists. "
+                                    f"restore the table from {table_id} before running the job.")
+            print(f"start to create partitioned table {self.__table_id}")
+            self.__client.create_table(self.__create_table_definition(), exists_ok=True)
+            return
+
+        mismatches = self.get_layout_mismatches(table=table)
+        if len(mismatches) > 0:
+            raise Exception(f"layout of {self.__table_id} is different from the expected one ({', '.join(mismatches)}). "
+                            f"run migrate_document_table.py to migrate the table.")
+
+    def get_layout_mismatches(self, table: bigquery.Table) -> List[str]:
+        # DOCUMENT_METADATA_SCHEMA以外に追加された列は、取り込みに影響しないため許容する
+        mismatches = []
+        if table.time_partitioning is None or table.time_partitioning.field != PARTITION_FIELD:
+            mismatches.append(f"not partitioned by {PARTITION_FIELD}")
+        field_types = {field.name: field.field_type for field in table.schema}
+        for field in DOCUMENT_METADATA_SCHEMA:
+            if field.name not in field_types:
+                mismatches.append(f"{field.name} is missing")
+            elif field_types[field.name] != field.field_type:
+                mismatches.append(f"{field.name} is {field_types[field.name]}, not {field.field_type}")
+        return mismatches
+
+    def get_migration_table_id(self) -> str:
+        return f"{self.__table_id}_partitioned"
+
+    def get_backup_table_id(self) -> str:
+        return f"{self.__table_id}_backup"
+
+    def migrate_to_partitioned_table(self) -> int:
+        """
+        既存のテーブルを、スキーマを明示したパーティション分割・クラスタリング済みのテーブルに作り直す
+        以前のテーブルは欠損値が"None"の文字列、フラグが"0"/"1"の文字列として保存されているため、欠損値に戻しつつ型を変換する
+        作業用のテーブルにコピーして件数を確認した後、元のテーブルは削除せずに_backupへ退避してから置き換える
+        """
+        table = self.__client.get_table(self.__table_id)
+        tmp_table_id = self.get_migration_table_id()
+        backup_table_id = self.get_backup_table_id()
+        # 前回の移行で残ったテーブルは、データを含みうるため自動では削除しない
+        for table_id in [tmp_table_id, backup_table_id]:
+            if self.__get_table_or_none(table_id=table_id) is not None:
+                raise Exception(f"{table_id} already exists. check and delete it before migrating {self.__table_id}.")
+
+        schema_names = {field.name for field in DOCUMENT_METADATA_SCHEMA}
+        dropped_columns = [field.name for field in table.schema if field.name not in schema_names]
+        if len(dropped_columns) > 0:
+            print(f"columns {dropped_columns} are not migrated. they are kept in {backup_table_id}")
+
+        print(f"start to copy {self.__table_id} into {tmp_table_id}")
+        self.__client.create_table(self.__create_table_definition(table_id=tmp_table_id))
+        columns = ", ".join([f"`{field.name}`" for field in DOCUMENT_METADATA_SCHEMA])
+        select_columns = ",\n".join([self.__create_cast_expression(field=field) for field in DOCUMENT_METADATA_SCHEMA])
+        copy_query = f"""
+            INSERT INTO `{tmp_table_id}` ({columns})
+            SELECT {select_columns}
+            FROM `{self.__table_id}`
+            WHERE docID IS NOT NULL
+        """
+        self.__client.query(copy_query).result()
+
+        # コピーした件数が一致しない場合は、元のテーブルを残したまま中断する
+        source_rows = self.__count_rows(table_id=self.__table_id, where_clause="WHERE docID IS NOT NULL")
+        copied_rows = self.__count_rows(table_id=tmp_table_id)
+        if source_rows != copied_rows:
+            raise Exception(f"copied rows ({copied_rows}) is different from rows of {self.__table_id} ({source_rows}). "
+                            f"{self.__table_id} is not changed.")
+
+        print(f"start to rename {self.__table_id} to {backup_table_id}")
+        self.__rename_table(table_id=self.__table_id, new_table_id=backup_table_id)
+        print(f"start to rename {tmp_table_id} to {self.__table_id}")
+        self.__rename_table(table_id=tmp_table_id, new_table_id=self.__table_id)
+        return copied_rows
+
+    def delete_partitions(self, start_date: date, end_date: date):
+        # パーティション列の範囲で削除するため、対象のパーティションのみが処理される
+        delete_query = f"""
+            DELETE FROM `{self.__table_id}`
+            WHERE {PARTITION_FIELD} >= @start_datetime AND {PARTITION_FIELD} < @end_datetime
+        """
+        query_config = bigquery.QueryJobConfig(
+            query_parameters=[
+                bigquery.ScalarQueryParameter("start_datetime", "DATETIME", to_datetime(start_date)),
+                bigquery.ScalarQueryParameter("end_datetime", "DATETIME", to_datetime(end_date) + timedelta(days=1)),
+            ]
+        )
+        self.__client.query(delete_query, job_config=query_config).result()
+
+    def replace_partitions(self, df: pd.DataFrame, target_dates: List[datetime], max_workers: int = 1) -> int:
+        """
+        取得した日付のパーティションを、取得したドキュメントで置き換える
+        取得した日付以外の提出日のドキュメント（訂正・取下げで別の日付の一覧に載ったものなど）は、docIDで置き換える
+        提出日のないドキュメント（取下げ済みで項目が空のもの）は、既存のレコードの削除のみを行う
+        dfには、一覧を取得した日付の列（LISTING_DATE_FIELD）が必要となる
+        """
+        dates = sorted({to_date(d) for d in target_dates})
+        if len(df) > 0:
+            # 同じdocIDが複数の日付の一覧に載っている場合は、一覧の連結順によらず、最も新しい日付の一覧の内容を使う
+            df = df.sort_values(LISTING_DATE_FIELD, kind="stable").drop_duplicates(subset=["docID"], keep="last")
+        submit_dates = df[PARTITION_FIELD].dt.date
+
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            futures = [executor.submit(self.__replace_partition, df=df[submit_dates == d], target_date=d)
+                       for d in dates]
+            for future in futures:
+                future.result()
+
+        other_df = df[~submit_dates.isin(dates)]
+        if len(other_df) > 0:
+            self.__merge_rows(df=other_df)
+        return len(df)
+
+    def __replace_partition(self, df: pd.DataFrame, target_date: date):
+        if len(df) == 0:
+            self.delete_partitions(start_date=target_date, end_date=target_date)
+            return
+
+        # パーティションデコレーターを指定したWRITE_TRUNCATEで、該当日付のパーティションのみを置き換える
+        self.__load_dataframe(df=df,
+                              destination=f"{self.__table_id}${target_date.strftime('%Y%m%d')}",
+                              write_disposition="WRITE_TRUNCATE")
+
+    def __merge_rows(self, df: pd.DataFrame):
+        # 提出日が分かる場合は、削除を該当する提出日のパーティションに限定して全件スキャンを避ける
+        query_parameters = [bigquery.ArrayQueryParameter("doc_ids", "STRING", df["docID"].tolist())]
+        where_clause = "docID IN UNNEST(@doc_ids)"
+        if df[PARTITION_FIELD].notna().all():
+            submit_dates = df[PARTITION_FIELD].dt.date
+            where_clause += f" AND {PARTITION_FIELD} >= @start_datetime AND {PARTITION_FIELD} < @end_datetime"
+            query_parameters += [
+                bigquery.ScalarQueryParameter("start_datetime", "DATETIME", to_datetime(submit_dates.min())),
+                bigquery.ScalarQueryParameter("end_datetime", "DATETIME",
+                                              to_datetime(submit_dates.max()) + timedelta(days=1)),
+            ]
+        delete_query = f"""
+            DELETE FROM `{self.__table_id}`
+            WHERE {where_clause}
+        """
+        query_config = bigquery.QueryJobConfig(query_parameters=query_parameters)
+        self.__client.query(delete_query, job_config=query_config).result()
+
+        df = df[df[PARTITION_FIELD].notna()]
+        if len(df) == 0:
+            return
+        self.__load_dataframe(df=df, destination=self.__table_id, write_disposition="WRITE_APPEND")
+
+    def __load_dataframe(self, df: pd.DataFrame, destination: str, write_disposition: str):
+        # DataFrameの型をそのままParquetに書き出してロードし、行単位の変換やJSONへのシリアライズを避ける
+        data = BytesIO()
+        pq.write_table(to_parquet_table(df), data, compression="zstd")
+        data.seek(0)
+        job_config = bigquery.LoadJobConfig(
+            schema=DOCUMENT_METADATA_SCHEMA,
+            source_format=bigquery.SourceFormat.PARQUET,
+            write_disposition=write_disposition
+        )
+        self.__client.load_table_from_file(data, destination, job_config=job_config).result()
+
+    def __get_table_or_none(self, table_id: str) -> bigquery.Table | None:
+        try:
+            return self.__client.get_table(table_id)
+        except NotFound:
+            return None
+
+    def __count_rows(self, table_id: str, where_clause: str = "") -> int:
+        rows = self.__client.query(f"SELECT COUNT(*) AS row_count FROM `{table_id}` {where_clause}").result()
+        return list(rows)[0]["row_count"]
+
+    def __rename_table(self, table_id: str, new_table_id: str):
+        self.__client.query(f"ALTER TABLE `{table_id}` RENAME TO `{new_table_id.split('.')[-1]}`").result()
+
+    def __create_table_definition(self, table_id: str = None) -> bigquery.Table:
+        table = bigquery.Table(self.__table_id if table_id is None else table_id, schema=DOCUMENT_METADATA_SCHEMA)
+        table.time_partitioning = bigquery.TimePartitioning(
+            type_=bigquery.TimePartitioningType.DAY,
+            field=PARTITION_FIELD
+        )
+        table.clustering_fields = CLUSTERING_FIELDS
+        return table
+
+    def __create_cast_expression(self, field: bigquery.SchemaField) -> str:
+        value = f"NULLIF(CAST(`{field.name}` AS STRING), 'None')"
+        if field.field_type == "STRING":
+            return value
+        if field.field_type == "BOOLEAN":
+            return f"{value} IN ('1', 'true')"
+        if field.field_type == "DATETIME":
+            # EDINETの日時は秒を含まない形式（YYYY-MM-DD hh:mm）のため、その形式でも変換できるようにする
+            return f"COALESCE(SAFE_CAST({value} AS DATETIME), SAFE.PARSE_DATETIME('%Y-%m-%d %H:%M', {value}))"
+        return f"SAFE_CAST({value} AS {field.field_type})"
+
+
+def to_parquet_table(df: pd.DataFrame) -> pa.Table:
+    table = pa.Table.from_pandas(df[PARQUET_SCHEMA.names], preserve_index=False)
+    return table.cast(PARQUET_SCHEMA)
+
+
+def to_date(d: date | datetime) -> date:
+    return d.date() if isinstance(d, datetime) else d
+
+
+def to_datetime(d: date | datetime) -> datetime:
+    return datetime(d.year, d.month, d.day)
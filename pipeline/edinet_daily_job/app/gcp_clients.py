@@ -0,0 +1,58 @@
+"""
+GCPのクライアントを、種類とプロジェクト単位でプロセス内に1つだけ保持するためのモジュール
+バックエンド（backend/app/gcp_util.pyのGcpClientRegistry）と同じ実装で、ジョブ内の全ての処理から共有する
+"""
+
+import os
+import threading
+from typing import Any, Callable, Dict
+
+import requests
+from google.cloud import bigquery, storage
+
+# クライアント毎に保持するHTTPコネクションの上限. 同時にGCPへアクセスするスレッド数以上にする
+DEFAULT_CONNECTION_POOL_SIZE = int(os.getenv("GCP_CONNECTION_POOL_SIZE", 32))
+
+
+class GcpClientRegistry:
+    def __init__(self, pool_size: int = DEFAULT_CONNECTION_POOL_SIZE) -> None:
+        self.__pool_size = pool_size
+        self.__lock = threading.Lock()
+        self.__clients: Dict[tuple, Any] = {}
+
+    def get_storage_client(self, project_id: str | None = None) -> storage.Client:
+        return self.__get_or_create(key=("storage", project_id),
+                                    create=lambda: storage.Client(project=project_id))
+
+    def get_bigquery_client(self, project_id: str | None = None) -> bigquery.Client:
+        return self.__get_or_create(key=("bigquery", project_id),
+                                    create=lambda: bigquery.Client(project=project_id))
+
+    def __get_or_create(self, key: tuple, create: Callable[[], Any]) -> Any:
+        client = self.__clients.get(key)
+        if client is not None:
+            return client
+
+        # 同じクライアントが複数のスレッドから同時に生成されないよう、ロックを取って再確認する
+        with self.__lock:
+            client = self.__clients.get(key)
+            if client is None:
+                client = create()
+                # requestsの既定のコネクションプール（10）では、並列に実行した際に再接続が発生する
+                http = getattr(client, "_http", None)
+                if isinstance(http, requests.Session):
+                    http.mount("https://", requests.adapters.HTTPAdapter(pool_connections=self.__pool_size,
+                                                                         pool_maxsize=self.__pool_size))
+                self.__clients[key] = client
+        return client
+
+
+client_registry = GcpClientRegistry()
+
+
+def get_storage_client(project_id: str | None = None) -> storage.Client:
+    return client_registry.get_storage_client(project_id=project_id)
+
+
+def get_bigquery_client(project_id: str | None = None) -> bigquery.Client:
+    return client_registry.get_bigquery_client(project_id=project_id)
@@ -0,0 +1,106 @@
+"""
+EDINETのドキュメント一覧をどの日付まで取り込んだか（ハイウォーターマーク）を保持するためのクラス群
+"""
+
+import json
+import os
+from abc import ABC, abstractmethod
+from datetime import datetime
+
+from google.cloud import bigquery
+
+from gcp_clients import get_bigquery_client
+
+
+class AbstractIngestionStateStore(ABC):
+    @abstractmethod
+    def get_last_ingested_date(self) -> datetime | None:
+        pass
+
+    @abstractmethod
+    def set_last_ingested_date(self, d: datetime):
+        pass
+
+
+class LocalIngestionStateStore(AbstractIngestionStateStore):
+    """ローカルのjsonファイルに取り込み状態を保存する（主にローカルでの動作確認用）"""
+
+    def __init__(self, state_file_path: str, table_id: str) -> None:
+        self.__state_file_path = state_file_path
+        self.__table_id = table_id
+
+    def get_last_ingested_date(self) -> datetime | None:
+        if not os.path.exists(self.__state_file_path):
+            return None
+
+        with open(self.__state_file_path, "r") as f:
+            states = json.load(f)
+        if self.__table_id not in states:
+            return None
+        return datetime.strptime(states[self.__table_id], "%Y-%m-%d")
+
+    def set_last_ingested_date(self, d: datetime):
+        states = {}
+        if os.path.exists(self.__state_file_path):
+            with open(self.__state_file_path, "r") as f:
+                states = json.load(f)
+        states[self.__table_id] = d.strftime("%Y-%m-%d")
+
+        # 書き込み途中で落ちても状態ファイルが壊れないよう、一時ファイルに書いてから置き換える
+        tmp_file_path = f"{self.__state_file_path}.tmp"
+        with open(tmp_file_path, "w") as f:
+            json.dump(states, f, indent=2)
+        os.replace(tmp_file_path, self.__state_file_path)
+
+
+class BigQueryIngestionStateStore(AbstractIngestionStateStore):
+    """BigQueryのメタデータテーブルに取り込み状態を保存する（Cloud Run Jobsはローカルディスクが揮発するため本番はこちらを使う）"""
+
+    def __init__(self, state_table_id: str, table_id: str, client: bigquery.Client = None) -> None:
+        self.__state_table_id = state_table_id
+        self.__table_id = table_id
+        self.__client = client if client is not None else get_bigquery_client()
+
+        # 状態管理用のテーブルがなければ作成する
+        schema = [
+            bigquery.SchemaField("table_id", "STRING", mode="REQUIRED"),
+            bigquery.SchemaField("last_ingested_date", "DATE", mode="REQUIRED"),
+            bigquery.SchemaField("updated_at", "TIMESTAMP", mode="REQUIRED"),
+        ]
+        self.__client.create_table(bigquery.Table(state_table_id, schema=schema), exists_ok=True)
+
+    def get_last_ingested_date(self) -> datetime | None:
+        query = f"""
+            SELECT last_ingested_date
+            FROM `{self.__state_table_id}`
+            WHERE table_id = @table_id
+            ORDER BY updated_at DESC
+            LIMIT 1
+        """
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ScalarQueryParameter("table_id", "STRING", self.__table_id)]
+        )
+        rows = list(self.__client.query(query, job_config=job_config).result())
+        if len(rows) == 0:
+            return None
+        d = rows[0]["last_ingested_date"]
+        return datetime(d.year, d.month, d.day)
+
+    def set_last_ingested_date(self, d: datetime):
+        query = f"""
+            MERGE `{self.__state_table_id}` T
+            USING (SELECT @table_id AS table_id, @last_ingested_date AS last_ingested_date) S
+            ON T.table_id = S.table_id
+            WHEN MATCHED THEN
+                UPDATE SET last_ingested_date = S.last_ingested_date, updated_at = CURRENT_TIMESTAMP()
+            WHEN NOT MATCHED THEN
+                INSERT (table_id, last_ingested_date, updated_at)
+                VALUES (S.table_id, S.last_ingested_date, CURRENT_TIMESTAMP())
+        """
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[
+                bigquery.ScalarQueryParameter("table_id", "STRING", self.__table_id),
+                bigquery.ScalarQueryParameter("last_ingested_date", "DATE", d.date()),
+            ]
+        )
+        self.__client.query(query, job_config=job_config).result()
@@ -1,57 +1,313 @@
 import os
 from dotenv import load_dotenv
-from google.cloud import bigquery
 from datetime import datetime, timedelta
+from typing import List
 
-from edinet_wrapper import EdinetWrapper
+import pandas as pd
+import pyarrow as pa
+
+from document_index import DocumentIndexStore, build_document_indexes
+from document_table import DocumentMetadataTable
+from edinet_wrapper import EdinetWrapper, GetDocumentListResult, concat_documents_tables
+from ingestion_state import AbstractIngestionStateStore, BigQueryIngestionStateStore, LocalIngestionStateStore
+from search_snapshot import export_search_snapshot
+
+
+FULL_INGESTION_MODE = "full"
+INCREMENTAL_INGESTION_MODE = "incremental"
 
 
 def main(duration_days: int,
          api_key: str,
          table_id: str,
          target_date: datetime,
-         force_delete_of_target_date: bool):
+         force_delete_of_target_date: bool,
+         max_workers: int = 1,
+         requests_per_second: float = 5.0,
+         ingestion_mode: str = FULL_INGESTION_MODE,
+         state_store: AbstractIngestionStateStore = None,
+         refetch_days: int = 3,
+         use_cache: bool = True,
+         pool_size: int = 10,
+         document_index_base_uri: str = None,
+         search_index_snapshot_uri: str = None,
+         streaming_batch_days: int = 0,
+         progress_store: AbstractIngestionStateStore = None):
+    # EDINETへの接続はジョブ全体で同じセッションを使い回す
+    with EdinetWrapper(
+        api_key=api_key,
+        output_folder=os.path.join(os.path.dirname(__file__), "output"),
+        max_workers=max_workers,
+        requests_per_second=requests_per_second,
+        use_cache=use_cache,
+        pool_size=pool_size
+    ) as edinet:
+        # パーティション分割・クラスタリングしたテーブルがなければ作成する（構成が異なる既存のテーブルは移行するまで取り込まない）
+        document_table = DocumentMetadataTable(table_id=table_id)
+        document_table.create_if_not_exists()
+
+        # 差分取り込みモードの場合、前回取り込み済みの日付以降のみを取得する
+        last_ingested_date = None
+        if ingestion_mode == INCREMENTAL_INGESTION_MODE:
+            last_ingested_date = state_store.get_last_ingested_date()
+            print(f"last ingested date is {last_ingested_date}")
+
+        # ストリーミングモードの場合、全期間のDataFrameを作らずに数日分ずつテーブルに反映する
+        if streaming_batch_days > 0:
+            target_dates = get_streaming_target_dates(duration_days=duration_days,
+                                                      target_date=target_date,
+                                                      last_ingested_date=last_ingested_date,
+                                                      refetch_days=refetch_days,
+                                                      force_delete_of_target_date=force_delete_of_target_date,
+                                                      document_table=document_table,
+                                                      progress_store=progress_store)
+            streaming_main(edinet=edinet,
+                           document_table=document_table,
+                           target_dates=target_dates,
+                           batch_days=streaming_batch_days,
+                           state_store=state_store,
+                           progress_store=progress_store if last_ingested_date is None else None,
+                           document_index_base_uri=document_index_base_uri,
+                           max_workers=max_workers)
+        else:
+            if last_ingested_date is not None:
+                df = incremental_main(edinet=edinet,
+                                      document_table=document_table,
+                                      target_date=target_date,
+                                      last_ingested_date=last_ingested_date,
+                                      state_store=state_store,
+                                      refetch_days=refetch_days,
+                                      max_workers=max_workers)
+            else:
+                df = full_main(edinet=edinet,
+                               duration_days=duration_days,
+                               document_table=document_table,
+                               target_date=target_date,
+                               force_delete_of_target_date=force_delete_of_target_date,
+                               state_store=state_store,
+                               max_workers=max_workers)
+
+            # 取り込んだ有価証券報告書のテキストを抽出しておき、解析の度にpdfを解析しなくて済むようにする
+            if document_index_base_uri:
+                build_document_index_of_reports(edinet=edinet,
+                                                df=df,
+                                                document_index_base_uri=document_index_base_uri,
+                                                max_workers=max_workers)
+
+    # バックエンドが企業名検索をBigQueryを使わずに行えるよう、検索用のスナップショットを出力する
+    if search_index_snapshot_uri:
+        print(f"start to export search snapshot into {search_index_snapshot_uri}")
+        rows = export_search_snapshot(table_id=table_id, snapshot_uri=search_index_snapshot_uri)
+        print(f"search snapshot rows = {rows}")
+
+
+def full_main(edinet: EdinetWrapper,
+              duration_days: int,
+              document_table: DocumentMetadataTable,
+              target_date: datetime,
+              force_delete_of_target_date: bool,
+              state_store: AbstractIngestionStateStore = None,
+              max_workers: int = 1) -> pd.DataFrame:
     # edinetから指定した日数分の有価証券報告書のリストをDataFrameで取得する
     print("start to get documents list from edinet. debug hogehoge")
-    edinet = EdinetWrapper(
-        api_key=api_key,
-        output_folder=os.path.join(os.path.dirname(__file__), "output")
-    )
     res = edinet.get_documents_list(
         duration_days=duration_days,
         target_date=target_date
     )
     df = res.df
+    print_documents_list_result(res=res)
 
-    # 日付単位でドキュメント一覧をループし、bigqueryから該当日付のレコードを削除して、追加し直す
-    # まずbigqueryのテーブルから該当日付のレコードを削除する（submitDateTimeでフィルタを行う）
+    # 取得に失敗した日付のレコードも残さない場合は、まず対象期間のパーティションを削除する
     if force_delete_of_target_date:
         print("start to delete records from bigquery..")
-        start_date = (target_date - timedelta(duration_days)).strftime("%Y-%m-%d")
-        end_date = target_date.strftime("%Y-%m-%d")
+        start_date = (target_date - timedelta(duration_days)).date()
+        end_date = target_date.date()
         print(f"start date is {start_date}, end_date is {end_date}")
+        document_table.delete_partitions(start_date=start_date, end_date=end_date)
 
-        client = bigquery.Client()
-        where_clause = f"submitDateTime BETWEEN '{start_date}' AND '{end_date}'"
-        delete_query = f"""
-            DELETE FROM `{table_id}`
-            WHERE {where_clause}
-        """
-        query_job = client.query(delete_query)
-        query_job.result()
-
-    # 次にEDINETから取得したデータをbigqueryに挿入する
-    print("start to insert documents list into bigquery")
-    client = bigquery.Client()
-    job_config = bigquery.LoadJobConfig(
-        write_disposition="WRITE_TRUNCATE"
-    )
-    job = client.load_table_from_dataframe(
-        df,
-        table_id,
-        job_config=job_config
+    # 次にEDINETから取得できた日付のパーティションを、取得したデータで置き換える
+    print("start to replace partitions of bigquery table")
+    document_table.replace_partitions(df=df, target_dates=res.get_success_dates(), max_workers=max_workers)
+
+    # 次回以降は差分取り込みができるよう、取り込み済みの日付を記録する
+    if state_store is not None:
+        state_store.set_last_ingested_date(get_next_high_water_mark(res=res, last_ingested_date=None))
+    return df
+
+
+def incremental_main(edinet: EdinetWrapper,
+                     document_table: DocumentMetadataTable,
+                     target_date: datetime,
+                     last_ingested_date: datetime,
+                     state_store: AbstractIngestionStateStore,
+                     refetch_days: int,
+                     max_workers: int = 1) -> pd.DataFrame:
+    # 提出後の訂正・取下げを拾えるよう、取り込み済みの日付から数日遡って再取得する
+    start_date = last_ingested_date - timedelta(days=refetch_days)
+    duration_days = max(1, (target_date.date() - start_date.date()).days + 1)
+    print(f"start to get documents list from edinet. start date is {start_date.strftime('%Y-%m-%d')}, "
+          f"duration days is {duration_days}")
+    res = edinet.get_documents_list(
+        duration_days=duration_days,
+        target_date=target_date
     )
-    job.result()
+    df = res.df
+    print_documents_list_result(res=res)
+
+    # 再取得した日付のパーティションのみを置き換え、テーブル全体の書き換えを避ける
+    print(f"start to replace partitions of {len(df)} records in bigquery")
+    document_table.replace_partitions(df=df, target_dates=res.get_success_dates(), max_workers=max_workers)
+
+    state_store.set_last_ingested_date(get_next_high_water_mark(res=res, last_ingested_date=last_ingested_date))
+    return df
+
+
+def get_streaming_target_dates(duration_days: int,
+                               target_date: datetime,
+                               last_ingested_date: datetime | None,
+                               refetch_days: int,
+                               force_delete_of_target_date: bool,
+                               document_table: DocumentMetadataTable,
+                               progress_store: AbstractIngestionStateStore = None) -> List[datetime]:
+    # 取り込み済みの日付を記録しながら進めるため、古い日付から順に取得する
+    if last_ingested_date is not None:
+        # 差分取り込みの場合は、取り込み状態自体が前回の続きとなる
+        start_date = last_ingested_date - timedelta(days=refetch_days)
+    else:
+        start_date = target_date - timedelta(days=duration_days - 1)
+        finished_date = progress_store.get_last_ingested_date() if progress_store is not None else None
+        if finished_date is not None and finished_date.date() >= start_date.date():
+            # 同じ日の全件取り込みが途中で終了していた場合は、取り込み済みの日付の翌日から再開する
+            print(f"resume streaming ingestion from the day after {finished_date.strftime('%Y-%m-%d')}")
+            start_date = finished_date + timedelta(days=1)
+        elif force_delete_of_target_date:
+            # 再開時に取り込み済みのパーティションを消さないよう、削除は最初の実行時のみ行う
+            print("start to delete records from bigquery..")
+            document_table.delete_partitions(start_date=start_date.date(), end_date=target_date.date())
+
+    duration_days = (target_date.date() - start_date.date()).days + 1
+    return [target_date - timedelta(days=day) for day in reversed(range(duration_days))]
+
+
+def streaming_main(edinet: EdinetWrapper,
+                   document_table: DocumentMetadataTable,
+                   target_dates: List[datetime],
+                   batch_days: int,
+                   state_store: AbstractIngestionStateStore = None,
+                   progress_store: AbstractIngestionStateStore = None,
+                   document_index_base_uri: str = None,
+                   max_workers: int = 1) -> int:
+    """
+    日付単位のドキュメント一覧を取得でき次第バッファに溜め、batch_days日分ごとにパーティションを置き換える
+    保持するのは1バッチ分のみのため、取り込む日数によらずメモリ使用量は一定となる
+    バッチを反映する度に取り込み済みの日付を記録し、途中で終了した場合も次回はその翌日から再開できるようにする
+    """
+    if len(target_dates) == 0:
+        print("there is no date to ingest")
+        return 0
+
+    print(f"start to stream documents list from {target_dates[0].strftime('%Y-%m-%d')} "
+          f"to {target_dates[-1].strftime('%Y-%m-%d')} in batches of {batch_days} days")
+    res = GetDocumentListResult(current_date=target_dates[-1])
+    tables = []
+    dates = []
+    rows = 0
+    # 取得に失敗した日付より後は、次回再取得させるため取り込み済みとしない
+    finished_date = None
+    has_error = False
+    for i, (t, table) in enumerate(edinet.iter_documents_tables(target_dates=target_dates,
+                                                                res=res,
+                                                                max_workers=max_workers)):
+        if table is None:
+            has_error = True
+        else:
+            tables.append(table)
+            dates.append(t)
+            if not has_error:
+                finished_date = t
+
+        if len(dates) < batch_days and i < len(target_dates) - 1:
+            continue
+        if len(dates) > 0:
+            rows += load_streaming_batch(edinet=edinet,
+                                         document_table=document_table,
+                                         tables=tables,
+                                         dates=dates,
+                                         document_index_base_uri=document_index_base_uri,
+                                         max_workers=max_workers)
+        tables = []
+        dates = []
+        if finished_date is not None:
+            if state_store is not None:
+                state_store.set_last_ingested_date(finished_date)
+            if progress_store is not None:
+                progress_store.set_last_ingested_date(finished_date)
+
+    print_documents_list_result(res=res)
+    print(f"streaming ingestion is finished. rows = {rows}")
+    return rows
+
+
+def load_streaming_batch(edinet: EdinetWrapper,
+                         document_table: DocumentMetadataTable,
+                         tables: List[pa.Table],
+                         dates: List[datetime],
+                         document_index_base_uri: str = None,
+                         max_workers: int = 1) -> int:
+    df = concat_documents_tables(list(zip(dates, tables)))
+    print(f"start to replace partitions from {dates[0].strftime('%Y-%m-%d')} to {dates[-1].strftime('%Y-%m-%d')}. "
+          f"rows = {len(df)}")
+    rows = document_table.replace_partitions(df=df, target_dates=dates, max_workers=max_workers)
+    if document_index_base_uri:
+        build_document_index_of_reports(edinet=edinet,
+                                        df=df,
+                                        document_index_base_uri=document_index_base_uri,
+                                        max_workers=max_workers)
+    return rows
+
+
+def build_document_index_of_reports(edinet: EdinetWrapper,
+                                    df: pd.DataFrame,
+                                    document_index_base_uri: str,
+                                    max_workers: int = 1):
+    # バックエンドの検索対象と同じく、pdfのある有価証券報告書のみを対象とする
+    if len(df) == 0:
+        return
+    target_df = df[df["docDescription"].str.contains("有価証券報告書", na=False) & df["pdfFlag"].fillna(False)]
+    print(f"start to build document index of {len(target_df)} reports into {document_index_base_uri}")
+    counts = build_document_indexes(edinet=edinet,
+                                    doc_ids=target_df["docID"].tolist(),
+                                    index_store=DocumentIndexStore(base_uri=document_index_base_uri),
+                                    max_workers=max_workers)
+    print(f"success count = {counts['success']}, skipped count = {counts['skipped']}, "
+          f"error count = {counts['error']}")
+
+
+def print_documents_list_result(res: GetDocumentListResult):
+    print(f"success count = {res.get_success_counts()}, error count = {res.get_error_counts()}")
+    print(f"cache hit count = {res.get_cache_hit_counts()}, cache miss count = {res.get_cache_miss_counts()}")
+
+
+def get_next_high_water_mark(res: GetDocumentListResult, last_ingested_date: datetime | None) -> datetime:
+    # 取得に失敗した日付は次回再取得させるため、最も古い失敗日の前日までを取り込み済みとする
+    error_dates = res.get_error_dates()
+    if len(error_dates) == 0:
+        return res.current_date
+
+    next_date = min(error_dates) - timedelta(days=1)
+    if last_ingested_date is not None:
+        next_date = max(next_date, last_ingested_date)
+    return next_date
+
+
+def create_state_store(table_id: str) -> AbstractIngestionStateStore:
+    state_table_id = os.getenv("STATE_TABLE_ID")
+    if state_table_id:
+        return BigQueryIngestionStateStore(state_table_id=state_table_id, table_id=table_id)
+
+    state_file = os.getenv("STATE_FILE", os.path.join(os.path.dirname(__file__), "output", "ingestion_state.json"))
+    os.makedirs(os.path.dirname(state_file), exist_ok=True)
+    return LocalIngestionStateStore(state_file_path=state_file, table_id=table_id)
 
 
 if __name__ == "__main__":
@@ -62,11 +318,36 @@ if __name__ == "__main__":
     duration_days = int(os.getenv("DURATION_DAYS", 365))
     delete_flag = bool(os.getenv("DELETE_FLAG", 0))
     table_id = os.environ["TABLE_ID"]
+    max_workers = int(os.getenv("MAX_WORKERS", 4))
+    requests_per_second = float(os.getenv("REQUESTS_PER_SECOND", 5.0))
+    ingestion_mode = os.getenv("INGESTION_MODE", FULL_INGESTION_MODE)
+    refetch_days = int(os.getenv("REFETCH_DAYS", 3))
+    use_cache = os.getenv("USE_CACHE", "1") == "1"
+    pool_size = int(os.getenv("POOL_SIZE", 10))
+    document_index_base_uri = os.getenv("DOCUMENT_INDEX_BASE_URI")
+    search_index_snapshot_uri = os.getenv("SEARCH_INDEX_SNAPSHOT_URI")
+    streaming_batch_days = int(os.getenv("STREAMING_BATCH_DAYS") or 0)
     target_date = datetime.now()
+
+    # 全件取り込みの途中経過は、同じ日の再実行（Cloud Run Jobsのリトライなど）でのみ再開に使う
+    progress_store = None
+    if streaming_batch_days > 0:
+        progress_store = create_state_store(table_id=f"{table_id}:streaming:{target_date.strftime('%Y%m%d')}")
     main(duration_days=duration_days,
          api_key=api_key,
          table_id=table_id,
          target_date=target_date,
-         force_delete_of_target_date=delete_flag)
+         force_delete_of_target_date=delete_flag,
+         max_workers=max_workers,
+         requests_per_second=requests_per_second,
+         ingestion_mode=ingestion_mode,
+         state_store=create_state_store(table_id=table_id),
+         refetch_days=refetch_days,
+         use_cache=use_cache,
+         pool_size=pool_size,
+         document_index_base_uri=document_index_base_uri,
+         search_index_snapshot_uri=search_index_snapshot_uri,
+         streaming_batch_days=streaming_batch_days,
+         progress_store=progress_store)
 
     print("--- end edinet script job ---")
@@ -0,0 +1,37 @@
+"""
+パーティション分割されていない、または列の型が異なる以前のedinet_document_metadataを、
+パーティション分割・クラスタリング済みのテーブルに移行するための一回限りのコマンド
+日次ジョブからは実行しない. 元のテーブルは{TABLE_ID}_backupに退避され、移行後に内容を確認してから手動で削除する
+
+実行例:
+    python app/migrate_document_table.py --dry_run
+    python app/migrate_document_table.py
+"""
+
+import os
+from argparse import ArgumentParser
+
+from dotenv import load_dotenv
+
+from document_table import DocumentMetadataTable
+from gcp_clients import get_bigquery_client
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--table_id", type=str, default=None, help="未指定の場合は環境変数のTABLE_IDを使う")
+    parser.add_argument("--dry_run", action="store_true", help="テーブルの構成の差分のみを表示し、移行は行わない")
+    args = parser.parse_args()
+
+    load_dotenv()
+    table_id = args.table_id if args.table_id is not None else os.environ["TABLE_ID"]
+    document_table = DocumentMetadataTable(table_id=table_id)
+
+    mismatches = document_table.get_layout_mismatches(table=get_bigquery_client().get_table(table_id))
+    if len(mismatches) == 0:
+        print(f"{table_id} is already migrated.")
+    elif args.dry_run:
+        print(f"{table_id} needs to be migrated. {', '.join(mismatches)}")
+    else:
+        rows = document_table.migrate_to_partitioned_table()
+        print(f"{table_id} is migrated. rows = {rows}, backup table is {document_table.get_backup_table_id()}")
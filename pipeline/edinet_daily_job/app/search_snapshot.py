@@ -0,0 +1,39 @@
+"""
+バックエンドの企業名検索で利用するスナップショットを、BigQueryのテーブルからParquet形式で出力するためのモジュール
+バックエンド（backend/app/company_search_index.py）はスナップショットの更新を検知し、検索用の索引を作り直す
+"""
+
+import os
+from io import BytesIO
+
+from gcp_clients import get_bigquery_client, get_storage_client
+
+# バックエンドの索引で利用する列（backend/app/company_search_index.pyのSEARCH_SNAPSHOT_COLUMNSと同じ）
+SEARCH_SNAPSHOT_COLUMNS = ["docID", "filerName", "docDescription", "submitDateTime", "pdfFlag"]
+
+
+def export_search_snapshot(table_id: str, snapshot_uri: str) -> int:
+    # 有価証券報告書（120）と訂正有価証券報告書（130）に絞ることで、クラスタリングされたブロックのみを読み込む
+    # 差分取り込みの場合も検索対象は全期間のため、取り込んだ分ではなくテーブル全体から出力する
+    query = f"""
+        SELECT {", ".join(SEARCH_SNAPSHOT_COLUMNS)}
+        FROM `{table_id}`
+        WHERE docTypeCode IN ("120", "130") AND CONTAINS_SUBSTR(docDescription, "有価証券報告書")
+    """
+    df = get_bigquery_client().query(query).to_dataframe()
+    data = BytesIO()
+    df.to_parquet(data, index=False, compression="zstd")
+
+    if snapshot_uri.startswith("gs://"):
+        # GCSのオブジェクトの置き換えは1回のアップロードで完了するため、読み込み側が書き込み途中のファイルを読むことはない
+        bucket_name, remote_file_path = snapshot_uri[len("gs://"):].split("/", 1)
+        blob = get_storage_client().bucket(bucket_name).blob(remote_file_path)
+        data.seek(0)
+        blob.upload_from_file(data, content_type="application/vnd.apache.parquet")
+    else:
+        os.makedirs(os.path.dirname(os.path.abspath(snapshot_uri)), exist_ok=True)
+        tmp_uri = f"{snapshot_uri}.tmp"
+        with open(tmp_uri, "wb") as f:
+            f.write(data.getvalue())
+        os.replace(tmp_uri, snapshot_uri)
+    return len(df)
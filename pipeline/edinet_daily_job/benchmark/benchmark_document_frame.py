@@ -0,0 +1,89 @@
+"""
+ドキュメント一覧のDataFrameについて、以前の方式（object型を全て文字列に変換）と、
+型を宣言したArrowベースの方式の作成時間・メモリ使用量・Parquetへの書き出し時間を比較するベンチマーク
+
+実行例:
+    python benchmark/benchmark_document_frame.py --duration_days 365 --documents_per_day 1000
+"""
+
+import os
+import sys
+import time
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from io import BytesIO
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from document_table import to_parquet_table  # noqa: E402
+from edinet_wrapper import to_documents_dataframe, to_documents_table  # noqa: E402
+from fake_edinet_server import FakeEdinetServer  # noqa: E402
+
+
+def create_documents_list(duration_days: int, documents_per_day: int) -> list:
+    server = FakeEdinetServer(documents_per_day=documents_per_day)
+    target_date = datetime.now()
+    documents_list = []
+    for day in range(duration_days):
+        date_str = (target_date - timedelta(days=day)).strftime("%Y-%m-%d")
+        documents_list.append(server.create_documents_json(date_str)["results"])
+    return documents_list
+
+
+def run_legacy(documents_list: list) -> dict:
+    start = time.perf_counter()
+    dfs = []
+    for documents in documents_list:
+        df = pd.DataFrame(documents)
+        df["submitDateTime"] = pd.to_datetime(df["submitDateTime"])
+        dfs.append(df)
+    df = pd.concat(dfs, ignore_index=True)
+    for col in df.columns:
+        if df[col].dtype == "object":
+            df[col] = df[col].astype(object).astype(str)
+    build_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    data = BytesIO()
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), data)
+    return {
+        "build_seconds": build_seconds,
+        "memory_bytes": df.memory_usage(deep=True).sum(),
+        "parquet_seconds": time.perf_counter() - start,
+        "parquet_bytes": len(data.getvalue()),
+    }
+
+
+def run_typed(documents_list: list) -> dict:
+    start = time.perf_counter()
+    df = to_documents_dataframe(pa.concat_tables([to_documents_table(documents) for documents in documents_list]))
+    build_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    data = BytesIO()
+    pq.write_table(to_parquet_table(df), data, compression="zstd")
+    return {
+        "build_seconds": build_seconds,
+        "memory_bytes": df.memory_usage(deep=True).sum(),
+        "parquet_seconds": time.perf_counter() - start,
+        "parquet_bytes": len(data.getvalue()),
+    }
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--duration_days", type=int, default=365)
+    parser.add_argument("--documents_per_day", type=int, default=1000)
+    args = parser.parse_args()
+
+    documents_list = create_documents_list(duration_days=args.duration_days, documents_per_day=args.documents_per_day)
+    results = {"legacy": run_legacy(documents_list), "typed": run_typed(documents_list)}
+
+    print("mode\tbuild[s]\tmemory[MB]\tparquet[s]\tparquet[MB]")
+    for mode, r in results.items():
+        print(f"{mode}\t{r['build_seconds']:.2f}\t{r['memory_bytes'] / 1024 ** 2:.1f}\t"
+              f"{r['parquet_seconds']:.2f}\t{r['parquet_bytes'] / 1024 ** 2:.2f}")
@@ -0,0 +1,63 @@
+"""
+EdinetWrapper.get_documents_listの実行時間を、ローカルの疑似EDINETサーバーに対して計測するベンチマーク
+
+実行例:
+    python benchmark/benchmark_get_documents_list.py --duration_days 60 --latency 0.2 --max_workers 1 4 8
+"""
+
+import os
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from datetime import datetime
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from edinet_wrapper import EdinetWrapper  # noqa: E402
+from fake_edinet_server import FakeEdinetServer  # noqa: E402
+
+
+def run(duration_days: int, latency: float, max_workers: int, requests_per_second: float) -> dict:
+    with FakeEdinetServer(latency_seconds=latency) as server, tempfile.TemporaryDirectory() as output_folder:
+        edinet = EdinetWrapper(
+            api_key="dummy",
+            output_folder=output_folder,
+            max_workers=max_workers,
+            requests_per_second=requests_per_second,
+            document_list_url=server.document_list_url,
+            document_base_url=server.document_base_url
+        )
+        start = time.perf_counter()
+        res = edinet.get_documents_list(duration_days=duration_days, target_date=datetime.now())
+        elapsed = time.perf_counter() - start
+        return {
+            "max_workers": max_workers,
+            "elapsed_seconds": elapsed,
+            "success_count": res.get_success_counts(),
+            "error_count": res.get_error_counts(),
+            "rows": len(res.df),
+            "requests": server.request_count,
+        }
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--duration_days", type=int, default=60)
+    parser.add_argument("--latency", type=float, default=0.2, help="疑似サーバーの1リクエストあたりの応答遅延（秒）")
+    parser.add_argument("--requests_per_second", type=float, default=0, help="0の場合はレート制限を行わない")
+    parser.add_argument("--max_workers", type=int, nargs="+", default=[1, 4, 8])
+    args = parser.parse_args()
+
+    results = []
+    for workers in args.max_workers:
+        results.append(run(duration_days=args.duration_days,
+                           latency=args.latency,
+                           max_workers=workers,
+                           requests_per_second=args.requests_per_second))
+
+    baseline = results[0]["elapsed_seconds"]
+    print("max_workers\telapsed[s]\tspeedup\tsuccess\terror\trows\trequests")
+    for r in results:
+        print(f"{r['max_workers']}\t{r['elapsed_seconds']:.2f}\t{baseline / r['elapsed_seconds']:.2f}x\t"
+              f"{r['success_count']}\t{r['error_count']}\t{r['rows']}\t{r['requests']}")
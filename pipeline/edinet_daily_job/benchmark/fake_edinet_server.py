@@ -0,0 +1,144 @@
+"""
+ベンチマーク用に、EDINET APIの挙動を模したローカルサーバー
+documents.json（書類一覧）とdocuments/{doc_id}（書類取得）のみを実装している
+"""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeEdinetServer:
+    def __init__(self,
+                 latency_seconds: float = 0.1,
+                 documents_per_day: int = 50,
+                 pdf_size_bytes: int = 1024 * 1024,
+                 host: str = "127.0.0.1",
+                 port: int = 0) -> None:
+        self.latency_seconds = latency_seconds
+        self.documents_per_day = documents_per_day
+        self.pdf_size_bytes = pdf_size_bytes
+        self.request_count = 0
+        self.__lock = threading.Lock()
+        self.__server = ThreadingHTTPServer((host, port), self.__create_handler())
+        self.__server.daemon_threads = True
+        self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.__server.server_address[:2]
+        return f"http://{host}:{port}/api/v2"
+
+    @property
+    def document_list_url(self) -> str:
+        return f"{self.base_url}/documents.json"
+
+    @property
+    def document_base_url(self) -> str:
+        return f"{self.base_url}/documents"
+
+    def start(self):
+        self.__thread.start()
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def count_request(self):
+        with self.__lock:
+            self.request_count += 1
+
+    def create_documents_json(self, date_str: str) -> dict:
+        results = []
+        for i in range(self.documents_per_day):
+            results.append({
+                "seqNumber": i + 1,
+                "docID": f"S{date_str.replace('-', '')}{i:04d}",
+                "edinetCode": f"E{i:05d}",
+                "secCode": None,
+                "JCN": None,
+                "filerName": f"サンプル株式会社{i}",
+                "fundCode": None,
+                "ordinanceCode": "010",
+                "formCode": "030000",
+                "docTypeCode": "120",
+                "periodStart": None,
+                "periodEnd": None,
+                "submitDateTime": f"{date_str} 09:00",
+                "docDescription": "有価証券報告書",
+                "issuerEdinetCode": None,
+                "subjectEdinetCode": None,
+                "subsidiaryEdinetCode": None,
+                "currentReportReason": None,
+                "parentDocID": None,
+                "opeDateTime": None,
+                "withdrawalStatus": "0",
+                "docInfoEditStatus": "0",
+                "disclosureStatus": "0",
+                "xbrlFlag": "1",
+                "pdfFlag": "1",
+                "attachDocFlag": "0",
+                "englishDocFlag": "0",
+                "csvFlag": "1",
+                "legalStatus": "1",
+            })
+        return {
+            "metadata": {"status": "200", "message": "OK", "resultset": {"count": len(results)}},
+            "results": results,
+        }
+
+    def __create_handler(self):
+        fake_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake_server.count_request()
+                time.sleep(fake_server.latency_seconds)
+
+                url = urlparse(self.path)
+                if url.path.endswith("/documents.json"):
+                    date_str = parse_qs(url.query).get("date", ["1970-01-01"])[0]
+                    body = json.dumps(fake_server.create_documents_json(date_str)).encode("utf-8")
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                elif "/documents/" in url.path:
+                    body = b"%PDF-1.4\n" + b"0" * max(0, fake_server.pdf_size_bytes - 9)
+
+                    # 再開ダウンロードの検証用に、Rangeヘッダー（bytes=start-の形式のみ）に対応する
+                    range_header = self.headers.get("Range")
+                    if range_header is not None and range_header.startswith("bytes="):
+                        start = int(range_header[len("bytes="):].split("-")[0])
+                        if start >= len(body):
+                            self.send_response(416)
+                            self.end_headers()
+                            return
+                        self.send_response(206)
+                        self.send_header("Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}")
+                        body = body[start:]
+                    else:
+                        self.send_response(200)
+                    self.send_header("Content-Type", "application/pdf")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                else:
+                    self.send_response(404)
+                    self.end_headers()
+
+            def log_message(self, format, *args):
+                # ベンチマークの出力を汚さないようにアクセスログは出力しない
+                pass
+
+        return Handler
@@ -0,0 +1,179 @@
+import os
+import re
+import sys
+from datetime import datetime
+
+import pyarrow.parquet as pq
+import pytest
+from google.api_core.exceptions import NotFound
+from google.cloud import bigquery
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from document_table import DOCUMENT_METADATA_SCHEMA, DocumentMetadataTable  # noqa: E402
+from edinet_wrapper import concat_documents_tables, to_documents_table  # noqa: E402
+
+
+TABLE_ID = "project.dataset.edinet_document_metadata"
+
+
+class FakeJob:
+    def __init__(self, rows: list = None) -> None:
+        self.__rows = rows if rows is not None else []
+
+    def result(self) -> list:
+        return self.__rows
+
+
+class FakeBigQueryClient:
+    # ロードされたParquetを、ロード先（パーティションデコレーター付きのテーブルID）単位で保持する
+    # テーブルはテーブルID -> (bigquery.Table, 件数)で保持し、件数の取得とテーブル名の変更のクエリのみを解釈する
+    def __init__(self, tables: dict = None, copied_rows: int | None = None) -> None:
+        self.loaded = {}
+        self.queries = []
+        self.tables = tables if tables is not None else {}
+        self.__copied_rows = copied_rows
+
+    def load_table_from_file(self, data, destination: str, job_config=None) -> FakeJob:
+        self.loaded[destination] = pq.read_table(data).to_pylist()
+        return FakeJob()
+
+    def get_table(self, table_id: str) -> bigquery.Table:
+        if table_id not in self.tables:
+            raise NotFound(f"{table_id} is not found.")
+        return self.tables[table_id][0]
+
+    def create_table(self, table: bigquery.Table, exists_ok: bool = False) -> bigquery.Table:
+        self.tables[f"{table.project}.{table.dataset_id}.{table.table_id}"] = (table, 0)
+        return table
+
+    def query(self, query: str, job_config=None) -> FakeJob:
+        query = query.strip()
+        self.queries.append(query)
+        if query.startswith("INSERT INTO"):
+            table_id = re.search(r"INSERT INTO `(.+?)`", query).group(1)
+            source_table_id = re.search(r"FROM `(.+?)`", query).group(1)
+            rows = self.__copied_rows if self.__copied_rows is not None else self.tables[source_table_id][1]
+            self.tables[table_id] = (self.tables[table_id][0], rows)
+        elif query.startswith("SELECT COUNT(*)"):
+            table_id = re.search(r"FROM `(.+?)`", query).group(1)
+            return FakeJob(rows=[{"row_count": self.tables[table_id][1]}])
+        elif query.startswith("ALTER TABLE"):
+            table_id, new_table_name = re.search(r"ALTER TABLE `(.+?)` RENAME TO `(.+?)`", query).groups()
+            new_table_id = f"{table_id.rsplit('.', 1)[0]}.{new_table_name}"
+            self.tables[new_table_id] = self.tables.pop(table_id)
+        return FakeJob()
+
+
+def create_legacy_table(extra_columns: list = None) -> bigquery.Table:
+    # パーティション分割されておらず、全ての列が文字列の以前のテーブル
+    schema = [bigquery.SchemaField(field.name, "STRING") for field in DOCUMENT_METADATA_SCHEMA]
+    schema += [bigquery.SchemaField(col, "STRING") for col in (extra_columns if extra_columns is not None else [])]
+    return bigquery.Table(TABLE_ID, schema=schema)
+
+
+def create_document(doc_id: str, withdrawal_status: str) -> dict:
+    return {
+        "seqNumber": 1,
+        "docID": doc_id,
+        "filerName": "テスト株式会社",
+        "docTypeCode": "120",
+        "submitDateTime": "2024-06-03 09:00",
+        "withdrawalStatus": withdrawal_status,
+    }
+
+
+@pytest.mark.parametrize("newest_first", [True, False])
+def test_replace_partitions_uses_newest_listing(newest_first):
+    # 6/3に提出された書類が、6/5に取り下げられて6/5の一覧にも載っている
+    dated_tables = [
+        (datetime(2024, 6, 3), to_documents_table([create_document("S100TEST", "0"), create_document("S100KEEP", "0")])),
+        (datetime(2024, 6, 4), to_documents_table([])),
+        (datetime(2024, 6, 5), to_documents_table([create_document("S100TEST", "1")])),
+    ]
+    if newest_first:
+        dated_tables = list(reversed(dated_tables))
+    df = concat_documents_tables(dated_tables)
+
+    client = FakeBigQueryClient()
+    document_table = DocumentMetadataTable(table_id=TABLE_ID, client=client)
+    rows = document_table.replace_partitions(df=df, target_dates=[t for t, _ in dated_tables], max_workers=2)
+
+    # 一覧の連結順によらず、取下げ後の内容で提出日のパーティションが置き換えられる
+    assert rows == 2
+    loaded = client.loaded[f"{TABLE_ID}$20240603"]
+    assert {row["docID"]: row["withdrawalStatus"] for row in loaded} == {"S100TEST": "1", "S100KEEP": "0"}
+    assert "listingDate" not in loaded[0]
+
+    # 提出書類のない日付・取下げの日付のパーティションは、空として置き換える
+    assert len(client.queries) == 2
+
+
+def test_create_if_not_exists_creates_missing_table():
+    client = FakeBigQueryClient()
+    DocumentMetadataTable(table_id=TABLE_ID, client=client).create_if_not_exists()
+
+    table = client.get_table(TABLE_ID)
+    assert table.time_partitioning.field == "submitDateTime"
+
+
+def test_create_if_not_exists_does_not_migrate_existing_table():
+    # 構成の異なる既存のテーブルは、ジョブからは作り直さずにエラーとする
+    client = FakeBigQueryClient(tables={TABLE_ID: (create_legacy_table(), 100)})
+    with pytest.raises(Exception, match="migrate_document_table.py"):
+        DocumentMetadataTable(table_id=TABLE_ID, client=client).create_if_not_exists()
+
+    assert client.queries == []
+    assert list(client.tables) == [TABLE_ID]
+
+
+def test_create_if_not_exists_allows_extra_columns():
+    client = FakeBigQueryClient()
+    document_table = DocumentMetadataTable(table_id=TABLE_ID, client=client)
+    document_table.create_if_not_exists()
+    table = client.get_table(TABLE_ID)
+    table.schema = list(table.schema) + [bigquery.SchemaField("memo", "STRING")]
+
+    document_table.create_if_not_exists()
+
+
+def test_create_if_not_exists_stops_after_interrupted_migration():
+    # 移行が途中で終了し、元のテーブルが退避されたままの場合は、空のテーブルを作らない
+    client = FakeBigQueryClient(tables={f"{TABLE_ID}_backup": (create_legacy_table(), 100)})
+    with pytest.raises(Exception, match="_backup exists"):
+        DocumentMetadataTable(table_id=TABLE_ID, client=client).create_if_not_exists()
+
+    assert TABLE_ID not in client.tables
+
+
+def test_migrate_to_partitioned_table():
+    client = FakeBigQueryClient(tables={TABLE_ID: (create_legacy_table(extra_columns=["memo"]), 100)})
+    document_table = DocumentMetadataTable(table_id=TABLE_ID, client=client)
+
+    assert document_table.migrate_to_partitioned_table() == 100
+
+    # 元のテーブルは削除せずに退避し、追加された列も退避したテーブルに残る
+    assert set(client.tables) == {TABLE_ID, f"{TABLE_ID}_backup"}
+    assert client.get_table(TABLE_ID).time_partitioning.field == "submitDateTime"
+    assert "memo" in [field.name for field in client.get_table(f"{TABLE_ID}_backup").schema]
+    assert not any("DROP TABLE" in query for query in client.queries)
+    assert document_table.get_layout_mismatches(table=client.get_table(TABLE_ID)) == []
+
+
+def test_migrate_to_partitioned_table_stops_if_row_count_differs():
+    client = FakeBigQueryClient(tables={TABLE_ID: (create_legacy_table(), 100)}, copied_rows=99)
+    with pytest.raises(Exception, match="is not changed"):
+        DocumentMetadataTable(table_id=TABLE_ID, client=client).migrate_to_partitioned_table()
+
+    # 元のテーブルはそのまま残り、作業用のテーブルは確認のために残す
+    assert client.get_table(TABLE_ID).time_partitioning is None
+    assert f"{TABLE_ID}_backup" not in client.tables
+
+
+def test_migrate_to_partitioned_table_does_not_delete_previous_tables():
+    client = FakeBigQueryClient(tables={TABLE_ID: (create_legacy_table(), 100),
+                                        f"{TABLE_ID}_partitioned": (create_legacy_table(), 100)})
+    with pytest.raises(Exception, match="already exists"):
+        DocumentMetadataTable(table_id=TABLE_ID, client=client).migrate_to_partitioned_table()
+
+    assert client.queries == []
@@ -0,0 +1,100 @@
+import os
+import sys
+from datetime import datetime
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "app"))
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "benchmark"))
+
+from edinet_wrapper import EdinetWrapper, get_retry_wait_seconds  # noqa: E402
+from fake_edinet_server import FakeEdinetServer  # noqa: E402
+from main import get_next_high_water_mark  # noqa: E402
+
+
+class WeekdayOnlyEdinetServer(FakeEdinetServer):
+    # 土日は提出書類がなく、resultsが空となる
+    def create_documents_json(self, date_str: str) -> dict:
+        documents_json = super().create_documents_json(date_str)
+        if datetime.strptime(date_str, "%Y-%m-%d").weekday() >= 5:
+            documents_json["results"] = []
+            documents_json["metadata"]["resultset"]["count"] = 0
+        return documents_json
+
+
+def test_get_documents_list_over_weekend(tmp_path):
+    # 2024-06-07（金）から2024-06-11（火）までの5日間
+    target_date = datetime(2024, 6, 11)
+    with WeekdayOnlyEdinetServer(latency_seconds=0.0, documents_per_day=3) as server:
+        with EdinetWrapper(api_key="dummy",
+                           output_folder=str(tmp_path),
+                           max_workers=2,
+                           requests_per_second=0,
+                           use_cache=False,
+                           document_list_url=server.document_list_url,
+                           document_base_url=server.document_base_url) as edinet:
+            res = edinet.get_documents_list(duration_days=5, target_date=target_date)
+
+    assert res.get_success_counts() == 5
+    assert res.get_error_counts() == 0
+    assert len(res.df) == 3 * 3
+    assert set(res.df["submitDateTime"].dt.strftime("%Y-%m-%d")) == {"2024-06-07", "2024-06-10", "2024-06-11"}
+
+    # 土日を挟んでも、ハイウォーターマークは実行日まで進む
+    assert get_next_high_water_mark(res=res, last_ingested_date=datetime(2024, 6, 6)) == target_date
+
+
+class CountingRateLimiter:
+    def __init__(self) -> None:
+        self.count = 0
+
+    def wait(self):
+        self.count += 1
+
+
+class FakeResponse:
+    def __init__(self, status_code: int, headers: dict = None, json_data: dict = None) -> None:
+        self.status_code = status_code
+        self.headers = headers if headers is not None else {}
+        self.__json_data = json_data
+
+    def json(self) -> dict:
+        return self.__json_data
+
+    def close(self):
+        pass
+
+
+class FakeSession:
+    def __init__(self, responses: list) -> None:
+        self.responses = responses
+        self.count = 0
+
+    def get(self, url: str, **kwargs) -> FakeResponse:
+        self.count += 1
+        return self.responses.pop(0)
+
+    def close(self):
+        pass
+
+
+def test_retry_goes_through_rate_limiter(tmp_path):
+    json_data = {"metadata": {"status": "200"}, "results": []}
+    session = FakeSession([FakeResponse(429, headers={"Retry-After": "0"}),
+                           FakeResponse(503),
+                           FakeResponse(200, json_data=json_data)])
+    rate_limiter = CountingRateLimiter()
+    edinet = EdinetWrapper(api_key="dummy", output_folder=str(tmp_path), use_cache=False, backoff_factor=0.0)
+    edinet._EdinetWrapper__session = session
+    edinet._EdinetWrapper__rate_limiter = rate_limiter
+
+    df = edinet.get_documents_info_dataframe(target_date=datetime(2024, 6, 8))
+
+    # 再試行を含めた全てのリクエストが、RateLimiterを経由する
+    assert len(df) == 0
+    assert session.count == 3
+    assert rate_limiter.count == 3
+
+
+def test_get_retry_wait_seconds():
+    assert get_retry_wait_seconds(attempt=2, backoff_factor=1.0) == 4.0
+    assert get_retry_wait_seconds(attempt=0, backoff_factor=1.0, retry_after="10") == 10.0
+    assert get_retry_wait_seconds(attempt=0, backoff_factor=1.0, retry_after="invalid") == 1.0
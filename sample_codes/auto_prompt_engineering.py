@@ -0,0 +1,515 @@
+"""
+Auto Prompt Engineeringのループ（Generator → Evaluator → Rewriter）を、有価証券報告書の分析に
+再利用できる形でまとめたモジュールです.
+
+- 有価証券報告書（PDF）毎のループは互いに独立しているため、スレッドプールで並列に実行します
+- Evaluatorの出力するスコアが改善しなくなった時点で、そのPDFのループを打ち切ります
+- 同じ（プロンプト, PDF）の組み合わせの分析結果はメモ化し、LLMを再度呼び出しません
+- イテレーション毎の各処理の所要時間をInternalLogに記録します
+
+利用例はauto_prompt_engineering_sample.pyを参照してください.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List
+
+
+DEFAULT_MODEL_NAME = "gemini-1.5-flash"
+
+# Evaluatorには、評価の最後にスコアを「スコア: 80」の形式で出力させる
+SCORE_PATTERN = re.compile(r"スコア\s*[:：]\s*(\d{1,3})")
+
+
+class InternalLog:
+    def __init__(self) -> None:
+        # 複数のPDFのループから同時に書き込まれるため、ロックを取って更新する
+        self.__lock = threading.Lock()
+        self.__queue = []
+        self.__latest_prompts = {}
+
+    def set_log(self,
+                pdf_uri: str,
+                iter_count: int,
+                analyze_result: str,
+                evaluate_result: str,
+                analyze_prompt: str,
+                score: int | None = None,
+                is_cached_result: bool = False,
+                timings: Dict[str, float] = {}) -> dict:
+        item = {
+            "pdf_uri": pdf_uri,
+            "iter_count": iter_count,
+            "analyze_result": analyze_result,
+            "evaluate_result": evaluate_result,
+            "analyze_prompt": analyze_prompt,
+            "score": score,
+            "is_cached_result": is_cached_result,
+            "timings": dict(timings)
+        }
+        with self.__lock:
+            self.__queue.append(item)
+        return item
+
+    def set_latest_prompt(self, pdf_uri: str, prompt: str):
+        with self.__lock:
+            self.__latest_prompts[pdf_uri] = prompt
+
+    def set_final_analysis_prompt(self, prompt: str, elapsed_seconds: float | None = None):
+        with self.__lock:
+            self.__queue.append(
+                {
+                    "analyze_final_prompt": prompt,
+                    "timings": {"generalize_seconds": elapsed_seconds}
+                }
+            )
+
+    def print_log(self, item: dict):
+        lines = [
+            "=======================================",
+            f"iter_count: {item['iter_count']}",
+            "=======================================",
+            f"pdf_uri: {item['pdf_uri']}",
+            "=======================================",
+            f"analyze_result: {item['analyze_result']}",
+            "=======================================",
+            f"evaluate_result: {item['evaluate_result']}",
+            "=======================================",
+            f"analyze_prompt: {item['analyze_prompt']}",
+            "=======================================",
+            f"score: {item['score']}, is_cached_result: {item['is_cached_result']}, timings: {item['timings']}",
+            "======================================="
+        ]
+        # 並列実行時に他のスレッドの出力と混ざらないよう、まとめて出力する
+        print("\n".join(lines))
+
+    def print_latest_log(self):
+        with self.__lock:
+            item = self.__queue[-1]
+        self.print_log(item)
+
+    def save_log_into_json(self, output_file_path: str):
+        with self.__lock:
+            d = {i: item for i, item in enumerate(self.__queue)}
+
+        with open(output_file_path, "w") as f:
+            json.dump(d, f, indent=2, ensure_ascii=False)
+
+    def get_latest_prompts(self) -> dict:
+        with self.__lock:
+            return dict(self.__latest_prompts)
+
+    def get_timing_summary(self) -> dict:
+        # 処理毎の所要時間の合計を返す. 並列実行時は、実行時間の合計より大きくなる
+        summary = {}
+        with self.__lock:
+            for item in self.__queue:
+                for key, value in item.get("timings", {}).items():
+                    if value is not None:
+                        summary[key] = summary.get(key, 0.0) + value
+        return summary
+
+
+class AbstractPromptEngineeringLLM(ABC):
+    """Auto Prompt Engineeringの各コンポーネントで利用するLLMの呼び出しをまとめたクラス"""
+
+    @abstractmethod
+    def generate(self, request_id: str, pdf_uri: str, prompt: str) -> str:
+        pass
+
+    @abstractmethod
+    def evaluate(self, request_id: str, pdf_uri: str, analyze_result: str) -> str:
+        pass
+
+    @abstractmethod
+    def rewrite(self, request_id: str, evaluator_result: str, analyze_prompt: str) -> str:
+        pass
+
+    @abstractmethod
+    def generalize(self, request_id: str, prompt_dict: dict) -> str:
+        pass
+
+
+class VertexPromptEngineeringLLM(AbstractPromptEngineeringLLM):
+    """
+    Vertex AI（Gemini）を利用するクラス
+    vertexai.initやstorage.Clientの生成は初回のみ行い、各スレッドから共有する
+    """
+
+    def __init__(self,
+                 project_id: str,
+                 bucket_name: str,
+                 output_folder: str,
+                 model_name: str = DEFAULT_MODEL_NAME,
+                 location: str = "us-central1",
+                 temperature: float = 0) -> None:
+        import vertexai
+        from google.cloud import storage
+        from vertexai.generative_models import GenerationConfig, GenerativeModel
+
+        vertexai.init(project=project_id, location=location)
+        self.__model = GenerativeModel(model_name=model_name)
+        self.__config = GenerationConfig(temperature=temperature)
+        self.__storage_client = storage.Client(project=project_id)
+        self.__model_name = model_name
+        self.__temperature = temperature
+        self.__bucket_name = bucket_name
+        self.__output_folder = output_folder
+        os.makedirs(output_folder, exist_ok=True)
+
+    def generate(self, request_id: str, pdf_uri: str, prompt: str) -> str:
+        """LLMを利用して、有価証券報告書を分析する"""
+        p = f"""
+上記の決算資料から、後述する観点について企業分析を行い、将来の株価の増減具合を教えてください。
+
+======
+{prompt}
+    """
+        return self.__generate_content(request_id=request_id,
+                                       pdf_uri=pdf_uri,
+                                       prompt=p,
+                                       log_name="analyze_pdf_log")
+
+    def evaluate(self, request_id: str, pdf_uri: str, analyze_result: str) -> str:
+        """LLMを利用して、有価証券報告書の分析結果が妥当だったか？を評価する"""
+        prompt = f"""
+あなたは有価証券報告書を分析するエキスパートです。
+上記の有価証券報告書の分析結果として、下記の内容は妥当でしょうか？妥当でない場合、課題点を列挙してください。
+最後の行には、分析結果の妥当性を0から100の整数で「スコア: <点数>」の形式で出力してください。
+
+=====
+{analyze_result}
+    """
+        return self.__generate_content(request_id=request_id,
+                                       pdf_uri=pdf_uri,
+                                       prompt=prompt,
+                                       log_name="evaluate_analysis_result_log")
+
+    def rewrite(self, request_id: str, evaluator_result: str, analyze_prompt: str) -> str:
+        prompt = f"""
+あなたはLLMのプロンプトを書き換えるエキスパートです。
+下記の分析に関する評価結果と分析時に利用したプロンプトから、最適なプロンプトを出力してください。
+ただし、後述するルールを守って、プロンプトを出力してください。
+
+分析の評価結果: {evaluator_result}
+分析時に利用したプロンプト: {analyze_prompt}
+
+# ルール
+・分析観点は一つに拘らず、複数の観点を出すようにしてください。
+・プロンプトの変更点がない場合は、プロンプト内容自体をFINISH、と表記するようにしてください。
+・会社名、具体的な決算資料の数値といった企業の固有情報をプロンプトに含めないでください。
+    """
+        return self.__generate_content(request_id=request_id,
+                                       pdf_uri=None,
+                                       prompt=prompt,
+                                       log_name="adjust_analysis_prompt_log")
+
+    def generalize(self, request_id: str, prompt_dict: dict) -> str:
+        target_prompts = ""
+        for target_prompt in prompt_dict.values():
+            p = f"prompt: {target_prompt}\n"
+            target_prompts += p
+        prompt = f"""
+あなたはLLMのプロンプトを書き換えるエキスパートです。
+下記の複数のプロンプトから、汎用的な有価証券報告書を分析するためのプロンプトに書き換えてください。
+ただし、後述するルールを守って、プロンプトを出力してください。
+
+# 複数のプロンプト情報
+{target_prompts}
+
+# ルール
+・分析観点は一つに拘らず、複数の観点を出すようにしてください。
+・会社名、具体的な決算資料の数値といった企業の固有情報をプロンプトに含めないでください。
+    """
+        return self.__generate_content(request_id=request_id,
+                                       pdf_uri=None,
+                                       prompt=prompt,
+                                       log_name="generalize_prompt_log")
+
+    def __generate_content(self, request_id: str, pdf_uri: str | None, prompt: str, log_name: str) -> str:
+        from vertexai.generative_models import Part
+
+        contents = [prompt]
+        if pdf_uri is not None:
+            contents = [Part.from_uri(uri=pdf_uri, mime_type="application/pdf"), prompt]
+        response = self.__model.generate_content(contents=contents, generation_config=self.__config)
+
+        # 解析結果をログとしてGCSに出力する
+        self.__upload_llm_log_data(request_id=request_id, response=response, prompt=prompt, log_name=log_name)
+        return response.text
+
+    def __upload_llm_log_data(self, request_id: str, response, prompt: str, log_name: str):
+        llm_log_data = {
+            "input": {
+                "input_datas": [],
+                "prompt": prompt,
+                "model_name": self.__model_name,
+                "llm_config": {
+                    "temperature": self.__temperature
+                },
+                "prompt_token_count": response._raw_response.usage_metadata.prompt_token_count,
+            },
+            "output": {
+                "text": response.candidates[0].text,
+                "finish_reason": response.candidates[0].finish_reason.name,
+                "finish_message": response.candidates[0].finish_message,
+                "safety_ratings": repeated_safety_ratings_to_list(response.candidates[0].safety_ratings),
+                "citation_metadata": repeated_citations_to_list(response.candidates[0].citation_metadata.citations),
+                "candidates_token_count": response._raw_response.usage_metadata.candidates_token_count,
+                "total_token_count": response._raw_response.usage_metadata.total_token_count
+            },
+            "meta": {
+                "timestamp": datetime.now().strftime("%Y%m%d%H%M%S"),
+                "request_id": request_id
+            }
+        }
+        # 並列実行時にファイルが衝突しないよう、request_idとログ名をファイル名に含める
+        tmp_log_file = os.path.join(self.__output_folder, f"tmp_log_{request_id}_{log_name}.json")
+        with open(tmp_log_file, "w") as f:
+            json.dump(llm_log_data, f, ensure_ascii=False)
+
+        try:
+            datetime_str = datetime.now().strftime("%Y%m%d%H%M%S")
+            bucket = self.__storage_client.bucket(self.__bucket_name)
+            blob = bucket.blob(f"log/{datetime_str}/{request_id}/{log_name}.json")
+            blob.upload_from_filename(tmp_log_file, if_generation_match=0)
+        except Exception as e:
+            print(e)
+        finally:
+            os.remove(tmp_log_file)
+
+
+class StubPromptEngineeringLLM(AbstractPromptEngineeringLLM):
+    """GCPに接続せずにループの挙動（並列実行、打ち切り、メモ化）を確認するためのスタブ"""
+
+    def __init__(self, latency_seconds: float = 1.0, scores: List[int] = [60, 70, 72, 72, 72]) -> None:
+        self.__latency_seconds = latency_seconds
+        self.__scores = scores
+        self.__lock = threading.Lock()
+        self.__evaluate_counts = {}
+        self.generate_count = 0
+
+    def generate(self, request_id: str, pdf_uri: str, prompt: str) -> str:
+        time.sleep(self.__latency_seconds)
+        with self.__lock:
+            self.generate_count += 1
+        return f"analysis result of {pdf_uri}"
+
+    def evaluate(self, request_id: str, pdf_uri: str, analyze_result: str) -> str:
+        time.sleep(self.__latency_seconds)
+        with self.__lock:
+            count = self.__evaluate_counts.get(pdf_uri, 0)
+            self.__evaluate_counts[pdf_uri] = count + 1
+        score = self.__scores[min(count, len(self.__scores) - 1)]
+        return f"evaluation of {pdf_uri}\nスコア: {score}"
+
+    def rewrite(self, request_id: str, evaluator_result: str, analyze_prompt: str) -> str:
+        time.sleep(self.__latency_seconds)
+        return f"{analyze_prompt}\n・{evaluator_result.splitlines()[0]}を踏まえて分析すること。"
+
+    def generalize(self, request_id: str, prompt_dict: dict) -> str:
+        time.sleep(self.__latency_seconds)
+        return "\n".join(prompt_dict.values())
+
+
+class AutoPromptEngineer:
+    """
+    PDF毎にGenerator → Evaluator → Rewriterのループを並列に実行し、
+    最後にGeneralizerで汎用的なプロンプトを作成するクラス
+    """
+
+    def __init__(self,
+                 llm: AbstractPromptEngineeringLLM,
+                 max_loop_count: int = 3,
+                 max_workers: int = 4,
+                 patience: int = 1,
+                 min_score_delta: int = 1,
+                 internal_logger: InternalLog | None = None,
+                 verbose: bool = True) -> None:
+        """
+        Args:
+            llm (AbstractPromptEngineeringLLM): 各コンポーネントで利用するLLM
+            max_loop_count (int): PDF毎のループの最大回数
+            max_workers (int): 同時にループを実行するPDFの数
+            patience (int): スコアがmin_score_delta以上改善しないイテレーションがこの回数続いた場合にループを打ち切る
+            min_score_delta (int): 改善したとみなすスコアの差分
+        """
+        self.__llm = llm
+        self.__max_loop_count = max_loop_count
+        self.__max_workers = max(1, max_workers)
+        self.__patience = patience
+        self.__min_score_delta = min_score_delta
+        self.__internal_logger = internal_logger if internal_logger is not None else InternalLog()
+        self.__verbose = verbose
+
+        # (プロンプトのハッシュ, PDFのuri) -> 分析結果のFuture. 同じ組み合わせを同時に分析しないよう、Futureを共有する
+        self.__generation_lock = threading.Lock()
+        self.__generations: Dict[tuple, Future] = {}
+
+    def get_internal_logger(self) -> InternalLog:
+        return self.__internal_logger
+
+    def run(self, pdf_uris: List[str], default_analyze_prompt: str) -> str:
+        with ThreadPoolExecutor(max_workers=self.__max_workers, thread_name_prefix="auto_prompt_engineering") as executor:
+            prompts = list(executor.map(lambda pdf_uri: self.optimize_prompt(pdf_uri=pdf_uri,
+                                                                                 default_analyze_prompt=default_analyze_prompt),
+                                        pdf_uris))
+        for pdf_uri, prompt in zip(pdf_uris, prompts):
+            self.__internal_logger.set_latest_prompt(pdf_uri=pdf_uri, prompt=prompt)
+
+        # 全てのプロンプト結果を元に汎用的なプロンプトを作り直す
+        start_time = time.perf_counter()
+        final_prompt = self.__llm.generalize(request_id=str(uuid.uuid4()),
+                                             prompt_dict=self.__internal_logger.get_latest_prompts())
+        self.__internal_logger.set_final_analysis_prompt(prompt=final_prompt,
+                                                         elapsed_seconds=time.perf_counter() - start_time)
+        return final_prompt
+
+    def optimize_prompt(self, pdf_uri: str, default_analyze_prompt: str) -> str:
+        """
+        1つのPDFに対してループを実行し、最もスコアが高かった分析時のプロンプトを返す
+        Rewriterがプロンプトの変更点がない（FINISH）と判断した場合や、スコアが改善しなくなった場合はループを打ち切る
+        """
+        analyze_prompt = default_analyze_prompt
+        best_prompt, best_score = default_analyze_prompt, None
+        stale_count = 0
+        for i in range(self.__max_loop_count):
+            request_id = str(uuid.uuid4())
+            timings = {}
+            iter_start_time = time.perf_counter()
+
+            # 有価証券報告書の分析を行う
+            start_time = time.perf_counter()
+            analyze_result, is_cached_result = self.__generate_with_memo(request_id=request_id,
+                                                                         pdf_uri=pdf_uri,
+                                                                         prompt=analyze_prompt)
+            timings["generate_seconds"] = time.perf_counter() - start_time
+
+            # 分析結果を評価する
+            start_time = time.perf_counter()
+            evaluate_result = self.__llm.evaluate(request_id=request_id, pdf_uri=pdf_uri, analyze_result=analyze_result)
+            timings["evaluate_seconds"] = time.perf_counter() - start_time
+            score = parse_score(evaluate_result)
+
+            # プロンプトを書き換える
+            start_time = time.perf_counter()
+            rewritten_prompt = self.__llm.rewrite(request_id=request_id,
+                                                  evaluator_result=evaluate_result,
+                                                  analyze_prompt=analyze_prompt)
+            timings["rewrite_seconds"] = time.perf_counter() - start_time
+            timings["iteration_seconds"] = time.perf_counter() - iter_start_time
+
+            # 1イテレーション分の結果を出力する
+            item = self.__internal_logger.set_log(pdf_uri=pdf_uri,
+                                                  iter_count=i,
+                                                  analyze_result=analyze_result,
+                                                  evaluate_result=evaluate_result,
+                                                  analyze_prompt=rewritten_prompt,
+                                                  score=score,
+                                                  is_cached_result=is_cached_result,
+                                                  timings=timings)
+            if self.__verbose:
+                self.__internal_logger.print_log(item)
+
+            # スコアが取得できない場合は、改善の有無を判断せずにループを続ける
+            if score is not None:
+                if best_score is None or score >= best_score + self.__min_score_delta:
+                    best_prompt, best_score = analyze_prompt, score
+                    stale_count = 0
+                else:
+                    stale_count += 1
+            elif best_score is None:
+                best_prompt = analyze_prompt
+
+            if "FINISH" in rewritten_prompt:
+                print(f"analyze_prompt of {pdf_uri} is end! break")
+                break
+            if stale_count >= self.__patience:
+                print(f"score of {pdf_uri} is not improved (best score = {best_score}). break")
+                break
+            analyze_prompt = rewritten_prompt
+
+        return best_prompt
+
+    def __generate_with_memo(self, request_id: str, pdf_uri: str, prompt: str) -> tuple[str, bool]:
+        key = (hashlib.sha256(prompt.encode("utf-8")).hexdigest(), pdf_uri)
+        with self.__generation_lock:
+            future = self.__generations.get(key)
+            is_cached_result = future is not None
+            if future is None:
+                future = Future()
+                self.__generations[key] = future
+        if is_cached_result:
+            return future.result(), True
+
+        try:
+            future.set_result(self.__llm.generate(request_id=request_id, pdf_uri=pdf_uri, prompt=prompt))
+        except Exception as e:
+            # 失敗した結果はメモ化せず、次回に再度分析する
+            with self.__generation_lock:
+                self.__generations.pop(key, None)
+            future.set_exception(e)
+            raise
+        return future.result(), False
+
+
+def parse_score(evaluate_result: str) -> int | None:
+    # 複数見つかった場合は、最後に出力されたスコアを採用する
+    scores = SCORE_PATTERN.findall(evaluate_result)
+    if len(scores) == 0:
+        return None
+    return min(int(scores[-1]), 100)
+
+
+# citation_metadataオブジェクトをリストに変換する
+def repeated_citations_to_list(citations) -> list:
+    citation_li = []
+    for citation in citations:
+        citation_dict = {}
+        citation_dict["startIndex"] = citation.startIndex
+        citation_dict["endIndex"] = citation.endIndex
+        citation_dict["uri"] = citation.uri
+        citation_dict["title"] = citation.title
+        citation_dict["license"] = citation.license
+        citation_dict["publicationDate"] = citation.publicationDate
+        citation_li.append(citation_dict)
+    return citation_li
+
+
+# safety_ratingsオブジェクトをリストに変換する
+def repeated_safety_ratings_to_list(safety_ratings) -> list:
+    safety_rating_li = []
+    for safety_rating in safety_ratings:
+        safety_rating_dict = {}
+        safety_rating_dict["category"] = safety_rating.category.name
+        safety_rating_dict["probability"] = safety_rating.probability.name
+        safety_rating_li.append(safety_rating_dict)
+    return safety_rating_li
+
+
+if __name__ == "__main__":
+    # スタブを利用して、PDFの数が増えても実行時間がワーカー数に応じて抑えられることを確認する
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument("--pdf_count", type=int, default=8)
+    parser.add_argument("--max_workers", type=int, default=8)
+    parser.add_argument("--max_loop_count", type=int, default=3)
+    parser.add_argument("--stub_latency", type=float, default=0.5)
+    args = parser.parse_args()
+
+    engineer = AutoPromptEngineer(llm=StubPromptEngineeringLLM(latency_seconds=args.stub_latency),
+                                  max_loop_count=args.max_loop_count,
+                                  max_workers=args.max_workers,
+                                  verbose=False)
+    start_time = time.perf_counter()
+    engineer.run(pdf_uris=[f"gs://stub_bucket/sample/{i}.pdf" for i in range(args.pdf_count)],
+                 default_analyze_prompt="・有価証券報告書に含まれる情報を分析時に利用すること。")
+    print(f"elapsed = {time.perf_counter() - start_time:.2f}s, timings = {engineer.get_internal_logger().get_timing_summary()}")